@@ -0,0 +1,116 @@
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+class AnalysisCache:
+    """Кэш результатов анализа документов по хэшу изображения
+
+    Два уровня: LRU в памяти процесса и таблица analysis_cache в SQLite,
+    чтобы повторно отправленное фото не уходило в Cloud Function после перезапуска.
+    """
+
+    def __init__(self, database=None):
+        self.db = database or db
+        self.enabled = os.getenv('ANALYSIS_CACHE_ENABLED', 'True').lower() == 'true'
+        self.max_memory_entries = int(os.getenv('ANALYSIS_CACHE_MEMORY_SIZE', 256))
+        self.max_db_entries = int(os.getenv('ANALYSIS_CACHE_DB_SIZE', 10000))
+        self.ttl = int(os.getenv('ANALYSIS_CACHE_TTL', 7 * 24 * 3600))
+        # Чистка SQLite уровня выполняется не на каждую запись
+        self.evict_every = int(os.getenv('ANALYSIS_CACHE_EVICT_EVERY', 100))
+
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._writes_since_evict = 0
+        self._stats = {
+            "memory_hits": 0,
+            "db_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+        }
+
+    @staticmethod
+    def make_key(image_bytes: bytes, document_type: str) -> str:
+        """Ключ кэша: хэш содержимого изображения и тип документа"""
+        digest = hashlib.sha256(image_bytes).hexdigest()
+        return f"{document_type}:{digest}"
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Ищет результат сначала в памяти, затем в базе данных"""
+        if not self.enabled:
+            return None
+
+        entry = self._memory.get(key)
+        if entry:
+            expires_at, result = entry
+            if expires_at > time.time():
+                self._memory.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return dict(result)
+            del self._memory[key]
+
+        cached = await self.db.get_cached_analysis(key, self.ttl)
+        if cached:
+            result, created_at = cached
+            self._stats["db_hits"] += 1
+            self._remember(key, result, created_at)
+            return dict(result)
+
+        self._stats["misses"] += 1
+        return None
+
+    async def set(self, key: str, document_type: str, result: Dict[str, Any]):
+        """Сохраняет успешный результат анализа в оба уровня кэша"""
+        if not self.enabled or not result.get("success"):
+            return
+
+        self._remember(key, result)
+        await self.db.save_cached_analysis(key, document_type, result)
+        self._stats["stores"] += 1
+
+        self._writes_since_evict += 1
+        if self._writes_since_evict >= self.evict_every:
+            self._writes_since_evict = 0
+            removed = await self.db.evict_analysis_cache(self.ttl, self.max_db_entries)
+            self._stats["evictions"] += removed
+
+    def _remember(self, key: str, result: Dict[str, Any], created_at: Optional[float] = None):
+        """Кладет результат в LRU и вытесняет самые старые записи
+
+        created_at - время записи результата в базу; срок жизни в памяти
+        отсчитывается от него, а не от момента чтения.
+        """
+        expires_at = (created_at if created_at is not None else time.time()) + self.ttl
+        self._memory[key] = (expires_at, dict(result))
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Возвращает счетчики попаданий и промахов"""
+        hits = self._stats["memory_hits"] + self._stats["db_hits"]
+        total = hits + self._stats["misses"]
+        return {
+            **self._stats,
+            "memory_entries": len(self._memory),
+            "hit_ratio": round(hits / total, 3) if total else 0.0,
+        }
+
+    def format_stats(self) -> str:
+        """Статистика кэша в виде строки для сообщений"""
+        stats = self.stats()
+        return (
+            f"попаданий: {stats['memory_hits']} (память) + {stats['db_hits']} (БД), "
+            f"промахов: {stats['misses']} ({stats['hit_ratio'] * 100:.0f}% попаданий), "
+            f"в памяти: {stats['memory_entries']}"
+        )
+
+# Создаем глобальный экземпляр кэша
+analysis_cache = AnalysisCache()
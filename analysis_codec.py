@@ -0,0 +1,109 @@
+import json
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+# Поля результата анализа, вынесенные в отдельные колонки document_analysis
+PROMOTED_FIELDS = ('vin', 'registration_number', 'brand', 'model', 'year', 'quality_score')
+
+# Версия формата хранится в первом байте данных, чтобы новый словарь
+# можно было ввести без перекодирования уже сохраненных строк
+FORMAT_DEFLATE_V1 = b'\x01'
+
+# Общий словарь сжатия: ключи результата анализа и типичные надписи СТС,
+# ПТС и ПСМ. Короткие результаты почти целиком состоят из этих строк, и без
+# словаря zlib не успевает набрать на них статистику. Самые частые строки
+# стоят в конце - на них получаются самые короткие ссылки.
+ZDICT_V1 = ''.join([
+    'ПАСПОРТ САМОХОДНОЙ МАШИНЫ И ДРУГИХ ВИДОВ ТЕХНИКИ Заводской номер машины (рамы) ',
+    'Вид движителя гусеничный колесный Максимальная конструктивная скорость, км/ч ',
+    'Габаритные размеры, мм Организация-изготовитель Страна производства ',
+    'Наименование (адрес) таможенного органа Особые отметки ',
+    'ПАСПОРТ ТРАНСПОРТНОГО СРЕДСТВА Наименование (тип ТС) Категория ТС (A, B, C, D, прицеп) ',
+    'Модель, № двигателя Шасси (рама) № Кузов (кабина, прицеп) № ОТСУТСТВУЕТ ',
+    'Мощность двигателя, л.с. (кВт) Рабочий объем двигателя, куб. см Тип двигателя дизельный ',
+    'Экологический класс Разрешенная максимальная масса, кг Масса без нагрузки, кг ',
+    'СВИДЕТЕЛЬСТВО О РЕГИСТРАЦИИ ТРАНСПОРТНОГО СРЕДСТВА Собственник (владелец) ',
+    'Регистрационный знак Идентификационный номер (VIN) Марка, модель Тип ТС ',
+    'Год выпуска ТС Цвет белый черный красный синий зеленый желтый серый оранжевый ',
+    'ГРУЗОВОЙ САМОСВАЛ ТЯГАЧ СЕДЕЛЬНЫЙ ПОГРУЗЧИК ЭКСКАВАТОР ТРАКТОР АВТОКРАН БУЛЬДОЗЕР ',
+    'КАМАЗ МАЗ ГАЗ УРАЛ ЗИЛ МТЗ БЕЛАРУС JCB CATERPILLAR HITACHI KOMATSU VOLVO ',
+    '"environmental_class":"","body_number":"","chassis_number":"","engine_number":"",',
+    '"passport_number":"","registration_date":"","owner":"","max_weight":,"weight":,',
+    '"color":"","engine_volume":,"engine_power":,"category":"","document_type":"СТС",',
+    '"analysis_timestamp":"20","success":true,"extracted_text":"',
+]).encode('utf-8')
+
+def encode_analysis(result: Dict[str, Any], columns: Dict[str, Any]) -> bytes:
+    """
+    Сжимает результат анализа без значений, которые хранятся в колонках
+
+    columns - значения колонок строки; поле результата с тем же значением
+    в blob не попадает и восстанавливается из колонки при чтении.
+    Явные None сохраняются: колонка со значением NULL поле не восстановит,
+    а "поле не распознано" и "поля нет в результате" различаются.
+    """
+    remainder = {
+        key: value for key, value in result.items()
+        if value is None or not (key in columns and columns[key] == value)
+    }
+    raw = json.dumps(remainder, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=ZDICT_V1)
+    return FORMAT_DEFLATE_V1 + compressor.compress(raw) + compressor.flush()
+
+def decode_analysis(blob, columns: Dict[str, Any]) -> Dict[str, Any]:
+    """Восстанавливает результат анализа из blob и колонок строки"""
+    if not blob:
+        result = {}
+    elif isinstance(blob, str):
+        # Строки, записанные до перехода на сжатый формат
+        result = json.loads(blob)
+    elif blob[:1] == FORMAT_DEFLATE_V1:
+        decompressor = zlib.decompressobj(-15, zdict=ZDICT_V1)
+        result = json.loads(decompressor.decompress(blob[1:]) + decompressor.flush())
+    else:
+        raise ValueError(f"Неизвестный формат данных анализа: {blob[:1]!r}")
+
+    for key, value in columns.items():
+        if value is not None:
+            result.setdefault(key, value)
+    return result
+
+def encode_missing_fields(fields: Optional[List[str]]) -> Optional[str]:
+    """Список отсутствующих полей в виде строки через запятую"""
+    return ','.join(fields) if fields else None
+
+def decode_missing_fields(value: Optional[str]) -> List[str]:
+    if not value:
+        return []
+    if value.startswith('['):
+        return json.loads(value)
+    return value.split(',')
+
+def analysis_columns(analysis_data: Dict[str, Any]) -> Tuple[Dict[str, Any], bytes]:
+    """
+    Колонки и blob строки document_analysis в формате save_document_analysis
+
+    Вынесенные поля берутся из самой записи, а если их там нет - из
+    результата анализа analysis_data.
+    """
+    result = analysis_data.get("analysis_data") or {}
+    columns = {
+        field: analysis_data[field] if analysis_data.get(field) is not None else result.get(field)
+        for field in PROMOTED_FIELDS
+    }
+    columns["document_type"] = analysis_data.get("document_type", "СТС")
+    columns["analysis_quality"] = analysis_data.get("analysis_quality")
+    missing_fields = analysis_data.get("missing_fields") or []
+    columns["missing_fields"] = encode_missing_fields(missing_fields)
+
+    # Поля, которые при чтении восстанавливаются из колонок
+    restored = {key: columns[key] for key in PROMOTED_FIELDS + ("document_type", "analysis_quality")}
+    restored["missing_fields"] = missing_fields
+    return columns, encode_analysis(result, restored)
+
+def restore_analysis(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Результат анализа из строки document_analysis"""
+    missing_fields = decode_missing_fields(row.get("missing_fields"))
+    columns = {key: row.get(key) for key in PROMOTED_FIELDS + ("document_type", "analysis_quality")}
+    columns["missing_fields"] = missing_fields or None
+    return decode_analysis(row.get("analysis_data"), columns)
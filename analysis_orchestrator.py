@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import os
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Поля, которые при объединении результатов берутся из резервного анализа
+MERGE_FIELDS = [
+    "vin", "registration_number", "model", "brand", "year", "category",
+    "engine_power", "engine_volume", "color", "weight", "max_weight", "owner",
+    "passport_number", "registration_date", "engine_number", "chassis_number",
+    "body_number", "environmental_class", "extracted_text"
+]
+
+class HedgedDocumentAnalyzer:
+    """
+    Анализ документа с хеджированием: Cloud Function + Vision OCR
+
+    Сначала вызывается основной анализатор (Cloud Function). Если за
+    latency_budget секунд ответа нет, параллельно запускается Vision OCR
+    с локальным разбором текста. Возвращается первый успешный результат;
+    если резервный пришел раньше, основной ждет еще grace секунд и при
+    успехе результаты объединяются. Проигравший запрос отменяется.
+
+    Если Vision тоже не ответил, а локальное распознавание local
+    включено, резервный анализ выполняется без сети.
+    """
+
+    def __init__(self, primary, vision, text_parser: Callable[[str], Dict[str, Any]], local=None):
+        self.primary = primary
+        self.vision = vision
+        self.text_parser = text_parser
+        self.local = local
+        self.latency_budget = float(os.getenv('CF_HEDGE_BUDGET', 8))
+        self.grace = float(os.getenv('CF_HEDGE_GRACE', 2))
+
+        self._stats = {
+            "primary": 0,
+            "fallback": 0,
+            "local": 0,
+            "merged": 0,
+            "hedged": 0,
+            "failed": 0,
+        }
+
+    async def analyze_document(self, image_bytes: bytes, document_type: str = "СТС",
+                               organization_id: int = None) -> Dict[str, Any]:
+        """Анализирует документ, ограничивая ожидание бюджетом задержки"""
+        primary_task = asyncio.create_task(
+            self.primary.analyze_document(image_bytes, document_type, organization_id)
+        )
+        fallback_task = None
+
+        try:
+            done, _ = await asyncio.wait({primary_task}, timeout=self.latency_budget)
+            if done:
+                result = primary_task.result()
+                if result.get("success"):
+                    return self._finish("primary", result)
+                logger.warning(f"Основной анализ не удался: {result.get('error')}, пробую Vision")
+                fallback = await self._fallback_analysis(image_bytes, document_type)
+                if fallback.get("success"):
+                    return self._finish("fallback", fallback)
+                self._stats["failed"] += 1
+                return result
+
+            logger.info(f"Нет ответа за {self.latency_budget}с, запускаю резервный анализ")
+            self._stats["hedged"] += 1
+            fallback_task = asyncio.create_task(self._fallback_analysis(image_bytes, document_type))
+            return await self._race(primary_task, fallback_task)
+        finally:
+            for task in (primary_task, fallback_task):
+                if task and not task.done():
+                    task.cancel()
+
+    async def _race(self, primary_task: asyncio.Task, fallback_task: asyncio.Task) -> Dict[str, Any]:
+        """Ждет первый успешный результат из двух запущенных анализов"""
+        pending = {primary_task, fallback_task}
+        fallback_result = None
+        primary_result = None
+
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+            if primary_task in done:
+                primary_result = primary_task.result()
+                if primary_result.get("success"):
+                    if fallback_result and fallback_result.get("success"):
+                        return self._finish("merged", self.merge_results(primary_result, fallback_result))
+                    return self._finish("primary", primary_result)
+
+            if fallback_task in done:
+                fallback_result = fallback_task.result()
+                if fallback_result.get("success") and primary_task in pending:
+                    # Даем основному анализу немного времени, чтобы объединить результаты
+                    finished, _ = await asyncio.wait({primary_task}, timeout=self.grace)
+                    if finished and primary_task.result().get("success"):
+                        return self._finish("merged", self.merge_results(primary_task.result(), fallback_result))
+                    return self._finish("fallback", fallback_result)
+
+        if fallback_result and fallback_result.get("success"):
+            return self._finish("fallback", fallback_result)
+
+        self._stats["failed"] += 1
+        return primary_result or fallback_result
+
+    async def _fallback_analysis(self, image_bytes: bytes, document_type: str) -> Dict[str, Any]:
+        """Распознает текст через Vision и разбирает поля регулярными выражениями"""
+        ocr_result = await self.vision.analyze_document_text(image_bytes)
+        if not ocr_result.get("success"):
+            if self.local and self.local.enabled:
+                logger.warning(f"Vision не ответил: {ocr_result.get('error')}, распознаю локально")
+                result = await self.local.analyze_document(image_bytes, document_type)
+                if result.get("success"):
+                    self._stats["local"] += 1
+                return result
+            return ocr_result
+
+        text = ocr_result["extracted_text"]
+        fields = self.text_parser(text)
+        fields["extracted_text"] = text
+
+        result = self.primary.result_from_fields(fields, document_type)
+        result["analysis_source"] = "vision"
+        return result
+
+    def merge_results(self, primary: Dict[str, Any], fallback: Dict[str, Any]) -> Dict[str, Any]:
+        """Дополняет результат основного анализа полями резервного"""
+        fields = {field: primary.get(field) for field in MERGE_FIELDS}
+        for field in MERGE_FIELDS:
+            if not fields.get(field) and fallback.get(field):
+                fields[field] = fallback[field]
+
+        merged = self.primary.result_from_fields(fields, primary.get("document_type", "СТС"))
+        merged["analysis_source"] = "merged"
+        return merged
+
+    def _finish(self, source: str, result: Dict[str, Any]) -> Dict[str, Any]:
+        self._stats[source] += 1
+        result.setdefault("analysis_source", source)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        """Возвращает статистику источников результата"""
+        return dict(self._stats)
+
+    def format_stats(self) -> str:
+        """Статистика хеджирования в виде строки для сообщений"""
+        stats = self.stats()
+        return (
+            f"Cloud Function: {stats['primary']}, резерв: {stats['fallback']} "
+            f"(из них локально: {stats['local']}), "
+            f"объединено: {stats['merged']}, хеджировано: {stats['hedged']}, ошибок: {stats['failed']}"
+        )
@@ -0,0 +1,70 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, List, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+class MicroBatcher:
+    """
+    Собирает элементы, пришедшие в коротком окне, в один пакет
+
+    process_batch получает список элементов и должен вернуть список
+    результатов в том же порядке. Пакет отправляется по истечении окна
+    или сразу при достижении max_size. Элемент, пришедший, когда ничего
+    не ждет и не обрабатывается, отправляется сразу без ожидания окна;
+    окно начинается со следующего элемента.
+    """
+
+    def __init__(self, process_batch: Callable[[List[Any]], Awaitable[List[Any]]],
+                 window: float, max_size: int):
+        self.process_batch = process_batch
+        self.window = window
+        self.max_size = max_size
+
+        self._pending: List[Tuple[Any, asyncio.Future]] = []
+        self._timer = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def submit(self, item: Any) -> Any:
+        """Добавляет элемент в текущий пакет и ждет его результат"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+
+        idle = len(self._pending) == 1 and not self._tasks
+        if idle or len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+
+        return await future
+
+    def _flush(self):
+        """Отправляет накопленный пакет в фоне"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        # Отмененные ожидания в пакет не попадают
+        batch = [(item, future) for item, future in self._pending if not future.done()]
+        self._pending = []
+        if not batch:
+            return
+
+        task = asyncio.create_task(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[Tuple[Any, asyncio.Future]]):
+        try:
+            results = await self.process_batch([item for item, _ in batch])
+        except Exception as e:
+            logger.error(f"Ошибка обработки пакета: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
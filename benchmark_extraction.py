@@ -0,0 +1,211 @@
+"""
+Микробенчмарк извлечения полей из ответов модели
+
+Сравнивает модуль extraction с прежней реализацией DocumentAnalyzer и
+vision_analyzer на корпусе ответов: поиск JSON, очистку полей и разбор
+распознанного текста документов и приборных панелей. Печатает время на
+один ответ и число ответов, где результаты различаются.
+
+Корпус - файл JSONL, где в каждой строке {"response": "..."} (ответ
+модели) или {"text": "..."} (распознанный текст). Без файла используется
+встроенный набор типичных ответов.
+
+Запуск: python benchmark_extraction.py [corpus.jsonl] [--repeat N]
+"""
+import json
+import re
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+import extraction
+
+# Типичные ответы функции анализа: JSON в блоке кода, с пояснениями,
+# с вложенными объектами и с переводами строк внутри строк
+SAMPLE_FIELDS = {
+    "document_type": "СТС", "vin": "x9f65200090012345", "registration_number": "а 123 вс 77",
+    "brand": "КАМАЗ", "model": "6520-43", "year": "2019 г.", "category": "C",
+    "engine_power": "400 л.с. (294 кВт)", "engine_volume": "11762 куб. см", "color": "оранжевый",
+    "weight": "12500 кг", "max_weight": "33100 кг", "owner": "ООО  Ромашка",
+    "passport_number": "77 ОТ 123456", "registration_date": "12.03.2021", "engine_number": "740.705",
+    "chassis_number": "ОТСУТСТВУЕТ", "body_number": "ОТСУТСТВУЕТ", "environmental_class": "пятый",
+    "extracted_text": "СВИДЕТЕЛЬСТВО О РЕГИСТРАЦИИ ТС\nМарка, модель: КАМАЗ 6520\nVIN X9F65200090012345",
+}
+SAMPLE_TEXT = (
+    "СВИДЕТЕЛЬСТВО О РЕГИСТРАЦИИ ТРАНСПОРТНОГО СРЕДСТВА\n"
+    "Регистрационный знак А123ВС77\n"
+    "Идентификационный номер (VIN) X9F65200090012345\n"
+    "Марка: КАМАЗ\nМодель: 6520-43\nГод выпуска ТС 2019\n"
+    "Пробег 125430 км"
+)
+
+def builtin_corpus() -> Dict[str, List[str]]:
+    body = json.dumps(SAMPLE_FIELDS, ensure_ascii=False, indent=2)
+    nested = dict(SAMPLE_FIELDS, details={"axles": {"count": 3}, "notes": "без замечаний"})
+    return {
+        "response": [
+            f"```json\n{body}\n```",
+            f"Вот результат анализа документа:\n{body}\nЕсли нужно, уточните фото.",
+            json.dumps(nested, ensure_ascii=False),
+            body.replace("\\n", "\n"),
+            "Не удалось распознать документ, попробуйте другое фото.",
+        ],
+        "text": [SAMPLE_TEXT, SAMPLE_TEXT.upper(), "Одометр: 98765\nТопливо 1/2"],
+    }
+
+def load_corpus(path: str) -> Dict[str, List[str]]:
+    corpus = {"response": [], "text": []}
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                record = json.loads(line)
+                for kind in corpus:
+                    if kind in record:
+                        corpus[kind].append(record[kind])
+    return corpus
+
+# ========== ПРЕЖНЯЯ РЕАЛИЗАЦИЯ ==========
+def legacy_extract_json(response_text: str) -> Optional[Dict]:
+    try:
+        json_str = None
+        for pattern in [r'```json\s*(.*?)\s*```', r'```\s*(.*?)\s*```', r'(\{.*?\})']:
+            match = re.search(pattern, response_text, re.DOTALL)
+            if match:
+                json_str = match.group(1) if len(match.groups()) > 0 else match.group(0)
+                break
+        if not json_str:
+            start = response_text.find('{')
+            end = response_text.rfind('}')
+            if start != -1 and end != -1 and end > start:
+                json_str = response_text[start:end+1]
+        if json_str:
+            json_str = re.sub(r'[\x00-\x1f\x7f-\x9f]', '', json_str.strip())
+            return json.loads(json_str)
+    except json.JSONDecodeError:
+        return None
+    return None
+
+def legacy_clean_fields(data: Dict) -> Dict:
+    cleaned = {}
+    for field in extraction.EXPECTED_FIELDS:
+        value = data.get(field)
+        if value is None or value == "null" or value == "":
+            cleaned[field] = None
+            continue
+        if isinstance(value, str):
+            value = re.sub(r'\s+', ' ', value.strip())
+            if field == "vin":
+                vin_match = re.search(r'[A-HJ-NPR-Z0-9]{17}', value.upper())
+                value = vin_match.group(0) if vin_match else None
+            elif field == "registration_number":
+                value = re.sub(r'[^А-Я0-9]', '', value.upper())
+            elif field == "year":
+                year_match = re.search(r'\b(19\d{2}|20\d{2})\b', value)
+                value = int(year_match.group(0)) if year_match else None
+            elif field == "engine_power":
+                power_match = re.search(r'(\d+)\s*(л\.с\.|лс|кВт|сил|hp)', value, re.IGNORECASE)
+                if power_match:
+                    value = int(power_match.group(1))
+                else:
+                    num_match = re.search(r'\b(\d{2,4})\b', value)
+                    value = int(num_match.group(1)) if num_match else None
+            elif field == "color":
+                colors = ["белый", "черный", "красный", "синий", "зеленый",
+                          "желтый", "серый", "коричневый", "оранжевый", "фиолетовый"]
+                for color in colors:
+                    if color in value.lower():
+                        value = color.capitalize()
+                        break
+            elif field in ["weight", "max_weight", "engine_volume"]:
+                num_match = re.search(r'\b(\d+)\b', value)
+                value = int(num_match.group(0)) if num_match else None
+        cleaned[field] = value
+    return cleaned
+
+def legacy_parse_document_text(text: str) -> Dict:
+    info = {}
+    vin_match = re.search(r'[A-HJ-NPR-Z0-9]{17}', text.upper())
+    if vin_match:
+        info['vin'] = vin_match.group(0)
+    plate_match = re.search(r'[АВЕКМНОРСТУХ]\d{3}[АВЕКМНОРСТУХ]{2}\d{2,3}', text.upper())
+    if plate_match:
+        info['registration_number'] = plate_match.group(0)
+    year_match = re.search(r'\b(19[0-9]{2}|20[0-2][0-9])\b', text)
+    if year_match:
+        info['year'] = year_match.group(0)
+    for line in text.split('\n'):
+        if 'МОДЕЛЬ' in line.upper() or 'MODEL' in line.upper():
+            parts = line.split(':')
+            if len(parts) > 1:
+                info['model'] = parts[1].strip()
+        if 'МАРКА' in line.upper() or 'BRAND' in line.upper():
+            parts = line.split(':')
+            if len(parts) > 1:
+                info['brand'] = parts[1].strip()
+    return info
+
+def legacy_parse_instrument_panel(text: str) -> Dict:
+    info = {}
+    patterns = [
+        r'(\d{1,6}[.,]?\d*)\s*(km|км|к\.м\.)',
+        r'(Пробег|Одометр|ODO)[:\s]*(\d{1,6}[.,]?\d*)',
+        r'\b(\d{4,6})\b'
+    ]
+    for pattern in patterns:
+        for match in re.findall(pattern, text, re.IGNORECASE):
+            if isinstance(match, tuple):
+                for item in match:
+                    if item and item.isdigit():
+                        info['odometer'] = int(item.replace('.', '').replace(',', ''))
+                        break
+            elif match.isdigit():
+                info['odometer'] = int(match)
+            if 'odometer' in info:
+                break
+        if 'odometer' in info:
+            break
+    return info
+
+# ========== ЗАМЕРЫ ==========
+def legacy_pipeline(response: str) -> Optional[Dict]:
+    data = legacy_extract_json(response)
+    return legacy_clean_fields(data) if data else None
+
+def new_pipeline(response: str) -> Optional[Dict]:
+    data = extraction.find_json_object(response)
+    return extraction.clean_fields(data) if data else None
+
+def measure(function: Callable, inputs: List[str], repeat: int) -> float:
+    """Среднее время одного вызова, мкс"""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for value in inputs:
+            function(value)
+    return (time.perf_counter() - started) / (repeat * len(inputs)) * 1e6
+
+def main() -> int:
+    args = sys.argv[1:]
+    repeat = 2000
+    if "--repeat" in args:
+        index = args.index("--repeat")
+        repeat = int(args[index + 1])
+        del args[index:index + 2]
+    corpus = load_corpus(args[0]) if args else builtin_corpus()
+
+    cases = [
+        ("JSON + очистка полей", corpus["response"], legacy_pipeline, new_pipeline),
+        ("текст документа", corpus["text"], legacy_parse_document_text, extraction.parse_document_text),
+        ("приборная панель", corpus["text"], legacy_parse_instrument_panel, extraction.parse_instrument_panel),
+    ]
+    print(f"{'операция':<24}{'было, мкс':>12}{'стало, мкс':>12}{'ускорение':>12}{'различий':>10}")
+    for name, inputs, legacy, new in cases:
+        if not inputs:
+            continue
+        differences = sum(1 for value in inputs if legacy(value) != new(value))
+        before = measure(legacy, inputs, repeat)
+        after = measure(new, inputs, repeat)
+        print(f"{name:<24}{before:>12.1f}{after:>12.1f}{before / after:>11.1f}x{differences:>10}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+"""
+Проверка планов запросов Database
+
+Вызывает каждый публичный метод Database на временной базе, перехватывает
+выполненные SQL-запросы через trace callback и прогоняет их через
+EXPLAIN QUERY PLAN. Завершается с кодом 1, если какой-то запрос читает
+таблицу полным сканированием или для метода нет примера вызова.
+
+Запуск: python check_query_plans.py
+"""
+import asyncio
+import inspect
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+from typing import Dict, List
+
+from database import Database
+
+# Примеры вызовов в порядке выполнения: (метод, позиционные аргументы, именованные аргументы)
+CALLS = [
+    ("register_user", (1001, "Директор"), {}),
+    ("register_user", (1002, "Водитель"), {}),
+    ("create_organization_for_director", (1001, "ООО Проверка"), {}),
+    ("update_user_role", (1002, "driver", 1), {}),
+    ("assign_role_to_user", (1002, "driver", 1), {}),
+    ("get_user", (1001,), {}),
+    ("get_users_page", (), {}),
+    ("get_users_page", ("0_0",), {"role": "driver", "organization_id": 1}),
+    ("get_users_page", ("0_0",), {"backward": True, "organization_id": 1}),
+    ("get_users_page", ("0_0",), {"role": "driver"}),
+    ("get_users_by_organization", (1,), {}),
+    ("get_organization", (1,), {}),
+    ("get_organizations_page", (), {}),
+    ("get_organizations_page", ("0_1",), {"backward": True}),
+    ("add_equipment", ("Камаз 6520", "6520", "X9F00000000000001", 1), {}),
+    ("update_equipment", (1,), {"year": 2020, "color": "Синий"}),
+    ("add_equipment_bulk", (1, [{"name": "МТЗ 82", "model": "82", "vin": "X9F00000000000002"}]), {}),
+    ("get_equipment_by_driver", (1002,), {}),
+    ("save_document_analysis", ({"equipment_id": 1, "document_type": "СТС", "analysis_data": {}},), {}),
+    ("get_document_analysis", (1,), {}),
+    ("get_analysis_fields", (1, ("vin", "brand")), {}),
+    ("purge_unattached_analyses", (86400,), {}),
+    ("save_cached_analysis", ("СТС:abc", "СТС", {"success": True}), {}),
+    ("get_cached_analysis", ("СТС:abc", 3600), {}),
+    ("evict_analysis_cache", (3600, 100), {}),
+    ("save_fingerprint", (1, "СТС", "00ff00ff00ff00ff", {"success": True}), {}),
+    ("get_recent_fingerprints", (30,), {}),
+    ("get_fingerprint_analysis", (1,), {}),
+    ("enqueue_analysis_job", ("file-1", "unique-1", "СТС", 1001, 1001), {}),
+    ("enqueue_analysis_job", ("file-1", "unique-1", "СТС", 1001, 1001), {}),
+    ("claim_analysis_job", (), {}),
+    ("retry_analysis_job", (1, "ошибка", 0), {}),
+    ("finish_analysis_job", (1, "done"), {"result": {"success": True}}),
+    ("requeue_running_analysis_jobs", (), {}),
+    ("purge_analysis_jobs", (86400,), {}),
+    ("get_analysis_queue_stats", (), {}),
+    ("start_shift", (1002, 1), {}),
+    ("get_active_shift", (1002,), {}),
+    ("add_maintenance", (1, "ТО-1", "2030-01-01"), {}),
+    ("get_stat_counters", (), {}),
+    ("get_stat_counters", (1,), {}),
+    ("get_maintenance_summary", (), {}),
+    ("get_maintenance_summary", (1,), {}),
+    ("save_fsm_state", ("1:1001:1001::default", "UserStates:waiting_for_document_photo"), {}),
+    ("save_fsm_data", ("1:1001:1001::default", b'{"document_type":"sts"}'), {}),
+    ("get_fsm_record", ("1:1001:1001::default",), {}),
+    ("purge_fsm_records", (86400,), {}),
+    ("delete_fsm_record", ("1:1001:1001::default",), {}),
+    ("get_due_notifications", (7, 20), {}),
+    ("mark_notifications_sent", ([{"kind": "fuel", "equipment_id": 1, "period": "2030-01-01", "chat_id": 1001}],), {}),
+    ("purge_notification_log", (90,), {}),
+    ("log_action", (1001, "проверка"), {"details": {"equipment_id": 1}}),
+    ("flush_action_logs", (), {}),
+]
+
+# Служебные методы без собственных запросов к данным
+SKIP_METHODS = {"connect", "close", "create_tables"}
+
+# "--" - строки трассировки срабатывания триггеров
+SKIP_STATEMENTS = ("PRAGMA", "BEGIN", "COMMIT", "ROLLBACK", "CREATE", "SAVEPOINT", "RELEASE", "--")
+
+# SQLite до 3.36 пишет "SCAN TABLE users", новые версии - "SCAN users"
+FULL_SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$")
+
+def find_full_scans(db_path: str, statements: List[str]) -> List[str]:
+    """Возвращает описания полных сканирований таблиц в планах запросов"""
+    problems = []
+    conn = sqlite3.connect(db_path)
+    try:
+        for sql in statements:
+            for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}"):
+                detail = row[3]
+                if FULL_SCAN.match(detail):
+                    problems.append(f"{detail}: {' '.join(sql.split())[:120]}")
+    finally:
+        conn.close()
+    return problems
+
+async def collect_statements(db_path: str) -> Dict[str, List[str]]:
+    """Выполняет примеры вызовов и собирает SQL каждого метода"""
+    db = Database(db_path)
+    if not await db.connect():
+        raise RuntimeError("не удалось подключиться к временной базе")
+
+    statements: Dict[str, List[str]] = {}
+    current = {"method": None}
+
+    def trace(sql: str):
+        if current["method"] and not sql.lstrip().upper().startswith(SKIP_STATEMENTS):
+            statements.setdefault(current["method"], []).append(sql)
+
+    for conn in [db.conn] + db.readers:
+        await conn.set_trace_callback(trace)
+
+    try:
+        for method, args, kwargs in CALLS:
+            # Кэш пользователей скрыл бы запрос get_user
+            db._user_cache.clear()
+            current["method"] = method
+            result = getattr(db, method)(*args, **kwargs)
+            if inspect.isawaitable(result):
+                await result
+        current["method"] = None
+    finally:
+        await db.close()
+
+    return statements
+
+def public_methods() -> List[str]:
+    """Публичные асинхронные методы Database, которые нужно проверить"""
+    return [
+        name for name, member in inspect.getmembers(Database, inspect.iscoroutinefunction)
+        if not name.startswith("_") and name not in SKIP_METHODS
+    ]
+
+def main() -> int:
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "plans.db")
+        statements = asyncio.run(collect_statements(db_path))
+
+        failed = False
+        covered = {method for method, _, _ in CALLS}
+        for method in public_methods():
+            if method not in covered:
+                print(f"❌ {method}: нет примера вызова в CALLS")
+                failed = True
+                continue
+
+            problems = find_full_scans(db_path, statements.get(method, []))
+            if problems:
+                failed = True
+                print(f"❌ {method}")
+                for problem in problems:
+                    print(f"    {problem}")
+            else:
+                print(f"✅ {method} ({len(statements.get(method, []))} запр.)")
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,130 +1,421 @@
 import json
 import base64
+import binascii
+import http.client
 import io
 import logging
-from PIL import Image
+import os
+import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import unquote, urlsplit
+from PIL import Image, ImageOps
+
+# Общие с ботом правила очистки полей и оценки качества; extraction.py
+# упаковывается в архив функции вместе с этим файлом
+from extraction import build_analysis_result, find_json_object, parse_document_text
 
 # Настройка логирования
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Форматы тела запроса, которые понимает функция (batch - список изображений в одном запросе)
+SUPPORTED_UPLOAD_FORMATS = "json, multipart, octet-stream, batch"
+
+# Максимальное количество изображений в пакетном запросе
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', 20))
+# Сколько изображений пакета обрабатывается параллельно
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', 4))
+
+# ========== НАСТРОЙКИ ПАЙПЛАЙНА ==========
+# Ключ API используется, если к функции не привязан сервисный аккаунт
+API_KEY = os.getenv('API_KEY', os.getenv('YANDEX_API_KEY', ''))
+FOLDER_ID = os.getenv('FOLDER_ID', os.getenv('YC_FOLDER_ID', ''))
+# Адреса переопределяются для локальной проверки с заглушкой API
+VISION_URL = os.getenv('VISION_URL', 'https://vision.api.cloud.yandex.net/vision/v1/batchAnalyze')
+LLM_URL = os.getenv('LLM_URL', 'https://llm.api.cloud.yandex.net/foundationModels/v1/completion')
+LLM_MODEL = os.getenv('LLM_MODEL', 'yandexgpt-lite')
+# Без языковой модели поля ищутся в распознанном тексте регулярными выражениями
+LLM_ENABLED = os.getenv('LLM_ENABLED', 'True').lower() == 'true'
+REQUEST_TIMEOUT = float(os.getenv('REQUEST_TIMEOUT', 20))
+IMAGE_MAX_SIDE = int(os.getenv('IMAGE_MAX_SIDE', 1600))
+
+class UpstreamError(RuntimeError):
+    """API распознавания или языковой модели не ответил или ответил ошибкой"""
+
+class ApiClient:
+    """
+    HTTP-клиент к API распознавания и языковой модели
+    
+    Создается один раз при загрузке модуля, поэтому теплые вызовы функции
+    переиспользуют открытые соединения. У каждого потока свои соединения:
+    http.client не рассчитан на параллельные запросы через одно соединение.
+    """
+    
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._ssl = ssl.create_default_context()
+        self._local = threading.local()
+    
+    def _connection(self, scheme, netloc):
+        connections = self._local.__dict__.setdefault('connections', {})
+        connection = connections.get((scheme, netloc))
+        if connection is None:
+            if scheme == 'https':
+                connection = http.client.HTTPSConnection(netloc, timeout=self.timeout, context=self._ssl)
+            else:
+                connection = http.client.HTTPConnection(netloc, timeout=self.timeout)
+            connections[(scheme, netloc)] = connection
+        return connection
+    
+    def post_json(self, url, payload, headers=None):
+        """
+        Отправляет JSON и возвращает разобранный JSON ответа
+        
+        Если сервер успел закрыть простаивавшее соединение, запрос один раз
+        повторяется на новом. Выбрасывает UpstreamError при ошибке.
+        """
+        parts = urlsplit(url)
+        path = parts.path + (f'?{parts.query}' if parts.query else '')
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        request_headers = {'Content-Type': 'application/json', **(headers or {})}
+        
+        for attempt in range(2):
+            connection = self._connection(parts.scheme, parts.netloc)
+            try:
+                connection.request('POST', path, body=body, headers=request_headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, ConnectionError) as e:
+                connection.close()
+                if attempt:
+                    raise UpstreamError(f'{parts.netloc}: {e}')
+                continue
+            except OSError as e:
+                connection.close()
+                raise UpstreamError(f'{parts.netloc}: {e}')
+            
+            if response.status != 200:
+                raise UpstreamError(f'{parts.netloc} ответил {response.status}: {data[:200].decode("utf-8", "replace")}')
+            try:
+                return json.loads(data)
+            except ValueError:
+                raise UpstreamError(f'{parts.netloc} вернул не JSON')
+
+# Клиент и пул потоков живут между вызовами функции в одном экземпляре
+api_client = ApiClient(REQUEST_TIMEOUT)
+_batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix='batch')
+
+def _get_header(event, name):
+    """Возвращает заголовок запроса без учета регистра"""
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name.lower():
+            return value
+    return None
+
+def _raw_body(event):
+    """Возвращает тело запроса в байтах"""
+    body = event['body']
+    if event.get('isBase64Encoded'):
+        return base64.b64decode(body)
+    return body.encode('utf-8') if isinstance(body, str) else body
+
+def _parse_multipart(body, content_type):
+    """Разбирает multipart/form-data на словарь имя -> байты"""
+    message = BytesParser(policy=HTTP).parsebytes(
+        b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + body
+    )
+    parts = {}
+    for part in message.iter_parts():
+        name = part.get_param('name', header='content-disposition')
+        if name:
+            parts[name] = part.get_payload(decode=True) or b''
+    return parts
+
+def _decode_base64_image(image_base64):
+    """Декодирует изображение из base64, пустая строка дает пустые байты"""
+    return base64.b64decode(image_base64) if image_base64 else b''
+
+def _read_request(event):
+    """
+    Извлекает промпт и список изображений из запроса
+    
+    Поддерживаются три формата тела:
+    - application/json: image в base64, prompt, document_type
+    - multipart/form-data: часть meta (JSON с prompt и document_type) и часть image
+    - application/octet-stream: изображение целиком, prompt и тип в заголовках
+      X-Prompt и X-Document-Type (URL-кодирование)
+    
+    Пакетный запрос передает в JSON (или в meta) список items:
+    [{"image": base64, "document_type": ...}] для JSON и
+    [{"part": имя части, "document_type": ...}] для multipart.
+    
+    Возвращает (prompt, items, is_batch), где item - словарь с image (байты),
+    document_type и, при ошибке декодирования, error.
+    """
+    content_type = _get_header(event, 'Content-Type') or 'application/json'
+    mime_type = content_type.split(';')[0].strip().lower()
+    
+    if mime_type == 'multipart/form-data':
+        parts = _parse_multipart(_raw_body(event), content_type)
+        meta = json.loads(parts.get('meta') or b'{}')
+        if 'items' in meta:
+            items = [
+                {'image': parts.get(item.get('part'), b''), 'document_type': item.get('document_type', 'СТС')}
+                for item in meta['items']
+            ]
+            return meta.get('prompt', ''), items, True
+        item = {'image': parts.get('image', b''), 'document_type': meta.get('document_type', 'СТС')}
+        return meta.get('prompt', ''), [item], False
+    
+    if mime_type == 'application/octet-stream':
+        prompt = unquote(_get_header(event, 'X-Prompt') or '')
+        document_type = unquote(_get_header(event, 'X-Document-Type') or 'СТС')
+        return prompt, [{'image': _raw_body(event), 'document_type': document_type}], False
+    
+    if mime_type != 'application/json':
+        raise TypeError(f'Неподдерживаемый формат: {mime_type}')
+    
+    body = json.loads(event['body'])
+    
+    if 'items' in body:
+        items = []
+        for item in body['items']:
+            document_type = item.get('document_type', 'СТС')
+            try:
+                items.append({'image': _decode_base64_image(item.get('image', '')), 'document_type': document_type})
+            except binascii.Error as e:
+                items.append({'image': b'', 'document_type': document_type,
+                              'error': f'Ошибка обработки изображения: {str(e)}'})
+        return body.get('prompt', ''), items, True
+    
+    item = {'image': _decode_base64_image(body.get('image', '')), 'document_type': body.get('document_type', 'СТС')}
+    return body.get('prompt', ''), [item], False
+
+def _response(status_code, payload):
+    """Формирует ответ функции"""
+    return {
+        'statusCode': status_code,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*',
+            'X-Upload-Formats': SUPPORTED_UPLOAD_FORMATS
+        },
+        'body': json.dumps(payload)
+    }
+
+def _auth_headers(context):
+    """Заголовок авторизации: IAM-токен сервисного аккаунта функции или ключ API"""
+    token = getattr(context, 'token', None)
+    if isinstance(token, dict) and token.get('access_token'):
+        return {'Authorization': f"Bearer {token['access_token']}"}
+    if API_KEY:
+        return {'Authorization': f'Api-Key {API_KEY}'}
+    return {}
+
+def _normalize_image(image_data):
+    """
+    Поворачивает изображение по EXIF, ограничивает размер и пережимает в JPEG
+    
+    Выбрасывает ValueError, если изображение не удалось открыть.
+    """
+    try:
+        with Image.open(io.BytesIO(image_data)) as source:
+            image_info = {
+                'format': source.format,
+                'size': source.size,
+                'mode': source.mode,
+                'size_kb': len(image_data) / 1024
+            }
+            image = ImageOps.exif_transpose(source)
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            image.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+            output = io.BytesIO()
+            image.save(output, format='JPEG', quality=85)
+    except Exception as e:
+        logger.error(f"Ошибка обработки изображения: {e}")
+        raise ValueError(f'Ошибка обработки изображения: {str(e)}')
+    
+    logger.info(f"Изображение: {image_info}")
+    return output.getvalue(), image_info
+
+def _recognize_text(image_bytes, headers):
+    """Распознает текст изображения через Vision OCR"""
+    result = api_client.post_json(VISION_URL, {
+        'folderId': FOLDER_ID,
+        'analyzeSpecs': [{
+            'content': base64.b64encode(image_bytes).decode('utf-8'),
+            'features': [{
+                'type': 'TEXT_DETECTION',
+                'textDetectionConfig': {'languageCodes': ['ru', 'en']}
+            }]
+        }]
+    }, headers)
+    
+    lines = []
+    for result_item in result.get('results', []):
+        for analysis_result in result_item.get('results', []):
+            for page in analysis_result.get('textDetection', {}).get('pages', []):
+                for block in page.get('blocks', []):
+                    for line in block.get('lines', []):
+                        lines.append(' '.join(word.get('text', '') for word in line.get('words', [])))
+    return '\n'.join(lines).strip()
+
+def _structure_fields(text, prompt, headers):
+    """Просит языковую модель разложить распознанный текст по полям"""
+    result = api_client.post_json(LLM_URL, {
+        'modelUri': f'gpt://{FOLDER_ID}/{LLM_MODEL}/latest',
+        'completionOptions': {'stream': False, 'temperature': 0.1, 'maxTokens': '2000'},
+        'messages': [
+            {'role': 'system', 'text': prompt},
+            {'role': 'user', 'text': f'Текст документа, распознанный OCR:\n{text}'}
+        ]
+    }, headers)
+    alternatives = result.get('result', {}).get('alternatives') or [{}]
+    return find_json_object(alternatives[0].get('message', {}).get('text', ''))
+
+def _analyze_image(image_data, prompt, document_type, headers):
+    """
+    Анализирует одно изображение документа
+    
+    Этапы: нормализация изображения, OCR, разбор полей языковой моделью
+    (или регулярными выражениями, если модель отключена или не ответила)
+    и общая с ботом валидация. Время каждого этапа возвращается в
+    processing_time. Выбрасывает ValueError, если изображение не удалось
+    открыть или на нем нет текста, и UpstreamError, если OCR недоступен.
+    """
+    logger.info(f"Тип документа: {document_type}")
+    timings = {}
+    started = stage_started = time.perf_counter()
+    
+    def stage(name):
+        nonlocal stage_started
+        now = time.perf_counter()
+        timings[name] = round(now - stage_started, 3)
+        stage_started = now
+    
+    normalized, image_info = _normalize_image(image_data)
+    stage('normalize')
+    
+    text = _recognize_text(normalized, headers)
+    stage('ocr')
+    if not text:
+        raise ValueError('Текст на изображении не распознан')
+    
+    fields = None
+    if LLM_ENABLED:
+        try:
+            fields = _structure_fields(text, prompt, headers)
+        except UpstreamError as e:
+            logger.warning(f"Языковая модель недоступна, разбираю текст регулярными выражениями: {e}")
+        stage('llm')
+    fields_source = 'llm' if fields else 'regex'
+    if not fields:
+        fields = parse_document_text(text)
+    if not fields.get('extracted_text'):
+        fields['extracted_text'] = text
+    
+    result = build_analysis_result(fields, document_type)
+    stage('validate')
+    
+    timings['total'] = round(time.perf_counter() - started, 3)
+    result.update({
+        'fields_source': fields_source,
+        'image_info': image_info,
+        'processing_time': timings
+    })
+    logger.info(f"Документ обработан: {timings}")
+    return result
+
+def _analyze_item(index, item, prompt, headers):
+    """Результат одного элемента пакета; ошибка элемента не прерывает пакет"""
+    if item.get('error'):
+        return {'index': index, 'error': item['error']}
+    if not item['image']:
+        return {'index': index, 'error': 'Отсутствует изображение'}
+    try:
+        return {'index': index, 'result': _analyze_image(item['image'], prompt, item['document_type'], headers)}
+    except UpstreamError as e:
+        return {'index': index, 'error': f'Сервис распознавания недоступен: {str(e)}', 'upstream_error': True}
+    except Exception as e:
+        return {'index': index, 'error': str(e)}
+
+def _analyze_batch(items, prompt, headers):
+    """Анализирует пакет изображений параллельно в пуле потоков"""
+    return list(_batch_executor.map(
+        lambda pair: _analyze_item(pair[0], pair[1], prompt, headers), enumerate(items)
+    ))
+
 def handler(event, context):
     """
     Обработчик Cloud Function для анализа документов СТС/ПТС
     
-    Ожидает JSON с полями:
-    - image: base64 изображения
-    - prompt: промпт для анализа
-    - document_type: тип документа
+    Ожидает изображение (или пакет изображений), промпт и тип документа
+    в одном из форматов, описанных в _read_request. JSON с base64 остается
+    форматом по умолчанию.
     
-    Возвращает JSON с результатами анализа
+    Возвращает JSON с результатом ({"result": ...}) или, для пакета,
+    со списком результатов ({"results": [{"index", "result" | "error"}]}).
+    Элементы, не обработанные из-за недоступности OCR, помечены
+    "upstream_error"; если так завершился весь пакет, код ответа 502.
     """
     try:
         logger.info("Начало обработки документа")
         
         # Получаем данные из запроса
         if 'body' not in event:
-            return {
-                'statusCode': 400,
-                'body': json.dumps({'error': 'Тело запроса отсутствует'})
-            }
+            return _response(400, {'error': 'Тело запроса отсутствует'})
         
-        body = json.loads(event['body'])
+        try:
+            prompt, items, is_batch = _read_request(event)
+        except TypeError as e:
+            return _response(415, {'error': str(e)})
+        except binascii.Error as e:
+            return _response(400, {'error': f'Ошибка обработки изображения: {str(e)}'})
         
-        image_base64 = body.get('image', '')
-        prompt = body.get('prompt', '')
-        document_type = body.get('document_type', 'СТС')
+        if is_batch:
+            if not prompt:
+                return _response(400, {'error': 'Отсутствует промпт'})
+            if not items:
+                return _response(400, {'error': 'Пустой пакет изображений'})
+            if len(items) > BATCH_MAX_ITEMS:
+                return _response(400, {'error': f'Слишком много изображений в пакете (максимум {BATCH_MAX_ITEMS})'})
+            
+            results = _analyze_batch(items, prompt, _auth_headers(context))
+            if all(result.get('upstream_error') for result in results):
+                logger.error("Ошибка распознавания: ни один элемент пакета не обработан")
+                return _response(502, {'error': 'Сервис распознавания недоступен', 'results': results})
+            logger.info(f"Пакет обработан: {len(results)} изображений")
+            return _response(200, {'results': results})
         
-        logger.info(f"Тип документа: {document_type}")
+        item = items[0]
         
-        if not image_base64:
-            return {
-                'statusCode': 400,
-                'body': json.dumps({'error': 'Отсутствует изображение'})
-            }
+        if not item['image']:
+            return _response(400, {'error': 'Отсутствует изображение'})
         
         if not prompt:
-            return {
-                'statusCode': 400,
-                'body': json.dumps({'error': 'Отсутствует промпт'})
-            }
+            return _response(400, {'error': 'Отсутствует промпт'})
         
-        # Декодируем изображение
         try:
-            image_data = base64.b64decode(image_base64)
-            image = Image.open(io.BytesIO(image_data))
-            
-            # Получаем информацию об изображении
-            image_info = {
-                'format': image.format,
-                'size': image.size,
-                'mode': image.mode,
-                'size_kb': len(image_data) / 1024
-            }
-            
-            logger.info(f"Изображение: {image_info}")
-            
-        except Exception as e:
-            logger.error(f"Ошибка обработки изображения: {e}")
-            return {
-                'statusCode': 400,
-                'body': json.dumps({'error': f'Ошибка обработки изображения: {str(e)}'})
-            }
-        
-        # Здесь должна быть интеграция с ИИ-моделью для анализа документа
-        # В реальной реализации здесь будет вызов:
-        # 1. Vision API для распознавания текста
-        # 2. GPT для структурирования данных
-        # 3. Валидация и очистка результатов
-        
-        # Временный ответ для тестирования
-        result = {
-            'document_type': document_type,
-            'vin': 'X9F12345678901234',
-            'registration_number': 'А123ВС77',
-            'model': 'Камаз-6520',
-            'brand': 'Камаз',
-            'year': 2022,
-            'category': 'Грузовой автомобиль',
-            'engine_power': 400,
-            'engine_volume': 11900,
-            'color': 'Красный',
-            'weight': 12000,
-            'max_weight': 25000,
-            'owner': 'ООО "Грузоперевозки"',
-            'passport_number': '77НН123456',
-            'registration_date': '15.05.2022',
-            'engine_number': '1234567890',
-            'chassis_number': 'CH12345678901234',
-            'body_number': 'BD12345678901234',
-            'environmental_class': 'Евро-5',
-            'extracted_text': 'СТС 77НН123456\nVIN: X9F12345678901234\nМарка: Камаз\nМодель: 6520\nГод выпуска: 2022\nЦвет: Красный\nМощность: 400 л.с.',
-            'image_info': image_info,
-            'processing_time': 0.5,
-            'success': True
-        }
+            result = _analyze_image(item['image'], prompt, item['document_type'], _auth_headers(context))
+        except ValueError as e:
+            return _response(400, {'error': str(e)})
+        except UpstreamError as e:
+            logger.error(f"Ошибка распознавания: {e}")
+            return _response(502, {'error': f'Сервис распознавания недоступен: {str(e)}'})
         
         logger.info("Анализ завершен успешно")
         
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'result': result})
-        }
+        return _response(200, {'result': result})
         
     except json.JSONDecodeError as e:
         logger.error(f"Ошибка JSON: {e}")
-        return {
-            'statusCode': 400,
-            'body': json.dumps({'error': 'Неверный формат JSON'})
-        }
+        return _response(400, {'error': 'Неверный формат JSON'})
         
     except Exception as e:
         logger.error(f"Неожиданная ошибка: {e}")
-        return {
-            'statusCode': 500,
-            'body': json.dumps({'error': f'Внутренняя ошибка: {str(e)}'})
-        }
+        return _response(500, {'error': f'Внутренняя ошибка: {str(e)}'})
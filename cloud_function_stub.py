@@ -0,0 +1,107 @@
+"""
+Заглушка API распознавания и языковой модели для локальной проверки функции
+
+Отвечает на POST /vision в формате Vision batchAnalyze (распознанный
+текст задается строками) и на POST /llm в формате completion (текст
+ответа модели или код ошибки). Считает запросы и новые соединения,
+чтобы было видно переиспользование соединений между вызовами.
+
+Запуск: python cloud_function_stub.py [порт], затем задать функции
+VISION_URL=http://127.0.0.1:<порт>/vision и LLM_URL=http://127.0.0.1:<порт>/llm
+"""
+import json
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SAMPLE_TEXT = (
+    "СВИДЕТЕЛЬСТВО О РЕГИСТРАЦИИ ТРАНСПОРТНОГО СРЕДСТВА\n"
+    "Регистрационный знак А123ВС77\n"
+    "Идентификационный номер (VIN) X9F65200090012345\n"
+    "Марка: КАМАЗ\n"
+    "Модель: 6520-43\n"
+    "Год выпуска ТС 2019"
+)
+
+SAMPLE_FIELDS = {
+    "vin": "X9F65200090012345", "registration_number": "А123ВС77",
+    "brand": "КАМАЗ", "model": "6520-43", "year": "2019", "category": "C",
+    "engine_power": "400 л.с.", "color": "оранжевый",
+}
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.stats["connections"] += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        stub = self.server
+        stub.stats["requests"] += 1
+        stub.requests.append((self.path, json.loads(body or b"{}")))
+
+        if self.path == "/vision":
+            status, payload = stub.vision_status, {"results": [{"results": [{"textDetection": {"pages": [{
+                "blocks": [{"lines": [{"words": [{"text": word} for word in line.split()]}]}
+                           for line in stub.text.splitlines()]
+            }]}}]}]}
+        elif self.path == "/llm":
+            status, payload = stub.llm_status, {"result": {"alternatives": [{
+                "message": {"role": "assistant", "text": f"```json\n{json.dumps(stub.fields, ensure_ascii=False)}\n```"}
+            }]}}
+        else:
+            status, payload = 404, {"error": "not found"}
+
+        data = json.dumps(payload if status == 200 else {"error": "stub"}, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+class StubApiServer(ThreadingHTTPServer):
+    """
+    HTTP-сервер заглушки в фоновом потоке
+
+    text - строки, которые "распознает" OCR; fields - JSON ответа модели;
+    vision_status и llm_status - код ответа (не 200 - ошибка сервиса).
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port: int = 0):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.text = SAMPLE_TEXT
+        self.fields = dict(SAMPLE_FIELDS)
+        self.vision_status = 200
+        self.llm_status = 200
+        self.requests = []
+        self.stats = {"requests": 0, "connections": 0}
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self) -> "StubApiServer":
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+if __name__ == "__main__":
+    server = StubApiServer(int(sys.argv[1]) if len(sys.argv) > 1 else 8090)
+    print(f"VISION_URL={server.url}/vision")
+    print(f"LLM_URL={server.url}/llm")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -6,28 +6,197 @@ from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Any, Tuple
 import json
 import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+from analysis_codec import PROMOTED_FIELDS, analysis_columns, decode_missing_fields, restore_analysis
+from migrations import run_migrations
 
 logger = logging.getLogger(__name__)
 
+# Состояние текущей транзакции; вложенные вызовы присоединяются к ней
+_transaction: ContextVar[Optional[Dict[str, Any]]] = ContextVar('db_transaction', default=None)
+
+# Колонки, которые можно передавать при добавлении и изменении записей
+EQUIPMENT_COLUMNS = (
+    'name', 'model', 'vin', 'registration_number', 'status', 'next_maintenance',
+    'last_maintenance', 'fuel_type', 'fuel_capacity', 'current_fuel_level', 'odometer',
+    'year', 'color', 'engine_power', 'weight', 'max_weight', 'category', 'notes'
+)
+# Поля анализа, которые заполняются при привязке черновика к технике
+ANALYSIS_ATTACH_COLUMNS = ('motohours', 'last_service', 'registration_date')
+MAINTENANCE_COLUMNS = (
+    'type', 'scheduled_date', 'completed_date', 'description', 'status', 'cost',
+    'performed_by', 'parts_used', 'odometer_at_service', 'next_service_km'
+)
+
+class TransactionAborted(Exception):
+    """Операция внутри транзакции завершилась ошибкой, изменения откачены"""
+
 class Database:
     def __init__(self, db_path=None):
         self.db_path = db_path or os.getenv('DATABASE_PATH', 'techcontrol.db')
+        # Соединение для записи; в режиме пула чтения идут через self.readers
         self.conn = None
+        self.readers: List[aiosqlite.Connection] = []
+        self._next_reader = 0
+        self.pool_readers = int(os.getenv('DB_POOL_READERS', 2))
+        self.cache_size_kb = int(os.getenv('DB_CACHE_SIZE_KB', 8192))
+        self.mmap_size = int(os.getenv('DB_MMAP_SIZE', 64 * 1024 * 1024))
+        self.busy_timeout = int(os.getenv('DB_BUSY_TIMEOUT_MS', 5000))
+        # Все записи идут через одно соединение, поэтому транзакции сериализуются
+        self._write_lock = asyncio.Lock()
+        # Журнал действий пишется пакетами фоновой задачей
+        self.log_flush_interval = float(os.getenv('DB_LOG_FLUSH_INTERVAL', 1.0))
+        self.log_flush_size = int(os.getenv('DB_LOG_FLUSH_SIZE', 100))
+        self._pending_logs: List[Tuple] = []
+        self._log_event = asyncio.Event()
+        self._log_flusher = None
+        self._log_stopping = False
+        # Кэш записей пользователей: почти каждое сообщение начинается с get_user
+        self.user_cache_size = int(os.getenv('USER_CACHE_SIZE', 1024))
+        self.user_cache_ttl = float(os.getenv('USER_CACHE_TTL', 300))
+        self._user_cache: "OrderedDict[int, tuple]" = OrderedDict()
+        self._user_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+        # Счетчик инвалидаций по пользователю: чтение, во время которого запись
+        # изменили, не должно положить в кэш старую строку. Счетчик нужен
+        # только на время чтения, поэтому хранятся последние user_cache_size
+        self._user_generations: "OrderedDict[int, int]" = OrderedDict()
         
     async def connect(self):
         """Устанавливает соединение с базой данных"""
         try:
-            self.conn = await aiosqlite.connect(self.db_path)
-            self.conn.row_factory = aiosqlite.Row
+            self.conn = await self._open_connection()
             await self.create_tables()
-            logger.info("✅ База данных подключена")
+            await run_migrations(self.conn)
+            
+            self._log_flusher = asyncio.create_task(self._flush_action_logs_loop())
+            
+            # База в памяти у каждого соединения своя, поэтому пул только для файла
+            if self.pool_readers > 0 and self.db_path != ':memory:':
+                for _ in range(self.pool_readers):
+                    self.readers.append(await self._open_connection(read_only=True))
+                logger.info(f"✅ База данных подключена (WAL, читателей: {len(self.readers)})")
+            else:
+                logger.info("✅ База данных подключена")
             return True
         except Exception as e:
             logger.error(f"❌ Ошибка подключения к БД: {e}")
             return False
+    
+    async def _open_connection(self, read_only: bool = False) -> aiosqlite.Connection:
+        """Открывает соединение и настраивает его прагмы"""
+        conn = await aiosqlite.connect(self.db_path)
+        conn.row_factory = aiosqlite.Row
+        
+        if self.pool_readers > 0 and not read_only:
+            # WAL позволяет читателям работать параллельно с записью
+            await conn.execute("PRAGMA journal_mode = WAL")
+        await conn.execute("PRAGMA synchronous = NORMAL")
+        await conn.execute(f"PRAGMA cache_size = -{self.cache_size_kb}")
+        await conn.execute(f"PRAGMA mmap_size = {self.mmap_size}")
+        await conn.execute("PRAGMA temp_store = MEMORY")
+        await conn.execute(f"PRAGMA busy_timeout = {self.busy_timeout}")
+        if read_only:
+            await conn.execute("PRAGMA query_only = ON")
+        return conn
+    
+    @property
+    def reader(self) -> aiosqlite.Connection:
+        """Соединение для чтения: читатели пула по кругу или основное соединение"""
+        # Внутри транзакции читаем через писателя, чтобы видеть свои изменения
+        if not self.readers or _transaction.get() is not None:
+            return self.conn
+        self._next_reader = (self._next_reader + 1) % len(self.readers)
+        return self.readers[self._next_reader]
             
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Единица работы: все записи внутри блока фиксируются одним commit
+        
+        Методы Database, вызванные внутри блока, присоединяются к нему.
+        Если любой из них завершился ошибкой, все изменения откатываются
+        и блок завершается исключением TransactionAborted.
+        """
+        state = _transaction.get()
+        if state is not None:
+            try:
+                yield
+            except BaseException:
+                state["failed"] = True
+                raise
+            return
+        
+        async with self._write_lock:
+            state = {"failed": False}
+            token = _transaction.set(state)
+            try:
+                await self.conn.execute("BEGIN IMMEDIATE")
+                try:
+                    yield
+                except BaseException:
+                    await self.conn.rollback()
+                    raise
+                if state["failed"]:
+                    await self.conn.rollback()
+                    raise TransactionAborted("операция внутри транзакции завершилась ошибкой")
+                await self.conn.commit()
+            finally:
+                _transaction.reset(token)
+    
+    # ========== ЖУРНАЛ ДЕЙСТВИЙ ==========
+    
+    def log_action(self, user_id: int, action_type: str, details: Any = None):
+        """Добавляет запись в журнал действий; в базу записи попадают пакетами"""
+        if details is not None and not isinstance(details, str):
+            details = json.dumps(details, ensure_ascii=False)
+        created_at = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        self._pending_logs.append((user_id, action_type, details, created_at))
+        if len(self._pending_logs) >= self.log_flush_size:
+            self._log_event.set()
+    
+    async def flush_action_logs(self) -> int:
+        """Записывает накопленный журнал действий одной транзакцией"""
+        if not self._pending_logs:
+            return 0
+        
+        logs, self._pending_logs = self._pending_logs, []
+        try:
+            async with self.transaction():
+                await self.conn.executemany(
+                    "INSERT INTO action_logs (user_id, action_type, details, created_at) VALUES (?, ?, ?, ?)",
+                    logs
+                )
+            return len(logs)
+        except Exception as e:
+            logger.error(f"Ошибка записи журнала действий ({len(logs)} записей): {e}")
+            return 0
+    
+    async def _flush_action_logs_loop(self):
+        while not self._log_stopping:
+            try:
+                await asyncio.wait_for(self._log_event.wait(), timeout=self.log_flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._log_event.clear()
+            await self.flush_action_logs()
+    
     async def close(self):
-        """Закрывает соединение с базой данных"""
+        """Закрывает соединения с базой данных"""
+        if self._log_flusher:
+            # Даем фоновой задаче дописать текущий пакет, а не прерываем ее
+            self._log_stopping = True
+            self._log_event.set()
+            await self._log_flusher
+            self._log_flusher = None
+        if self.conn:
+            await self.flush_action_logs()
+        for reader in self.readers:
+            await reader.close()
+        self.readers = []
         if self.conn:
             await self.conn.close()
             logger.info("🔌 Соединение с БД закрыто")
@@ -108,6 +277,57 @@ class Database:
                 )
             ''')
             
+            # Кэш результатов анализа документов по хэшу изображения
+            await self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS analysis_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    document_type TEXT NOT NULL,
+                    result TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_access TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # Перцептивные хэши проанализированных документов
+            await self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS document_fingerprints (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    organization_id INTEGER NOT NULL,
+                    document_type TEXT NOT NULL,
+                    phash TEXT NOT NULL,
+                    analysis_data TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (organization_id) REFERENCES organizations(id)
+                )
+            ''')
+            
+            # Очередь задач анализа фото документов
+            await self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS analysis_jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    file_id TEXT NOT NULL,
+                    file_unique_id TEXT NOT NULL,
+                    document_type TEXT NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    chat_id INTEGER NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT,
+                    result TEXT,
+                    enqueued_at REAL NOT NULL,
+                    next_run_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    FOREIGN KEY (user_id) REFERENCES users(telegram_id)
+                )
+            ''')
+            # Одно и то же фото от одного пользователя не может стоять в очереди
+            # дважды; то же фото, пересланное другим, - отдельная задача со своим ответом
+            await self.conn.execute('''
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_analysis_jobs_active_request
+                ON analysis_jobs (file_unique_id, chat_id, user_id) WHERE status IN ('queued', 'running')
+            ''')
+            
             # Таблица смен
             await self.conn.execute('''
                 CREATE TABLE IF NOT EXISTS shifts (
@@ -217,27 +437,64 @@ class Database:
     # ========== БАЗОВЫЕ МЕТОДЫ ==========
     
     async def get_user(self, telegram_id: int) -> Optional[Dict]:
-        """Получает пользователя по Telegram ID"""
+        """Получает пользователя по Telegram ID (через кэш)"""
+        entry = self._user_cache.get(telegram_id)
+        if entry:
+            expires_at, user = entry
+            if expires_at > time.monotonic():
+                self._user_cache.move_to_end(telegram_id)
+                self._user_cache_stats["hits"] += 1
+                return dict(user)
+            del self._user_cache[telegram_id]
+        
+        self._user_cache_stats["misses"] += 1
+        generation = self._user_generations.get(telegram_id, 0)
         try:
-            cursor = await self.conn.execute(
+            cursor = await self.reader.execute(
                 "SELECT * FROM users WHERE telegram_id = ?", 
                 (telegram_id,)
             )
             row = await cursor.fetchone()
             await cursor.close()
-            return dict(row) if row else None
         except Exception as e:
             logger.error(f"Ошибка получения пользователя {telegram_id}: {e}")
             return None
+        
+        if not row:
+            return None
+        
+        user = dict(row)
+        if self._user_generations.get(telegram_id, 0) != generation:
+            # Запись изменили во время чтения: ответ отдаем, но не кэшируем
+            return dict(user)
+        self._user_cache[telegram_id] = (time.monotonic() + self.user_cache_ttl, user)
+        self._user_cache.move_to_end(telegram_id)
+        while len(self._user_cache) > self.user_cache_size:
+            self._user_cache.popitem(last=False)
+        return dict(user)
+    
+    def invalidate_user(self, telegram_id: int):
+        """Удаляет пользователя из кэша после изменения его записи"""
+        self._user_generations[telegram_id] = self._user_generations.get(telegram_id, 0) + 1
+        self._user_generations.move_to_end(telegram_id)
+        while len(self._user_generations) > self.user_cache_size:
+            self._user_generations.popitem(last=False)
+        if self._user_cache.pop(telegram_id, None):
+            self._user_cache_stats["invalidations"] += 1
+    
+    def user_cache_stats(self) -> Dict[str, Any]:
+        """Возвращает статистику кэша пользователей"""
+        return {**self._user_cache_stats, "size": len(self._user_cache)}
     
     async def register_user(self, telegram_id: int, full_name: str, username: str = None, role: str = 'unassigned') -> bool:
         """Регистрирует нового пользователя"""
         try:
-            await self.conn.execute(
-                "INSERT OR IGNORE INTO users (telegram_id, full_name, username, role) VALUES (?, ?, ?, ?)",
-                (telegram_id, full_name, username, role)
-            )
-            await self.conn.commit()
+            async with self.transaction():
+                await self.conn.execute(
+                    "INSERT OR IGNORE INTO users (telegram_id, full_name, username, role) VALUES (?, ?, ?, ?)",
+                    (telegram_id, full_name, username, role)
+                )
+            self.invalidate_user(telegram_id)
             return True
         except Exception as e:
             logger.error(f"Ошибка регистрации пользователя {telegram_id}: {e}")
@@ -246,39 +503,109 @@ class Database:
     async def update_user_role(self, telegram_id: int, role: str, organization_id: int = None) -> bool:
         """Обновляет роль пользователя и организацию"""
         try:
-            if organization_id:
-                await self.conn.execute(
-                    "UPDATE users SET role = ?, organization_id = ? WHERE telegram_id = ?",
-                    (role, organization_id, telegram_id)
-                )
-            else:
-                await self.conn.execute(
-                    "UPDATE users SET role = ? WHERE telegram_id = ?",
-                    (role, telegram_id)
-                )
-            await self.conn.commit()
+            async with self.transaction():
+                if organization_id:
+                    await self.conn.execute(
+                        "UPDATE users SET role = ?, organization_id = ? WHERE telegram_id = ?",
+                        (role, organization_id, telegram_id)
+                    )
+                else:
+                    await self.conn.execute(
+                        "UPDATE users SET role = ? WHERE telegram_id = ?",
+                        (role, telegram_id)
+                    )
+            self.invalidate_user(telegram_id)
             return True
         except Exception as e:
             logger.error(f"Ошибка обновления роли {telegram_id}: {e}")
             return False
     
-    async def get_all_users_simple(self) -> List[Dict]:
-        """Получает всех пользователей (упрощенная версия)"""
+    @staticmethod
+    def _keyset_page(rows, limit: int, key: Optional[str], backward: bool, make_key) -> Dict:
+        """
+        Собирает страницу из limit + 1 строк, выбранных по курсору
+
+        Лишняя строка показывает, есть ли записи дальше в направлении
+        выборки; в обратную сторону записи есть, если был ключ.
+        """
+        more = len(rows) > limit
+        items = [dict(row) for row in rows[:limit]]
+        if backward:
+            items.reverse()
+        has_next = key is not None if backward else more
+        has_prev = more if backward else key is not None
+        return {
+            "items": items,
+            "next": make_key(items[-1]) if has_next and items else None,
+            "prev": make_key(items[0]) if has_prev and items else None,
+        }
+    
+    @staticmethod
+    def _parse_page_key(key: Optional[str]) -> Optional[Tuple[int, int]]:
+        """
+        Разбирает курсор страницы "время_id"
+        
+        Курсор приходит из callback-данных клиента, поэтому некорректное
+        значение (или ключ записи без created_at) дает первую страницу.
+        """
+        if not key:
+            return None
         try:
-            cursor = await self.conn.execute(
-                "SELECT telegram_id, full_name, role, organization_id FROM users ORDER BY created_at DESC"
+            created_ts, row_id = key.split('_')
+            return int(created_ts), int(row_id)
+        except ValueError:
+            logger.warning(f"Некорректный курсор страницы: {key!r}")
+            return None
+    
+    async def get_users_page(self, key: str = None, backward: bool = False, limit: int = 10,
+                             role: str = None, organization_id: int = None) -> Dict:
+        """
+        Получает страницу пользователей, новые сначала
+        
+        key - значение next/prev предыдущей страницы; backward - листать
+        к более новым записям. Каждая страница читается по индексу с
+        created_at, поэтому ее цена не зависит от числа пользователей.
+        """
+        conditions, params = [], []
+        if role:
+            conditions.append("role = ?")
+            params.append(role)
+        if organization_id:
+            conditions.append("organization_id = ?")
+            params.append(organization_id)
+        page_key = self._parse_page_key(key)
+        if page_key:
+            conditions.append(
+                f"(created_at, telegram_id) {'>' if backward else '<'} (datetime(?, 'unixepoch'), ?)"
+            )
+            params.extend(page_key)
+        else:
+            key, backward = None, False
+        
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        order = "ASC" if backward else "DESC"
+        try:
+            cursor = await self.reader.execute(
+                f"""SELECT telegram_id, full_name, role, organization_id,
+                           CAST(strftime('%s', created_at) AS INTEGER) AS created_ts
+                    FROM users {where}
+                    ORDER BY created_at {order}, telegram_id {order} LIMIT ?""",
+                (*params, limit + 1)
             )
             rows = await cursor.fetchall()
             await cursor.close()
-            return [dict(row) for row in rows]
+            return self._keyset_page(
+                rows, limit, key, backward,
+                lambda item: f"{item['created_ts']}_{item['telegram_id']}"
+            )
         except Exception as e:
-            logger.error(f"Ошибка получения пользователей: {e}")
-            return []
+            logger.error(f"Ошибка получения страницы пользователей: {e}")
+            return {"items": [], "next": None, "prev": None}
     
     async def get_users_by_organization(self, org_id: int) -> List[Dict]:
         """Получает пользователей организации"""
         try:
-            cursor = await self.conn.execute(
+            cursor = await self.reader.execute(
                 "SELECT * FROM users WHERE organization_id = ? ORDER BY role, full_name",
                 (org_id,)
             )
@@ -292,7 +619,7 @@ class Database:
     async def get_organization(self, org_id: int) -> Optional[Dict]:
         """Получает организацию по ID"""
         try:
-            cursor = await self.conn.execute(
+            cursor = await self.reader.execute(
                 "SELECT * FROM organizations WHERE id = ?", 
                 (org_id,)
             )
@@ -306,83 +633,183 @@ class Database:
     async def create_organization_for_director(self, director_id: int, org_name: str, address: str = None, contact_phone: str = None):
         """Создает организацию и назначает директора"""
         try:
-            user = await self.get_user(director_id)
-            if user and user.get('organization_id'):
-                return None, "У этого пользователя уже есть организация"
-            
-            cursor = await self.conn.execute(
-                "INSERT INTO organizations (name, director_id, address, contact_phone) VALUES (?, ?, ?, ?)",
-                (org_name, director_id, address, contact_phone)
-            )
-            org_id = cursor.lastrowid
-            
-            await self.conn.execute(
-                "UPDATE users SET organization_id = ?, role = 'director' WHERE telegram_id = ?",
-                (org_id, director_id)
-            )
-            
-            await self.conn.commit()
+            async with self.transaction():
+                user = await self.get_user(director_id)
+                if user and user.get('organization_id'):
+                    return None, "У этого пользователя уже есть организация"
+                
+                cursor = await self.conn.execute(
+                    "INSERT INTO organizations (name, director_id, address, contact_phone) VALUES (?, ?, ?, ?)",
+                    (org_name, director_id, address, contact_phone)
+                )
+                org_id = cursor.lastrowid
+                
+                await self.conn.execute(
+                    "UPDATE users SET organization_id = ?, role = 'director' WHERE telegram_id = ?",
+                    (org_id, director_id)
+                )
+            self.invalidate_user(director_id)
             return org_id, None
         except Exception as e:
             logger.error(f"Ошибка создания организации: {e}")
             return None, str(e)
     
-    async def get_all_organizations_simple(self) -> List[Dict]:
-        """Получает все организации (упрощенная версия)"""
+    async def get_organizations_page(self, key: str = None, backward: bool = False, limit: int = 10) -> Dict:
+        """Получает страницу организаций, новые сначала (см. get_users_page)"""
+        where, params = "", []
+        page_key = self._parse_page_key(key)
+        if page_key:
+            where = f"WHERE (created_at, id) {'>' if backward else '<'} (datetime(?, 'unixepoch'), ?)"
+            params.extend(page_key)
+        else:
+            key, backward = None, False
+        
+        order = "ASC" if backward else "DESC"
         try:
-            cursor = await self.conn.execute(
-                "SELECT id, name, director_id FROM organizations ORDER BY created_at DESC"
+            cursor = await self.reader.execute(
+                f"""SELECT id, name, director_id, CAST(strftime('%s', created_at) AS INTEGER) AS created_ts
+                    FROM organizations {where}
+                    ORDER BY created_at {order}, id {order} LIMIT ?""",
+                (*params, limit + 1)
             )
             rows = await cursor.fetchall()
             await cursor.close()
-            return [dict(row) for row in rows]
+            return self._keyset_page(
+                rows, limit, key, backward,
+                lambda item: f"{item['created_ts']}_{item['id']}"
+            )
         except Exception as e:
-            logger.error(f"Ошибка получения организаций: {e}")
-            return []
+            logger.error(f"Ошибка получения страницы организаций: {e}")
+            return {"items": [], "next": None, "prev": None}
     
     # ========== МЕТОДЫ ДЛЯ ТЕХНИКИ ==========
     
+    @staticmethod
+    def _whitelisted(record: Dict, allowed: Tuple[str, ...], table: str) -> Tuple[List[str], List]:
+        """Возвращает колонки и значения записи, проверяя имена по списку разрешенных"""
+        unknown = set(record) - set(allowed)
+        if unknown:
+            raise ValueError(f"Неизвестные поля {table}: {', '.join(sorted(unknown))}")
+        # Порядок колонок фиксирован, чтобы одинаковые наборы полей давали один запрос
+        columns = [column for column in allowed if record.get(column) is not None]
+        return columns, [record[column] for column in columns]
+    
+    async def _insert_equipment(self, org_id: int, record: Dict) -> Dict:
+        """Вставляет технику без фиксации транзакции и возвращает строку"""
+        columns, values = self._whitelisted(record, EQUIPMENT_COLUMNS, "equipment")
+        columns.append("organization_id")
+        values.append(org_id)
+        
+        cursor = await self.conn.execute(
+            f"INSERT INTO equipment ({', '.join(columns)}) "
+            f"VALUES ({', '.join('?' for _ in columns)}) RETURNING *",
+            values
+        )
+        row = await cursor.fetchone()
+        await cursor.close()
+        return dict(row)
+    
     async def add_equipment(self, name: str, model: str, vin: str, org_id: int, 
                           registration_number: str = None, fuel_type: str = 'diesel',
-                          fuel_capacity: float = None) -> Optional[int]:
-        """Добавляет новую технику"""
+                          fuel_capacity: float = None, analysis: Dict = None,
+                          maintenance: Dict = None, analysis_id: int = None, **fields) -> Optional[Dict]:
+        """
+        Добавляет технику одной транзакцией
+        
+        fields - остальные колонки equipment (odometer, year, color, engine_power...).
+        analysis_id - сохраненный ранее черновик анализа, который привязывается
+        к технике; тогда analysis - поля ANALYSIS_ATTACH_COLUMNS для него.
+        Без analysis_id analysis - новая строка в формате save_document_analysis.
+        maintenance - первая запись ТО (type, scheduled_date, description...).
+        Возвращает строку техники или None при ошибке.
+        """
+        record = dict(fields, name=name, model=model, vin=vin, registration_number=registration_number,
+                      fuel_type=fuel_type, fuel_capacity=fuel_capacity)
         try:
-            cursor = await self.conn.execute(
-                """INSERT INTO equipment 
-                (name, model, vin, organization_id, registration_number, fuel_type, fuel_capacity) 
-                VALUES (?, ?, ?, ?, ?, ?, ?)""",
-                (name, model, vin, org_id, registration_number, fuel_type, fuel_capacity)
-            )
-            await self.conn.commit()
-            return cursor.lastrowid
+            async with self.transaction():
+                equipment = await self._insert_equipment(org_id, record)
+                if analysis_id:
+                    await self._attach_document_analysis(analysis_id, equipment['id'], analysis or {})
+                elif analysis:
+                    await self._insert_document_analysis(dict(analysis, equipment_id=equipment['id']))
+                if maintenance:
+                    await self._insert_maintenance(equipment['id'], maintenance)
+            return equipment
         except Exception as e:
             logger.error(f"Ошибка добавления техники: {e}")
             return None
     
     async def update_equipment(self, eq_id: int, **kwargs) -> bool:
         """Обновляет данные техники"""
+        if not kwargs:
+            return False
+        
         try:
-            if not kwargs:
-                return False
+            unknown = set(kwargs) - set(EQUIPMENT_COLUMNS)
+            if unknown:
+                raise ValueError(f"Неизвестные поля equipment: {', '.join(sorted(unknown))}")
             
             set_clause = ', '.join([f"{key} = ?" for key in kwargs.keys()])
             values = list(kwargs.values())
             values.append(eq_id)
             
-            await self.conn.execute(
-                f"UPDATE equipment SET {set_clause} WHERE id = ?",
-                values
-            )
-            await self.conn.commit()
+            async with self.transaction():
+                await self.conn.execute(
+                    f"UPDATE equipment SET {set_clause} WHERE id = ?",
+                    values
+                )
             return True
         except Exception as e:
             logger.error(f"Ошибка обновления техники {eq_id}: {e}")
             return False
     
+    async def add_equipment_bulk(self, org_id: int, items: List[Dict]) -> Tuple[List[int], Optional[str]]:
+        """
+        Добавляет несколько единиц техники одной транзакцией
+        
+        Каждый элемент содержит поля техники (name, model, vin, registration_number,
+        year, color, engine_power, fuel_type, fuel_capacity) и, опционально,
+        analysis_id и analysis - как в add_equipment.
+        Либо сохраняется вся техника, либо ничего.
+        """
+        if not items:
+            return [], None
+        
+        try:
+            async with self.transaction():
+                vins = [item['vin'] for item in items]
+                placeholders = ', '.join('?' for _ in vins)
+                cursor = await self.conn.execute(
+                    f"SELECT vin FROM equipment WHERE vin IN ({placeholders})",
+                    vins
+                )
+                existing = [row['vin'] for row in await cursor.fetchall()]
+                await cursor.close()
+                if existing:
+                    return [], f"Техника с VIN уже зарегистрирована: {', '.join(existing)}"
+                
+                equipment_ids = []
+                for item in items:
+                    record = {key: value for key, value in item.items() if key in EQUIPMENT_COLUMNS}
+                    record.setdefault('fuel_type', 'diesel')
+                    equipment = await self._insert_equipment(org_id, record)
+                    equipment_ids.append(equipment['id'])
+                    
+                    if item.get('analysis_id'):
+                        await self._attach_document_analysis(
+                            item['analysis_id'], equipment['id'], item.get('analysis') or {}
+                        )
+                    elif item.get('analysis'):
+                        await self._insert_document_analysis(dict(item['analysis'], equipment_id=equipment['id']))
+            return equipment_ids, None
+        except Exception as e:
+            logger.error(f"Ошибка массового добавления техники: {e}")
+            return [], str(e)
+    
     async def get_equipment_by_driver(self, driver_id: int) -> List[Dict]:
         """Получает технику назначенную водителю"""
         try:
-            cursor = await self.conn.execute('''
+            cursor = await self.reader.execute('''
                 SELECT e.* FROM equipment e
                 JOIN driver_equipment de ON e.id = de.equipment_id
                 WHERE de.driver_id = ? AND e.status = 'active'
@@ -400,42 +827,87 @@ class Database:
     async def save_document_analysis(self, analysis_data: Dict) -> Optional[int]:
         """Сохраняет результат анализа документа"""
         try:
-            equipment_id = analysis_data.get("equipment_id")
-            document_type = analysis_data.get("document_type", "СТС")
-            
-            # Сериализуем данные анализа
-            analysis_json = json.dumps(analysis_data.get("analysis_data", {}), ensure_ascii=False)
-            
-            quality = analysis_data.get("analysis_quality")
-            quality_score = analysis_data.get("quality_score")
-            
-            # Сериализуем список отсутствующих полей
-            missing_fields = analysis_data.get("missing_fields", [])
-            missing_fields_json = json.dumps(missing_fields, ensure_ascii=False) if missing_fields else None
-            
-            motohours = analysis_data.get("motohours")
-            last_service = analysis_data.get("last_service")
-            registration_date = analysis_data.get("registration_date")
-            
-            cursor = await self.conn.execute(
-                """INSERT INTO document_analysis 
-                (equipment_id, document_type, analysis_data, analysis_quality, quality_score,
-                 missing_fields, motohours, last_service, registration_date) 
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                (equipment_id, document_type, analysis_json, quality, quality_score,
-                 missing_fields_json, motohours, last_service, registration_date)
-            )
-            
-            await self.conn.commit()
-            return cursor.lastrowid
+            async with self.transaction():
+                analysis_id = await self._insert_document_analysis(analysis_data)
+            return analysis_id
         except Exception as e:
             logger.error(f"Ошибка сохранения анализа документа: {e}")
             return None
     
+    async def _insert_document_analysis(self, analysis_data: Dict) -> int:
+        """Вставляет строку анализа документа без фиксации транзакции"""
+        # Частые поля идут в колонки, остальное - в сжатый blob (см. analysis_codec)
+        columns, blob = analysis_columns(analysis_data)
+        
+        cursor = await self.conn.execute(
+            """INSERT INTO document_analysis 
+            (equipment_id, document_type, analysis_data, analysis_quality, quality_score,
+             missing_fields, motohours, last_service, registration_date,
+             vin, registration_number, brand, model, year) 
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (analysis_data.get("equipment_id"), columns["document_type"], blob,
+             columns["analysis_quality"], columns["quality_score"], columns["missing_fields"],
+             analysis_data.get("motohours"), analysis_data.get("last_service"),
+             analysis_data.get("registration_date"), columns["vin"], columns["registration_number"],
+             columns["brand"], columns["model"], columns["year"])
+        )
+        return cursor.lastrowid
+    
+    async def _attach_document_analysis(self, analysis_id: int, equipment_id: int, updates: Dict):
+        """Привязывает черновик анализа к технике без фиксации транзакции"""
+        columns, values = self._whitelisted(updates, ANALYSIS_ATTACH_COLUMNS, 'document_analysis')
+        set_clause = ''.join(f", {column} = ?" for column in columns)
+        cursor = await self.conn.execute(
+            f"UPDATE document_analysis SET equipment_id = ?{set_clause} WHERE id = ? AND equipment_id IS NULL",
+            (equipment_id, *values, analysis_id)
+        )
+        if cursor.rowcount != 1:
+            raise ValueError(f"Черновик анализа {analysis_id} не найден или уже привязан")
+    
+    async def get_analysis_fields(self, analysis_id: int, fields: Tuple[str, ...]) -> Dict[str, Any]:
+        """
+        Получает отдельные поля результата анализа
+        
+        Частые поля читаются из колонок; blob распаковывается, только если
+        запрошено поле, которого в колонках нет. Шагам регистрации
+        достаточно хранить в FSM только id анализа.
+        """
+        if not analysis_id or not fields:
+            return {}
+        try:
+            cursor = await self.reader.execute(
+                f"""SELECT {', '.join(PROMOTED_FIELDS)}, document_type, analysis_quality, missing_fields,
+                    CASE WHEN ? THEN analysis_data END AS analysis_data
+                    FROM document_analysis WHERE id = ?""",
+                (not set(fields) <= set(PROMOTED_FIELDS), analysis_id)
+            )
+            row = await cursor.fetchone()
+            await cursor.close()
+            if not row:
+                return {}
+            data = restore_analysis(dict(row))
+            return {field: data.get(field) for field in fields}
+        except Exception as e:
+            logger.error(f"Ошибка получения полей анализа {analysis_id}: {e}")
+            return {}
+    
+    async def purge_unattached_analyses(self, max_age_seconds: int) -> int:
+        """Удаляет черновики анализа, которые так и не привязали к технике"""
+        try:
+            async with self.transaction():
+                cursor = await self.conn.execute(
+                    "DELETE FROM document_analysis WHERE equipment_id IS NULL AND created_at < datetime('now', ?)",
+                    (f"-{max_age_seconds} seconds",)
+                )
+                return cursor.rowcount
+        except Exception as e:
+            logger.error(f"Ошибка очистки черновиков анализа: {e}")
+            return 0
+    
     async def get_document_analysis(self, equipment_id: int) -> Optional[Dict]:
         """Получает анализ документа для техники"""
         try:
-            cursor = await self.conn.execute(
+            cursor = await self.reader.execute(
                 "SELECT * FROM document_analysis WHERE equipment_id = ? ORDER BY created_at DESC LIMIT 1",
                 (equipment_id,)
             )
@@ -444,29 +916,392 @@ class Database:
             
             if row:
                 data = dict(row)
-                # Парсим JSON данные
-                if data.get("analysis_data"):
-                    data["analysis_data"] = json.loads(data["analysis_data"])
-                if data.get("missing_fields"):
-                    data["missing_fields"] = json.loads(data["missing_fields"])
+                data["analysis_data"] = restore_analysis(data)
+                data["missing_fields"] = decode_missing_fields(data.get("missing_fields"))
                 return data
             return None
         except Exception as e:
             logger.error(f"Ошибка получения анализа документа: {e}")
             return None
     
+    # ========== КЭШ АНАЛИЗА ДОКУМЕНТОВ ==========
+    
+    async def get_cached_analysis(self, cache_key: str, ttl_seconds: int) -> Optional[Tuple[Dict, float]]:
+        """
+        Получает закэшированный результат анализа, если он не устарел
+        
+        Возвращает (результат, время записи в секундах Unix), чтобы кэш
+        в памяти истекал вместе с записью в базе, а не получал новый срок.
+        """
+        try:
+            cursor = await self.reader.execute(
+                """SELECT result, CAST(strftime('%s', created_at) AS REAL) AS created_ts
+                FROM analysis_cache 
+                WHERE cache_key = ? AND created_at >= datetime('now', ?)""",
+                (cache_key, f"-{ttl_seconds} seconds")
+            )
+            row = await cursor.fetchone()
+            await cursor.close()
+            
+            if not row:
+                return None
+            
+            async with self.transaction():
+                await self.conn.execute(
+                    "UPDATE analysis_cache SET last_access = CURRENT_TIMESTAMP WHERE cache_key = ?",
+                    (cache_key,)
+                )
+            return json.loads(row["result"]), row["created_ts"]
+        except Exception as e:
+            logger.error(f"Ошибка чтения кэша анализа: {e}")
+            return None
+    
+    async def save_cached_analysis(self, cache_key: str, document_type: str, result: Dict) -> bool:
+        """Сохраняет результат анализа в кэш"""
+        try:
+            async with self.transaction():
+                await self.conn.execute(
+                    """INSERT OR REPLACE INTO analysis_cache (cache_key, document_type, result) 
+                    VALUES (?, ?, ?)""",
+                    (cache_key, document_type, json.dumps(result, ensure_ascii=False))
+                )
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка записи кэша анализа: {e}")
+            return False
+    
+    async def evict_analysis_cache(self, ttl_seconds: int, max_entries: int) -> int:
+        """Удаляет устаревшие записи кэша и ограничивает его размер"""
+        try:
+            async with self.transaction():
+                cursor = await self.conn.execute(
+                    "DELETE FROM analysis_cache WHERE created_at < datetime('now', ?)",
+                    (f"-{ttl_seconds} seconds",)
+                )
+                removed = cursor.rowcount
+                
+                cursor = await self.conn.execute(
+                    """DELETE FROM analysis_cache WHERE cache_key IN (
+                        SELECT cache_key FROM analysis_cache 
+                        ORDER BY last_access DESC LIMIT -1 OFFSET ?
+                    )""",
+                    (max_entries,)
+                )
+                removed += cursor.rowcount
+            return removed
+        except Exception as e:
+            logger.error(f"Ошибка очистки кэша анализа: {e}")
+            return 0
+    
+    # ========== ПЕРЦЕПТИВНЫЕ ХЭШИ ДОКУМЕНТОВ ==========
+    
+    async def save_fingerprint(self, organization_id: int, document_type: str, 
+                               phash: str, analysis_data: Dict) -> Optional[int]:
+        """Сохраняет перцептивный хэш документа вместе с результатом анализа"""
+        try:
+            async with self.transaction():
+                cursor = await self.conn.execute(
+                    """INSERT INTO document_fingerprints (organization_id, document_type, phash, analysis_data) 
+                    VALUES (?, ?, ?, ?)""",
+                    (organization_id, document_type, phash, json.dumps(analysis_data, ensure_ascii=False))
+                )
+            return cursor.lastrowid
+        except Exception as e:
+            logger.error(f"Ошибка сохранения хэша документа: {e}")
+            return None
+    
+    async def get_recent_fingerprints(self, window_days: int) -> List[Dict]:
+        """Получает хэши документов за последние window_days дней"""
+        try:
+            cursor = await self.reader.execute(
+                """SELECT id, organization_id, document_type, phash,
+                       CAST(strftime('%s', created_at) AS REAL) AS created_ts
+                FROM document_fingerprints 
+                WHERE created_at >= datetime('now', ?)""",
+                (f"-{window_days} days",)
+            )
+            rows = await cursor.fetchall()
+            await cursor.close()
+            return [dict(row) for row in rows]
+        except Exception as e:
+            logger.error(f"Ошибка получения хэшей документов: {e}")
+            return []
+    
+    async def get_fingerprint_analysis(self, fingerprint_id: int) -> Optional[Dict]:
+        """Получает результат анализа, сохраненный вместе с хэшем"""
+        try:
+            cursor = await self.reader.execute(
+                "SELECT analysis_data FROM document_fingerprints WHERE id = ?",
+                (fingerprint_id,)
+            )
+            row = await cursor.fetchone()
+            await cursor.close()
+            return json.loads(row["analysis_data"]) if row else None
+        except Exception as e:
+            logger.error(f"Ошибка получения анализа по хэшу {fingerprint_id}: {e}")
+            return None
+    
+    # ========== ОЧЕРЕДЬ АНАЛИЗА ДОКУМЕНТОВ ==========
+    
+    async def enqueue_analysis_job(self, file_id: str, file_unique_id: str, document_type: str,
+                                   user_id: int, chat_id: int) -> Tuple[Optional[int], bool]:
+        """Добавляет задачу анализа; для фото, которое этот пользователь уже поставил в очередь, возвращает его задачу"""
+        try:
+            async with self.transaction():
+                now = time.time()
+                cursor = await self.conn.execute(
+                    """INSERT OR IGNORE INTO analysis_jobs 
+                    (file_id, file_unique_id, document_type, user_id, chat_id, enqueued_at, next_run_at) 
+                    VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                    (file_id, file_unique_id, document_type, user_id, chat_id, now, now)
+                )
+            if cursor.rowcount:
+                return cursor.lastrowid, True
+            
+            cursor = await self.conn.execute(
+                """SELECT id FROM analysis_jobs 
+                WHERE file_unique_id = ? AND chat_id = ? AND user_id = ? AND status IN ('queued', 'running')""",
+                (file_unique_id, chat_id, user_id)
+            )
+            row = await cursor.fetchone()
+            await cursor.close()
+            return (row["id"] if row else None), False
+        except Exception as e:
+            logger.error(f"Ошибка постановки задачи анализа: {e}")
+            return None, False
+    
+    async def claim_analysis_job(self) -> Optional[Dict]:
+        """Забирает следующую готовую к выполнению задачу и помечает ее как выполняемую"""
+        try:
+            async with self.transaction():
+                now = time.time()
+                cursor = await self.conn.execute(
+                    """UPDATE analysis_jobs 
+                    SET status = 'running', attempts = attempts + 1, started_at = ? 
+                    WHERE id = (
+                        SELECT id FROM analysis_jobs 
+                        WHERE status = 'queued' AND next_run_at <= ? 
+                        ORDER BY next_run_at, id LIMIT 1
+                    ) 
+                    RETURNING *""",
+                    (now, now)
+                )
+                row = await cursor.fetchone()
+                await cursor.close()
+            return dict(row) if row else None
+        except Exception as e:
+            logger.error(f"Ошибка получения задачи анализа: {e}")
+            return None
+    
+    async def retry_analysis_job(self, job_id: int, error: str, delay: float) -> bool:
+        """Возвращает задачу в очередь с паузой перед следующей попыткой"""
+        try:
+            async with self.transaction():
+                await self.conn.execute(
+                    """UPDATE analysis_jobs 
+                    SET status = 'queued', last_error = ?, next_run_at = ? 
+                    WHERE id = ?""",
+                    (error, time.time() + delay, job_id)
+                )
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка повтора задачи анализа {job_id}: {e}")
+            return False
+    
+    async def finish_analysis_job(self, job_id: int, status: str, result: Dict = None,
+                                  error: str = None) -> bool:
+        """Завершает задачу анализа со статусом done или failed"""
+        try:
+            async with self.transaction():
+                await self.conn.execute(
+                    """UPDATE analysis_jobs 
+                    SET status = ?, result = ?, last_error = COALESCE(?, last_error), finished_at = ? 
+                    WHERE id = ?""",
+                    (
+                        status,
+                        json.dumps(result, ensure_ascii=False) if result is not None else None,
+                        error,
+                        time.time(),
+                        job_id
+                    )
+                )
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка завершения задачи анализа {job_id}: {e}")
+            return False
+    
+    async def purge_analysis_jobs(self, max_age_seconds: int) -> int:
+        """Удаляет завершенные и проваленные задачи анализа старше max_age_seconds"""
+        try:
+            async with self.transaction():
+                cursor = await self.conn.execute(
+                    "DELETE FROM analysis_jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+                    (time.time() - max_age_seconds,)
+                )
+                return cursor.rowcount
+        except Exception as e:
+            logger.error(f"Ошибка очистки задач анализа: {e}")
+            return 0
+    
+    async def requeue_running_analysis_jobs(self) -> int:
+        """Возвращает в очередь задачи, прерванные остановкой бота"""
+        try:
+            async with self.transaction():
+                cursor = await self.conn.execute(
+                    "UPDATE analysis_jobs SET status = 'queued', next_run_at = ? WHERE status = 'running'",
+                    (time.time(),)
+                )
+            return cursor.rowcount
+        except Exception as e:
+            logger.error(f"Ошибка возобновления задач анализа: {e}")
+            return 0
+    
+    async def get_analysis_queue_stats(self) -> Dict:
+        """Получает глубину очереди анализа и возраст самой старой задачи"""
+        try:
+            cursor = await self.reader.execute(
+                """SELECT 
+                    COALESCE(SUM(status = 'queued'), 0) AS queued,
+                    COALESCE(SUM(status = 'running'), 0) AS running,
+                    MIN(CASE WHEN status = 'queued' THEN enqueued_at END) AS oldest
+                FROM analysis_jobs WHERE status IN ('queued', 'running')"""
+            )
+            row = await cursor.fetchone()
+            await cursor.close()
+            oldest = row["oldest"]
+            return {
+                "queued": row["queued"],
+                "running": row["running"],
+                "oldest_wait": round(time.time() - oldest, 1) if oldest else 0,
+            }
+        except Exception as e:
+            logger.error(f"Ошибка получения статистики очереди анализа: {e}")
+            return {"queued": 0, "running": 0, "oldest_wait": 0}
+    
+    # ========== СОСТОЯНИЯ FSM ==========
+    
+    async def get_fsm_record(self, storage_key: str) -> Optional[Dict]:
+        """Получает сохраненное состояние FSM и его данные"""
+        try:
+            cursor = await self.reader.execute(
+                "SELECT state, data, updated_at FROM fsm_states WHERE storage_key = ?",
+                (storage_key,)
+            )
+            row = await cursor.fetchone()
+            await cursor.close()
+            return dict(row) if row else None
+        except Exception as e:
+            logger.error(f"Ошибка чтения состояния FSM {storage_key}: {e}")
+            return None
+    
+    async def save_fsm_state(self, storage_key: str, state: Optional[str]) -> bool:
+        """Сохраняет состояние FSM, не трогая его данные"""
+        try:
+            async with self.transaction():
+                await self.conn.execute(
+                    """INSERT INTO fsm_states (storage_key, state, updated_at) VALUES (?, ?, ?)
+                    ON CONFLICT (storage_key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at""",
+                    (storage_key, state, time.time())
+                )
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка сохранения состояния FSM {storage_key}: {e}")
+            return False
+    
+    async def save_fsm_data(self, storage_key: str, data: Optional[bytes]) -> bool:
+        """Сохраняет сериализованные данные FSM, не трогая состояние"""
+        try:
+            async with self.transaction():
+                await self.conn.execute(
+                    """INSERT INTO fsm_states (storage_key, data, updated_at) VALUES (?, ?, ?)
+                    ON CONFLICT (storage_key) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at""",
+                    (storage_key, data, time.time())
+                )
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка сохранения данных FSM {storage_key}: {e}")
+            return False
+    
+    async def delete_fsm_record(self, storage_key: str) -> bool:
+        """Удаляет состояние FSM вместе с данными"""
+        try:
+            async with self.transaction():
+                await self.conn.execute("DELETE FROM fsm_states WHERE storage_key = ?", (storage_key,))
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка удаления состояния FSM {storage_key}: {e}")
+            return False
+    
+    async def purge_fsm_records(self, idle_seconds: float) -> int:
+        """Удаляет состояния FSM, которые не менялись дольше idle_seconds"""
+        try:
+            async with self.transaction():
+                cursor = await self.conn.execute(
+                    "DELETE FROM fsm_states WHERE updated_at < ?",
+                    (time.time() - idle_seconds,)
+                )
+                return cursor.rowcount
+        except Exception as e:
+            logger.error(f"Ошибка очистки состояний FSM: {e}")
+            return 0
+    
+    # ========== СТАТИСТИКА ==========
+    
+    async def get_stat_counters(self, organization_id: int = 0) -> Dict[str, Dict[str, float]]:
+        """Получает счетчики статистики организации (0 - вся система) по разделам"""
+        try:
+            cursor = await self.reader.execute(
+                "SELECT scope, key, value FROM stat_counters WHERE organization_id = ? AND value != 0",
+                (organization_id,)
+            )
+            rows = await cursor.fetchall()
+            await cursor.close()
+            
+            counters: Dict[str, Dict[str, float]] = {}
+            for row in rows:
+                counters.setdefault(row["scope"], {})[row["key"]] = row["value"]
+            return counters
+        except Exception as e:
+            logger.error(f"Ошибка получения счетчиков статистики {organization_id}: {e}")
+            return {}
+    
+    async def get_maintenance_summary(self, organization_id: int = None, days: int = 7) -> Dict[str, int]:
+        """Считает просроченное и ближайшее (в течение days дней) плановое ТО"""
+        try:
+            query = """SELECT 
+                    COALESCE(SUM(m.scheduled_date < date('now')), 0) AS overdue,
+                    COALESCE(SUM(m.scheduled_date >= date('now')), 0) AS upcoming
+                FROM maintenance m"""
+            params: List[Any] = [f"+{days} days"]
+            if organization_id:
+                query += """
+                JOIN equipment e ON e.id = m.equipment_id 
+                WHERE m.status = 'scheduled' AND m.scheduled_date <= date('now', ?) 
+                AND e.organization_id = ?"""
+                params.append(organization_id)
+            else:
+                query += " WHERE m.status = 'scheduled' AND m.scheduled_date <= date('now', ?)"
+            
+            cursor = await self.reader.execute(query, params)
+            row = await cursor.fetchone()
+            await cursor.close()
+            return {"overdue": row["overdue"], "upcoming": row["upcoming"]}
+        except Exception as e:
+            logger.error(f"Ошибка получения сводки ТО: {e}")
+            return {"overdue": 0, "upcoming": 0}
+    
     # ========== МЕТОДЫ ДЛЯ СМЕН ==========
     
     async def start_shift(self, driver_id: int, equipment_id: int, briefing_confirmed: bool = False, 
                          start_odometer: int = None) -> Optional[int]:
         """Начинает новую смену"""
         try:
-            cursor = await self.conn.execute(
-                """INSERT INTO shifts (driver_id, equipment_id, briefing_confirmed, start_odometer) 
-                VALUES (?, ?, ?, ?)""",
-                (driver_id, equipment_id, briefing_confirmed, start_odometer)
-            )
-            await self.conn.commit()
+            async with self.transaction():
+                cursor = await self.conn.execute(
+                    """INSERT INTO shifts (driver_id, equipment_id, briefing_confirmed, start_odometer) 
+                    VALUES (?, ?, ?, ?)""",
+                    (driver_id, equipment_id, briefing_confirmed, start_odometer)
+                )
             return cursor.lastrowid
         except Exception as e:
             logger.error(f"Ошибка начала смены для водителя {driver_id}: {e}")
@@ -475,7 +1310,7 @@ class Database:
     async def get_active_shift(self, driver_id: int) -> Optional[Dict]:
         """Получает активную смену водителя"""
         try:
-            cursor = await self.conn.execute('''
+            cursor = await self.reader.execute('''
                 SELECT s.*, e.name as equipment_name, e.odometer
                 FROM shifts s
                 LEFT JOIN equipment e ON s.equipment_id = e.id
@@ -491,20 +1326,110 @@ class Database:
     
     # ========== МЕТОДЫ ДЛЯ ТО ==========
     
+    async def _insert_maintenance(self, equipment_id: int, record: Dict) -> int:
+        """Вставляет запись о ТО без фиксации транзакции"""
+        columns, values = self._whitelisted(record, MAINTENANCE_COLUMNS, "maintenance")
+        columns.insert(0, "equipment_id")
+        values.insert(0, equipment_id)
+        
+        cursor = await self.conn.execute(
+            f"INSERT INTO maintenance ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+            values
+        )
+        return cursor.lastrowid
+    
     async def add_maintenance(self, equipment_id: int, type: str, scheduled_date: str, 
                              description: str = None) -> Optional[int]:
         """Добавляет запись о ТО"""
         try:
-            cursor = await self.conn.execute(
-                "INSERT INTO maintenance (equipment_id, type, scheduled_date, description) VALUES (?, ?, ?, ?)",
-                (equipment_id, type, scheduled_date, description)
-            )
-            await self.conn.commit()
-            return cursor.lastrowid
+            async with self.transaction():
+                maintenance_id = await self._insert_maintenance(equipment_id, {
+                    "type": type,
+                    "scheduled_date": scheduled_date,
+                    "description": description
+                })
+            return maintenance_id
         except Exception as e:
             logger.error(f"Ошибка добавления ТО: {e}")
             return None
     
+    # ========== УВЕДОМЛЕНИЯ ==========
+    
+    async def get_due_notifications(self, maintenance_days: int, fuel_threshold: float) -> List[Dict]:
+        """
+        Находит неотправленные уведомления о ТО и топливе одним запросом
+        
+        ТО - активная техника, у которой next_maintenance не позже чем через
+        maintenance_days дней (включая просроченное); топливо - остаток ниже
+        fuel_threshold процентов бака. Каждая строка - пара техника и
+        получатель: директор или начальник парка организации техники.
+        """
+        recipients = """JOIN users u ON u.organization_id = e.organization_id
+                AND u.role IN ('director', 'fleetmanager')"""
+        not_sent = """NOT EXISTS (SELECT 1 FROM notification_log n WHERE n.kind = {kind}
+                AND n.equipment_id = e.id AND n.period = {period} AND n.chat_id = u.telegram_id)"""
+        try:
+            cursor = await self.reader.execute(
+                f"""SELECT 'maintenance' AS kind, e.id AS equipment_id, e.name, e.registration_number,
+                    e.next_maintenance AS period, NULL AS fuel_percent, u.telegram_id AS chat_id
+                FROM equipment e {recipients}
+                WHERE e.next_maintenance IS NOT NULL AND e.next_maintenance <= date('now', ?)
+                AND COALESCE(e.status, 'active') = 'active'
+                AND {not_sent.format(kind="'maintenance'", period='e.next_maintenance')}
+                UNION ALL
+                SELECT 'fuel', e.id, e.name, e.registration_number, date('now'),
+                    round(e.current_fuel_level * 100.0 / e.fuel_capacity), u.telegram_id
+                FROM equipment e {recipients}
+                WHERE e.fuel_capacity > 0 AND e.current_fuel_level > 0
+                AND e.current_fuel_level * 100.0 / e.fuel_capacity < ?
+                AND COALESCE(e.status, 'active') = 'active'
+                AND {not_sent.format(kind="'fuel'", period="date('now')")}""",
+                (f"+{maintenance_days} days", fuel_threshold)
+            )
+            rows = await cursor.fetchall()
+            await cursor.close()
+            return [dict(row) for row in rows]
+        except Exception as e:
+            logger.error(f"Ошибка поиска уведомлений: {e}")
+            return []
+    
+    async def mark_notifications_sent(self, notifications: List[Dict]) -> List[Dict]:
+        """
+        Отмечает уведомления отправленными до отправки
+        
+        Возвращает только те, что еще не были отмечены: уведомление уходит
+        не больше одного раза за период, даже если проверки пересеклись.
+        """
+        try:
+            marked = []
+            async with self.transaction():
+                for notification in notifications:
+                    cursor = await self.conn.execute(
+                        """INSERT OR IGNORE INTO notification_log (kind, equipment_id, period, chat_id)
+                        VALUES (?, ?, ?, ?)""",
+                        (notification["kind"], notification["equipment_id"],
+                         notification["period"], notification["chat_id"])
+                    )
+                    if cursor.rowcount:
+                        marked.append(notification)
+            return marked
+        except Exception as e:
+            logger.error(f"Ошибка записи журнала уведомлений: {e}")
+            return []
+    
+    async def purge_notification_log(self, days: int) -> int:
+        """Удаляет записи журнала уведомлений старше days дней"""
+        try:
+            async with self.transaction():
+                cursor = await self.conn.execute(
+                    "DELETE FROM notification_log WHERE sent_at < datetime('now', ?)",
+                    (f"-{days} days",)
+                )
+                return cursor.rowcount
+        except Exception as e:
+            logger.error(f"Ошибка очистки журнала уведомлений: {e}")
+            return 0
+    
     # ========== ВСПОМОГАТЕЛЬНЫЕ МЕТОДЫ ==========
     
     async def assign_role_to_user(self, user_id: int, role: str, organization_id: int = None) -> bool:
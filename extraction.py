@@ -0,0 +1,312 @@
+import json
+import re
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional
+
+# ========== ШАБЛОНЫ ==========
+# Компилируются один раз при импорте, а не на каждое поле каждого ответа
+VIN_PATTERN = re.compile(r'[A-HJ-NPR-Z0-9]{17}')
+PLATE_PATTERN = re.compile(r'[АВЕКМНОРСТУХ]\d{3}[АВЕКМНОРСТУХ]{2}\d{2,3}')
+YEAR_PATTERN = re.compile(r'\b(19\d{2}|20\d{2})\b')
+# В распознанном тексте год ищется только среди правдоподобных значений
+TEXT_YEAR_PATTERN = re.compile(r'\b(19[0-9]{2}|20[0-2][0-9])\b')
+POWER_PATTERN = re.compile(r'(\d+)\s*(л\.с\.|лс|кВт|сил|hp)', re.IGNORECASE)
+POWER_NUMBER_PATTERN = re.compile(r'\b(\d{2,4})\b')
+NUMBER_PATTERN = re.compile(r'\b(\d+)\b')
+WHITESPACE_PATTERN = re.compile(r'\s+')
+PLATE_JUNK_PATTERN = re.compile(r'[^А-Я0-9]')
+
+# Пробег: число с единицами, число после подписи или просто 4-6 цифр подряд
+ODOMETER_PATTERNS = (
+    re.compile(r'(\d{1,6}[.,]?\d*)\s*(km|км|к\.м\.)', re.IGNORECASE),
+    re.compile(r'(Пробег|Одометр|ODO)[:\s]*(\d{1,6}[.,]?\d*)', re.IGNORECASE),
+    re.compile(r'\b(\d{4,6})\b'),
+)
+
+COLORS = ("белый", "черный", "красный", "синий", "зеленый",
+          "желтый", "серый", "коричневый", "оранжевый", "фиолетовый")
+
+# Поля ответа модели в порядке, в котором они попадают в результат анализа
+EXPECTED_FIELDS = (
+    "document_type", "vin", "registration_number", "model", "brand",
+    "year", "category", "engine_power", "engine_volume", "color",
+    "weight", "max_weight", "owner", "passport_number", "registration_date",
+    "engine_number", "chassis_number", "body_number", "environmental_class",
+    "extracted_text"
+)
+
+# Подписи строк документа, после двоеточия в которых идет значение поля
+TEXT_LABELS = (
+    ("model", ("МОДЕЛЬ", "MODEL")),
+    ("brand", ("МАРКА", "BRAND")),
+)
+
+# ========== НОРМАЛИЗАЦИЯ ПОЛЕЙ ==========
+def normalize_vin(value: str) -> Optional[str]:
+    match = VIN_PATTERN.search(value.upper())
+    return match.group(0) if match else None
+
+def normalize_plate(value: str) -> str:
+    return PLATE_JUNK_PATTERN.sub('', value.upper())
+
+def normalize_year(value: str) -> Optional[int]:
+    match = YEAR_PATTERN.search(value)
+    return int(match.group(0)) if match else None
+
+def normalize_power(value: str) -> Optional[int]:
+    match = POWER_PATTERN.search(value) or POWER_NUMBER_PATTERN.search(value)
+    return int(match.group(1)) if match else None
+
+def normalize_color(value: str) -> str:
+    lowered = value.lower()
+    for color in COLORS:
+        if color in lowered:
+            return color.capitalize()
+    return value
+
+def normalize_number(value: str) -> Optional[int]:
+    match = NUMBER_PATTERN.search(value)
+    return int(match.group(0)) if match else None
+
+# Строковые значения полей без нормализатора только очищаются от лишних пробелов
+NORMALIZERS: Dict[str, Callable[[str], Any]] = {
+    "vin": normalize_vin,
+    "registration_number": normalize_plate,
+    "year": normalize_year,
+    "engine_power": normalize_power,
+    "color": normalize_color,
+    "weight": normalize_number,
+    "max_weight": normalize_number,
+    "engine_volume": normalize_number,
+}
+
+def clean_field(field: str, value: Any) -> Any:
+    """Приводит одно поле ответа модели к ожидаемому типу"""
+    if value is None or value == "null" or value == "":
+        return None
+    if isinstance(value, str):
+        value = WHITESPACE_PATTERN.sub(' ', value.strip())
+        normalizer = NORMALIZERS.get(field)
+        if normalizer:
+            value = normalizer(value)
+    return value
+
+def clean_fields(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Приводит поля ответа модели к ожидаемым типам за один проход"""
+    return {field: clean_field(field, data.get(field)) for field in EXPECTED_FIELDS}
+
+# ========== КАЧЕСТВО АНАЛИЗА ==========
+# Поля и их вес в оценке качества; отсутствие первых двух групп попадает в missing_fields
+CRITICAL_FIELDS = ("vin", "model", "brand")
+IMPORTANT_FIELDS = ("registration_number", "year", "engine_power", "category")
+ADDITIONAL_FIELDS = ("color", "weight", "owner", "registration_date")
+
+def calculate_quality_score(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Рассчитывает качество распознавания по заполненности полей"""
+    missing_fields = []
+    score = 0
+
+    for fields, weight, required in ((CRITICAL_FIELDS, 13.33, True),
+                                     (IMPORTANT_FIELDS, 8.75, True),
+                                     (ADDITIONAL_FIELDS, 6.25, False)):
+        for field in fields:
+            if data.get(field):
+                score += weight
+            elif required:
+                missing_fields.append(field)
+
+    if score >= 80:
+        quality = "high"
+    elif score >= 50:
+        quality = "medium"
+    else:
+        quality = "low"
+
+    return {
+        "quality": quality,
+        "score": round(score, 2),
+        "missing_fields": missing_fields
+    }
+
+def build_analysis_result(fields: Dict[str, Any], document_type: str) -> Dict[str, Any]:
+    """
+    Результат анализа из извлеченных полей
+
+    Общий для всех источников (Cloud Function, Vision, локальное
+    распознавание): очищенные поля, тип документа и оценка качества.
+    """
+    result = clean_fields(fields)
+    result["document_type"] = document_type
+    result["success"] = True
+    result["analysis_timestamp"] = datetime.now().isoformat()
+
+    quality_score = calculate_quality_score(result)
+    result["analysis_quality"] = quality_score["quality"]
+    result["quality_score"] = quality_score["score"]
+    result["missing_fields"] = quality_score["missing_fields"]
+    return result
+
+# ========== ПОИСК JSON ==========
+# strict=False пропускает переводы строк внутри строк, которые модели оставляют в тексте
+_decoder = json.JSONDecoder(strict=False)
+
+def find_json_object(text: str) -> Optional[Dict[str, Any]]:
+    """
+    Находит первый JSON-объект в ответе модели
+
+    Разбор начинается с каждой открывающей скобки по очереди и
+    продолжается до парной закрывающей, поэтому вложенные объекты,
+    блоки ```json и пояснения вокруг JSON не мешают.
+    """
+    position = text.find('{')
+    while position != -1:
+        try:
+            value, end = _decoder.raw_decode(text, position)
+        except json.JSONDecodeError:
+            position = text.find('{', position + 1)
+            continue
+        if isinstance(value, dict):
+            return value
+        position = text.find('{', end)
+    return None
+
+# ========== ПОТОКОВЫЙ РАЗБОР ==========
+# Поля, которые показываются пользователю до окончания ответа
+PREVIEW_FIELDS = ("vin", "registration_number", "brand", "model")
+
+# Значимые для структуры JSON символы; остальное пропускается одним поиском
+_STRUCTURE_PATTERN = re.compile(rb'[{}"\\]')
+# "поле": "значение" в объекте ответа или внутри строки с текстом модели,
+# где кавычки экранированы (\"поле\": \"значение\"), а экранирование
+# самого значения удвоено
+_PREVIEW_KEYS = b'|'.join(field.encode() for field in PREVIEW_FIELDS)
+_PREVIEW_PATTERN = re.compile(
+    rb'"(' + _PREVIEW_KEYS + rb')"\s*:\s*"((?:[^"\\]|\\.)*)"'
+    rb'|\\"(' + _PREVIEW_KEYS + rb')\\"\s*:\s*\\"((?:[^"\\]|\\[^"\\]|\\\\(?:[^"\\]|\\.))*)\\"'
+)
+# Значения полей предпросмотра короткие; столько байт конца буфера
+# просматривается повторно, чтобы не пропустить поле на границе блоков
+_PREVIEW_OVERLAP = 256
+
+class JsonStreamScanner:
+    """
+    Разбирает тело JSON-ответа по мере поступления блоков
+
+    feed() добавляет блок и возвращает поля предпросмотра, которые
+    полностью пришли в нем. Как только закрывается внешний объект,
+    complete становится истинным и остаток тела можно не читать;
+    result() декодирует объект один раз, без повторного поиска.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.fields: Dict[str, Any] = {}
+        self.end: Optional[int] = None
+        self._position = 0
+        self._depth = 0
+        self._in_string = False
+        self._preview_position = 0
+
+    @property
+    def complete(self) -> bool:
+        return self.end is not None
+
+    def feed(self, chunk: bytes) -> Dict[str, Any]:
+        self.buffer += chunk
+        found = self._scan_preview() if len(self.fields) < len(PREVIEW_FIELDS) else {}
+        if not self.complete:
+            self._scan_structure()
+        return found
+
+    def result(self) -> Any:
+        body = self.buffer if self.end is None else self.buffer[:self.end]
+        return json.loads(body)
+
+    def _scan_structure(self):
+        buffer = self.buffer
+        position = self._position
+        while True:
+            match = _STRUCTURE_PATTERN.search(buffer, position)
+            if not match:
+                position = len(buffer)
+                break
+            char = buffer[match.start()]
+            position = match.start() + 1
+            if self._in_string:
+                if char == 0x5c:  # \ экранирует следующий символ
+                    if position >= len(buffer):
+                        # Экранированный символ еще не пришел
+                        position -= 1
+                        break
+                    position += 1
+                elif char == 0x22:  # "
+                    self._in_string = False
+            elif char == 0x22:
+                self._in_string = True
+            elif char == 0x7b:  # {
+                self._depth += 1
+            elif char == 0x7d:  # }
+                self._depth -= 1
+                if self._depth == 0:
+                    self.end = position
+                    break
+        self._position = position
+
+    def _scan_preview(self) -> Dict[str, Any]:
+        found = {}
+        end = self._preview_position
+        for match in _PREVIEW_PATTERN.finditer(self.buffer, self._preview_position):
+            end = match.end()
+            nested = match.group(1) is None
+            field = match.group(3 if nested else 1).decode()
+            if field in self.fields:
+                continue
+            try:
+                value = json.loads(b'"' + match.group(4 if nested else 2) + b'"')
+                if nested:
+                    value = json.loads(f'"{value}"')
+            except ValueError:
+                continue
+            value = clean_field(field, value)
+            if value:
+                self.fields[field] = found[field] = value
+        self._preview_position = max(end, len(self.buffer) - _PREVIEW_OVERLAP)
+        return found
+
+# ========== РАСПОЗНАННЫЙ ТЕКСТ ==========
+def parse_document_text(text: str) -> Dict[str, Any]:
+    """Ищет VIN, госномер, год, марку и модель в распознанном тексте документа"""
+    info = {}
+    upper = text.upper()
+
+    vin_match = VIN_PATTERN.search(upper)
+    if vin_match:
+        info['vin'] = vin_match.group(0)
+
+    plate_match = PLATE_PATTERN.search(upper)
+    if plate_match:
+        info['registration_number'] = plate_match.group(0)
+
+    year_match = TEXT_YEAR_PATTERN.search(text)
+    if year_match:
+        info['year'] = year_match.group(0)
+
+    for line in text.split('\n'):
+        # Значение поля идет после двоеточия, строки без него не нужны
+        if ':' not in line:
+            continue
+        line_upper = line.upper()
+        for field, labels in TEXT_LABELS:
+            if any(label in line_upper for label in labels):
+                info[field] = line.split(':')[1].strip()
+
+    return info
+
+def parse_instrument_panel(text: str) -> Dict[str, Any]:
+    """Ищет показания одометра в распознанном тексте приборной панели"""
+    for pattern in ODOMETER_PATTERNS:
+        for match in pattern.findall(text):
+            for item in (match if isinstance(match, tuple) else (match,)):
+                if item.isdigit():
+                    return {'odometer': int(item)}
+    return {}
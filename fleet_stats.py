@@ -0,0 +1,70 @@
+import logging
+import os
+import time
+from typing import Any, Dict
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+class FleetStatistics:
+    """
+    Статистика системы и организаций
+
+    Количества читаются из таблицы stat_counters, которую ведут триггеры,
+    поэтому запрос не зависит от числа пользователей и техники. ТО по датам
+    считается индексированным запросом. Готовые снимки кэшируются на
+    STATS_CACHE_TTL секунд.
+    """
+
+    def __init__(self, database=None):
+        self.db = database or db
+        self.ttl = float(os.getenv('STATS_CACHE_TTL', 30))
+        self.maintenance_days = int(os.getenv('STATS_MAINTENANCE_DAYS', 7))
+        self._snapshots: Dict[int, tuple] = {}
+
+    async def snapshot(self, organization_id: int = 0) -> Dict[str, Any]:
+        """Возвращает снимок статистики организации (0 - вся система)"""
+        cached = self._snapshots.get(organization_id)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        counters = await self.db.get_stat_counters(organization_id)
+        maintenance = await self.db.get_maintenance_summary(organization_id or None, self.maintenance_days)
+
+        def counter(scope: str) -> Dict[str, int]:
+            return {key: int(value) for key, value in counters.get(scope, {}).items()}
+
+        def total(scope: str) -> float:
+            return counters.get(scope, {}).get('total', 0)
+
+        users_by_role = counter('users_by_role')
+        equipment_by_status = counter('equipment_by_status')
+        stats = {
+            "users_by_role": users_by_role,
+            "users": sum(users_by_role.values()),
+            "organizations": int(total('organizations')),
+            "equipment_by_status": equipment_by_status,
+            "equipment": sum(equipment_by_status.values()),
+            "analysis_quality": counter('analysis_quality'),
+            "maintenance_overdue": maintenance["overdue"],
+            "maintenance_upcoming": maintenance["upcoming"],
+            "maintenance_days": self.maintenance_days,
+            "reports": int(total('reports')),
+            "shift_hours": round(total('shift_hours'), 1),
+            "fuel_used": round(total('fuel_used'), 1),
+        }
+
+        self._snapshots[organization_id] = (time.monotonic() + self.ttl, stats)
+        return stats
+
+    def invalidate(self, organization_id: int = None):
+        """Сбрасывает снимок организации или все снимки"""
+        if organization_id is None:
+            self._snapshots.clear()
+        else:
+            self._snapshots.pop(organization_id, None)
+            self._snapshots.pop(0, None)
+
+# Создаем глобальный сервис статистики
+fleet_stats = FleetStatistics()
@@ -0,0 +1,174 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+# Первый байт сжатых данных; несжатые данные - JSON-объект и начинаются с "{"
+COMPRESSED_MARKER = b"z"
+
+def dump_data(data: Dict[str, Any], compress_min: int) -> Optional[bytes]:
+    """Компактный JSON данных FSM, сжатый zlib, если он длиннее compress_min байт"""
+    if not data:
+        return None
+    raw = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if len(raw) < compress_min:
+        return raw
+    return COMPRESSED_MARKER + zlib.compress(raw)
+
+def load_data(blob: Optional[bytes]) -> Dict[str, Any]:
+    """Восстанавливает данные FSM, записанные dump_data"""
+    if not blob:
+        return {}
+    if blob[:1] == COMPRESSED_MARKER:
+        blob = zlib.decompress(blob[1:])
+    return json.loads(blob)
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище состояний FSM в SQLite с LRU-кэшем в памяти
+
+    Каждое изменение сразу пишется в таблицу fsm_states, поэтому начатая
+    регистрация техники переживает перезапуск бота. Чтения обслуживает
+    кэш на FSM_CACHE_SIZE ключей, включая ключи без состояния - их
+    большинство, и без кэша каждое сообщение читало бы базу. Состояния,
+    которые не менялись FSM_STATE_TTL секунд, считаются брошенными и
+    удаляются фоновой очисткой.
+    """
+
+    def __init__(self, database=None):
+        self.db = database or db
+        self.cache_size = int(os.getenv('FSM_CACHE_SIZE', 1024))
+        self.ttl = float(os.getenv('FSM_STATE_TTL', 24 * 3600))
+        self.purge_interval = float(os.getenv('FSM_PURGE_INTERVAL', 3600))
+        self.compress_min = int(os.getenv('FSM_COMPRESS_MIN_BYTES', 512))
+
+        # storage_key -> [state, data, updated_at]
+        self._cache: "OrderedDict[str, list]" = OrderedDict()
+        self._purge_task: Optional[asyncio.Task] = None
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "writes": 0,
+            "expired": 0,
+        }
+
+    @staticmethod
+    def make_key(key: StorageKey) -> str:
+        """Строковый ключ записи: бот, чат, пользователь, тред и destiny"""
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+    async def start(self):
+        """Запускает фоновую очистку брошенных состояний"""
+        if not self._purge_task:
+            self._purge_task = asyncio.create_task(self._purge_loop())
+
+    async def _purge_loop(self):
+        while True:
+            try:
+                removed = await self.db.purge_fsm_records(self.ttl)
+                if removed:
+                    self._stats["expired"] += removed
+                    logger.info(f"🧹 Удалено брошенных состояний FSM: {removed}")
+            except Exception as e:
+                logger.error(f"Ошибка очистки состояний FSM: {e}")
+            await asyncio.sleep(self.purge_interval)
+
+    async def _entry(self, storage_key: str) -> list:
+        """Запись ключа из кэша или из базы; устаревшая запись считается пустой"""
+        entry = self._cache.get(storage_key)
+        if entry is not None:
+            self._stats["hits"] += 1
+            self._cache.move_to_end(storage_key)
+        else:
+            self._stats["misses"] += 1
+            record = await self.db.get_fsm_record(storage_key)
+            if record:
+                entry = [record["state"], load_data(record["data"]), record["updated_at"]]
+            else:
+                entry = [None, {}, time.time()]
+            # Пока шло чтение, запись могла попасть в кэш из параллельного обработчика
+            entry = self._cache.get(storage_key) or entry
+            self._remember(storage_key, entry)
+
+        if (entry[0] is not None or entry[1]) and entry[2] < time.time() - self.ttl:
+            self._stats["expired"] += 1
+            await self.db.delete_fsm_record(storage_key)
+            entry[:] = [None, {}, time.time()]
+        return entry
+
+    def _remember(self, storage_key: str, entry: list):
+        self._cache[storage_key] = entry
+        self._cache.move_to_end(storage_key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _save(self, storage_key: str, entry: list, state: Optional[str], data: Dict[str, Any],
+                    blob: Optional[bytes] = None):
+        """Обновляет запись в кэше и записывает изменившуюся часть в базу"""
+        state_changed = state != entry[0]
+        entry[:] = [state, data, time.time()]
+        self._stats["writes"] += 1
+        if state is None and not data:
+            await self.db.delete_fsm_record(storage_key)
+        elif state_changed:
+            await self.db.save_fsm_state(storage_key, state)
+        else:
+            await self.db.save_fsm_data(storage_key, blob)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self.make_key(key)
+        entry = await self._entry(storage_key)
+        new_state = state.state if isinstance(state, State) else state
+        if new_state != entry[0]:
+            await self._save(storage_key, entry, new_state, entry[1])
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._entry(self.make_key(key)))[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        storage_key = self.make_key(key)
+        entry = await self._entry(storage_key)
+        if data != entry[1]:
+            # Сериализуем до изменения кэша, чтобы ошибка не оставила его впереди базы
+            blob = dump_data(data, self.compress_min)
+            await self._save(storage_key, entry, entry[0], data.copy(), blob)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._entry(self.make_key(key)))[1].copy()
+
+    async def close(self) -> None:
+        if self._purge_task:
+            self._purge_task.cancel()
+            await asyncio.gather(self._purge_task, return_exceptions=True)
+            self._purge_task = None
+
+    def stats(self) -> Dict[str, Any]:
+        """Счетчики попаданий в кэш и записей"""
+        total = self._stats["hits"] + self._stats["misses"]
+        return {
+            **self._stats,
+            "cached": len(self._cache),
+            "hit_rate": round(self._stats["hits"] / total * 100, 1) if total else 0.0,
+        }
+
+    def format_stats(self) -> str:
+        """Статистика хранилища в виде строки для сообщений"""
+        stats = self.stats()
+        return (
+            f"в кэше: {stats['cached']}, попаданий: {stats['hit_rate']}%, "
+            f"записей: {stats['writes']}, удалено брошенных: {stats['expired']}"
+        )
+
+# Создаем глобальное хранилище состояний
+fsm_storage = SQLiteStorage()
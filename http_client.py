@@ -0,0 +1,112 @@
+import aiohttp
+import asyncio
+import logging
+import os
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+class HttpClient:
+    """Общий пул HTTP соединений для всех внешних вызовов бота"""
+
+    def __init__(self):
+        self.limit = int(os.getenv('HTTP_POOL_LIMIT', 100))
+        self.limit_per_host = int(os.getenv('HTTP_POOL_LIMIT_PER_HOST', 10))
+        self.keepalive_timeout = float(os.getenv('HTTP_KEEPALIVE_TIMEOUT', 60))
+        self.dns_cache_ttl = int(os.getenv('HTTP_DNS_CACHE_TTL', 300))
+        self.connect_timeout = float(os.getenv('HTTP_CONNECT_TIMEOUT', 10))
+        self.total_timeout = float(os.getenv('HTTP_TOTAL_TIMEOUT', 60))
+
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._lock = asyncio.Lock()
+        self._stats = {
+            "requests": 0,
+            "connections_created": 0,
+            "connections_reused": 0,
+        }
+
+    async def start(self):
+        """Открывает пул соединений"""
+        async with self._lock:
+            if self._session and not self._session.closed:
+                return
+
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.dns_cache_ttl,
+                use_dns_cache=True,
+            )
+
+            # Трассировка нужна, чтобы видеть переиспользование соединений
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_request_start.append(self._on_request_start)
+            trace_config.on_connection_create_end.append(self._on_connection_create_end)
+            trace_config.on_connection_reuseconn.append(self._on_connection_reuseconn)
+
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(
+                    total=self.total_timeout,
+                    connect=self.connect_timeout
+                ),
+                trace_configs=[trace_config],
+            )
+            logger.info(
+                f"🌐 HTTP пул открыт: limit={self.limit}, per_host={self.limit_per_host}, "
+                f"keepalive={self.keepalive_timeout}с"
+            )
+
+    async def close(self):
+        """Закрывает пул соединений"""
+        if self._session and not self._session.closed:
+            await self._session.close()
+            logger.info(f"🔌 HTTP пул закрыт. {self.format_stats()}")
+        self._session = None
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """Возвращает общую сессию, открывая пул при первом обращении"""
+        if not self._session or self._session.closed:
+            await self.start()
+        return self._session
+
+    def timeout(self, total: float = None) -> aiohttp.ClientTimeout:
+        """Таймаут запроса с общим ограничением на подключение"""
+        return aiohttp.ClientTimeout(
+            total=total or self.total_timeout,
+            connect=self.connect_timeout
+        )
+
+    # ========== СТАТИСТИКА ==========
+
+    async def _on_request_start(self, session, trace_ctx, params):
+        self._stats["requests"] += 1
+
+    async def _on_connection_create_end(self, session, trace_ctx, params):
+        self._stats["connections_created"] += 1
+
+    async def _on_connection_reuseconn(self, session, trace_ctx, params):
+        self._stats["connections_reused"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Возвращает статистику использования пула"""
+        created = self._stats["connections_created"]
+        reused = self._stats["connections_reused"]
+        total = created + reused
+        return {
+            **self._stats,
+            "reuse_ratio": round(reused / total, 3) if total else 0.0,
+            "open": bool(self._session and not self._session.closed),
+        }
+
+    def format_stats(self) -> str:
+        """Статистика пула в виде строки для логов и сообщений"""
+        stats = self.stats()
+        return (
+            f"запросов: {stats['requests']}, новых соединений: {stats['connections_created']}, "
+            f"переиспользовано: {stats['connections_reused']} ({stats['reuse_ratio'] * 100:.0f}%)"
+        )
+
+# Создаем глобальный HTTP клиент
+http_client = HttpClient()
@@ -0,0 +1,192 @@
+import io
+import logging
+import os
+import time
+from typing import Dict, Any, List, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+from database import db
+from image_preprocessing import find_document_box, run_in_pool
+
+logger = logging.getLogger(__name__)
+
+# Размер хэша: 16x16 = 256 бит, в базе хранится 64 шестнадцатеричными символами
+HASH_SIZE = 16
+HASH_HEX_DIGITS = HASH_SIZE * HASH_SIZE // 4
+
+def dhash(image_bytes: bytes, hash_size: int = HASH_SIZE) -> int:
+    """Вычисляет разностный перцептивный хэш (dHash) документа на фото
+
+    Хэш считается по обрезке документа, как при предобработке, а не по
+    всему кадру: фон и поля кадра у разных фото одного бланка совпадают
+    и иначе сближали бы хэши разной техники. Устойчив к перекомпрессии
+    Telegram: сравниваются только соседние пиксели уменьшенной серой копии.
+    """
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image.draft("L", (512, 512))
+        gray = ImageOps.exif_transpose(image).convert("L")
+
+    box = find_document_box(gray)
+    if box:
+        gray = gray.crop(box)
+    small = gray.resize((hash_size + 1, hash_size), Image.LANCZOS)
+
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+def hamming_distance(a: int, b: int) -> int:
+    """Расстояние Хэмминга между двумя хэшами"""
+    return (a ^ b).bit_count()
+
+class BKTree:
+    """BK-дерево для поиска хэшей в пределах расстояния Хэмминга"""
+
+    __slots__ = ("root", "size")
+
+    def __init__(self):
+        # Узел: [хэш, значение, {расстояние: дочерний узел}]
+        self.root = None
+        self.size = 0
+
+    def add(self, hash_value: int, value: Any):
+        """Добавляет хэш в дерево"""
+        self.size += 1
+        if self.root is None:
+            self.root = [hash_value, value, {}]
+            return
+
+        node = self.root
+        while True:
+            distance = hamming_distance(hash_value, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [hash_value, value, {}]
+                return
+            node = child
+
+    def search(self, hash_value: int, max_distance: int) -> List[Tuple[int, Any]]:
+        """Возвращает все значения на расстоянии не более max_distance"""
+        if self.root is None:
+            return []
+
+        found = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(hash_value, node[0])
+            if distance <= max_distance:
+                found.append((distance, node[1]))
+            low, high = distance - max_distance, distance + max_distance
+            for child_distance, child in node[2].items():
+                if low <= child_distance <= high:
+                    stack.append(child)
+
+        found.sort(key=lambda item: item[0])
+        return found
+
+class DuplicateIndex:
+    """Индекс почти одинаковых фото документов по организациям
+
+    В памяти хранятся только хэш, id записи и время создания;
+    сами данные анализа читаются из SQLite при совпадении. Совпадение -
+    не повторный анализ: бланки СТС/ПТС одинаковы по разметке, поэтому
+    найденные данные показываются пользователю на проверку.
+    """
+
+    def __init__(self, database=None):
+        self.db = database or db
+        self.enabled = os.getenv('PHASH_ENABLED', 'True').lower() == 'true'
+        self.max_distance = int(os.getenv('PHASH_MAX_DISTANCE', 8))
+        self.window_days = int(os.getenv('PHASH_WINDOW_DAYS', 30))
+
+        self._trees: Dict[Tuple[int, str], BKTree] = {}
+        self._stats = {"lookups": 0, "matches": 0}
+
+    async def load(self):
+        """Перестраивает индекс из базы данных"""
+        if not self.enabled:
+            return
+
+        self._trees = {}
+        rows = await self.db.get_recent_fingerprints(self.window_days)
+        # Хэши другого размера (прежние 64-битные) с текущими не сравниваются
+        rows = [row for row in rows if len(row["phash"]) == HASH_HEX_DIGITS]
+        for row in rows:
+            self._add(row["organization_id"], row["document_type"], int(row["phash"], 16),
+                      row["id"], row["created_ts"])
+        logger.info(f"✅ Индекс перцептивных хэшей загружен: {len(rows)} документов")
+
+    async def compute(self, image_bytes: bytes) -> Optional[int]:
+        """Считает хэш в пуле потоков, чтобы не блокировать цикл событий"""
+        if not self.enabled:
+            return None
+        try:
+            return await run_in_pool(dhash, image_bytes)
+        except Exception as e:
+            logger.warning(f"Не удалось вычислить перцептивный хэш: {e}")
+            return None
+
+    async def find(self, organization_id: int, document_type: str, phash: int) -> Optional[Dict[str, Any]]:
+        """Ищет ранее проанализированный почти такой же документ"""
+        if not self.enabled or phash is None or not organization_id:
+            return None
+
+        self._stats["lookups"] += 1
+        tree = self._trees.get((organization_id, document_type))
+        if not tree:
+            return None
+
+        oldest = time.time() - self.window_days * 86400
+        candidates = [
+            (distance, fingerprint_id)
+            for distance, (fingerprint_id, created_ts) in tree.search(phash, self.max_distance)
+            if created_ts >= oldest
+        ]
+        if not candidates:
+            return None
+
+        # Берем ближайший документ, а не первый найденный
+        distance, fingerprint_id = min(candidates)
+        result = await self.db.get_fingerprint_analysis(fingerprint_id)
+        if not result:
+            return None
+        self._stats["matches"] += 1
+        result["duplicate_distance"] = distance
+        return result
+
+    async def add(self, organization_id: int, document_type: str, phash: int, result: Dict[str, Any]):
+        """Запоминает успешный анализ для будущих совпадений"""
+        if not self.enabled or phash is None or not organization_id or not result.get("success"):
+            return
+
+        fingerprint_id = await self.db.save_fingerprint(
+            organization_id, document_type, format(phash, f"0{HASH_HEX_DIGITS}x"), result
+        )
+        if fingerprint_id:
+            self._add(organization_id, document_type, phash, fingerprint_id, time.time())
+
+    def _add(self, organization_id: int, document_type: str, phash: int,
+             fingerprint_id: int, created_ts: float):
+        tree = self._trees.setdefault((organization_id, document_type), BKTree())
+        tree.add(phash, (fingerprint_id, created_ts))
+
+    def stats(self) -> Dict[str, Any]:
+        """Возвращает статистику индекса"""
+        return {
+            **self._stats,
+            "entries": sum(tree.size for tree in self._trees.values()),
+        }
+
+    def format_stats(self) -> str:
+        """Статистика индекса в виде строки для сообщений"""
+        stats = self.stats()
+        return f"документов: {stats['entries']}, поисков: {stats['lookups']}, совпадений: {stats['matches']}"
+
+# Создаем глобальный индекс дубликатов
+duplicate_index = DuplicateIndex()
@@ -0,0 +1,188 @@
+import asyncio
+import io
+import logging
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Tuple
+
+from PIL import Image, ImageFilter, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# Общий пул потоков для тяжелой работы с изображениями
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('IMAGE_PREPROCESS_WORKERS', 2)),
+    thread_name_prefix="image"
+)
+
+async def run_in_pool(func, *args):
+    """Выполняет CPU-задачу с изображением в пуле потоков"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, func, *args)
+
+def find_document_box(gray: Image.Image, min_area_ratio: float = 0.3):
+    """
+    Ищет границы документа по карте контуров уменьшенной копии
+
+    Возвращает (left, top, right, bottom) в координатах gray или None,
+    если рамка меньше min_area_ratio кадра или почти весь кадр. Используется
+    предобработкой, локальным OCR и перцептивным хэшем.
+    """
+    preview = gray.copy()
+    preview.thumbnail((256, 256))
+    scale_x = gray.width / preview.width
+    scale_y = gray.height / preview.height
+
+    # Фильтр дает ложные контуры по краю кадра, поэтому край отбрасываем
+    border = 2
+    edges = preview.filter(ImageFilter.FIND_EDGES).crop(
+        (border, border, preview.width - border, preview.height - border)
+    )
+    mask = edges.point(lambda value: 255 if value > 40 else 0)
+    box = mask.getbbox()
+    if not box:
+        return None
+
+    left, top, right, bottom = (coord + border for coord in box)
+    margin = 4
+    left, top = max(left - margin, 0), max(top - margin, 0)
+    right, bottom = min(right + margin, preview.width), min(bottom + margin, preview.height)
+
+    area_ratio = (right - left) * (bottom - top) / float(preview.width * preview.height)
+    # Слишком маленькая или почти полная рамка - обрезка не нужна
+    if area_ratio < min_area_ratio or area_ratio > 0.95:
+        return None
+
+    return (int(left * scale_x), int(top * scale_y), int(right * scale_x), int(bottom * scale_y))
+
+def preprocess_document_image(image_bytes: bytes, max_side: int = 1600, quality: int = 80,
+                              grayscale: bool = True) -> Tuple[bytes, Dict[str, Any]]:
+    """
+    Готовит фото документа к отправке на распознавание
+
+    Поворачивает по EXIF, обрезает по границам документа, ограничивает
+    разрешение и пережимает в JPEG. Если результат не меньше исходника,
+    возвращается исходное изображение.
+    """
+    with Image.open(io.BytesIO(image_bytes)) as source:
+        original_size = source.size
+        image = ImageOps.exif_transpose(source)
+        gray = image.convert("L")
+
+        cropped = False
+        box = find_document_box(gray)
+        if box:
+            image = image.crop(box)
+            gray = gray.crop(box)
+            cropped = True
+
+        if grayscale:
+            image = gray
+        elif image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+
+        if max(image.size) > max_side:
+            image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=quality, optimize=True)
+        processed = output.getvalue()
+        final_size = image.size
+
+    info = {
+        "original_bytes": len(image_bytes),
+        "original_size": original_size,
+        "size": final_size,
+        "cropped": cropped,
+        "grayscale": grayscale,
+        "max_side": max_side,
+    }
+
+    if len(processed) >= len(image_bytes):
+        info.update({"applied": False, "bytes": len(image_bytes)})
+        return image_bytes, info
+
+    info.update({"applied": True, "bytes": len(processed)})
+    return processed, info
+
+class ImagePreprocessor:
+    """Предобработка фото документов со сбором статистики для настройки"""
+
+    def __init__(self):
+        self.enabled = os.getenv('IMAGE_PREPROCESS_ENABLED', 'True').lower() == 'true'
+        self.max_side = int(os.getenv('IMAGE_MAX_SIDE', 1600))
+        self.quality = int(os.getenv('IMAGE_JPEG_QUALITY', 80))
+        self.grayscale = os.getenv('IMAGE_GRAYSCALE', 'True').lower() == 'true'
+        # Доля фото, отправляемых без обработки, для сравнения quality_score
+        self.bypass_rate = float(os.getenv('IMAGE_PREPROCESS_BYPASS_RATE', 0))
+
+        self._stats = {
+            "images": 0,
+            "applied": 0,
+            "bytes_in": 0,
+            "bytes_out": 0,
+            "errors": 0,
+        }
+        # Сумма и количество quality_score для обработанных и исходных фото
+        self._quality = {"processed": [0.0, 0], "original": [0.0, 0]}
+
+    async def process(self, image_bytes: bytes) -> Tuple[bytes, Dict[str, Any]]:
+        """Обрабатывает изображение в пуле потоков"""
+        if not self.enabled or (self.bypass_rate and random.random() < self.bypass_rate):
+            return image_bytes, {"applied": False, "bytes": len(image_bytes)}
+
+        self._stats["images"] += 1
+        self._stats["bytes_in"] += len(image_bytes)
+        try:
+            processed, info = await run_in_pool(
+                preprocess_document_image, image_bytes, self.max_side, self.quality, self.grayscale
+            )
+        except Exception as e:
+            logger.warning(f"Ошибка предобработки изображения: {e}")
+            self._stats["errors"] += 1
+            self._stats["bytes_out"] += len(image_bytes)
+            return image_bytes, {"applied": False, "bytes": len(image_bytes), "error": str(e)}
+
+        self._stats["bytes_out"] += len(processed)
+        if info["applied"]:
+            self._stats["applied"] += 1
+            logger.info(
+                f"Изображение сжато: {info['original_bytes'] // 1024} → {info['bytes'] // 1024} КБ, "
+                f"{info['original_size']} → {info['size']}"
+            )
+        return processed, info
+
+    def record_quality(self, info: Dict[str, Any], quality_score: float):
+        """Учитывает качество распознавания для обработанного или исходного фото"""
+        if quality_score is None:
+            return
+        bucket = self._quality["processed" if info.get("applied") else "original"]
+        bucket[0] += quality_score
+        bucket[1] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Возвращает статистику предобработки"""
+        def average(bucket):
+            return round(bucket[0] / bucket[1], 2) if bucket[1] else None
+
+        return {
+            **self._stats,
+            "bytes_saved": self._stats["bytes_in"] - self._stats["bytes_out"],
+            "max_side": self.max_side,
+            "avg_quality_processed": average(self._quality["processed"]),
+            "avg_quality_original": average(self._quality["original"]),
+        }
+
+    def format_stats(self) -> str:
+        """Статистика предобработки в виде строки для сообщений"""
+        stats = self.stats()
+        return (
+            f"фото: {stats['images']}, сжато: {stats['applied']}, "
+            f"сэкономлено: {stats['bytes_saved'] // 1024} КБ, лимит: {stats['max_side']}px, "
+            f"качество: {stats['avg_quality_processed']} (обработанные) / "
+            f"{stats['avg_quality_original']} (исходные)"
+        )
+
+# Создаем глобальный препроцессор
+image_preprocessor = ImagePreprocessor()
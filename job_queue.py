@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Итог задачи, который остается в analysis_jobs; сам анализ хранится в document_analysis
+JOB_RESULT_FIELDS = ("success", "analysis_id", "error")
+
+class AnalysisJobQueue:
+    """
+    Очередь задач анализа документов, сохраняемая в SQLite
+
+    Задачи пишутся в таблицу analysis_jobs до начала обработки, поэтому
+    переживают перезапуск бота: незавершенные задачи снова ставятся в
+    очередь при старте. Пул воркеров выполняет handler(job); исключение
+    означает повтор с экспоненциальной паузой, после max_attempts задача
+    считается проваленной и вызывается failure_handler(job, error).
+    У завершенной задачи сохраняется только краткий итог, а сама задача
+    удаляется через retention секунд (purge).
+    """
+
+    def __init__(self, database, handler: Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]],
+                 failure_handler: Callable[[Dict[str, Any], str], Awaitable[None]] = None):
+        self.db = database
+        self.handler = handler
+        self.failure_handler = failure_handler
+
+        self.workers = int(os.getenv('ANALYSIS_WORKERS', 4))
+        self.max_attempts = int(os.getenv('ANALYSIS_JOB_MAX_ATTEMPTS', 3))
+        self.retry_delay = float(os.getenv('ANALYSIS_JOB_RETRY_DELAY', 5))
+        self.poll_interval = float(os.getenv('ANALYSIS_QUEUE_POLL', 2))
+        self.retention = int(os.getenv('ANALYSIS_JOB_RETENTION', 3 * 24 * 3600))
+
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+        # Последние времена ожидания в очереди и обработки (с)
+        self._wait_times = deque(maxlen=200)
+        self._run_times = deque(maxlen=200)
+        self._stats = {
+            "enqueued": 0,
+            "duplicates": 0,
+            "completed": 0,
+            "retried": 0,
+            "failed": 0,
+        }
+
+    async def start(self):
+        """Возвращает в очередь прерванные задачи и запускает воркеры"""
+        resumed = await self.db.requeue_running_analysis_jobs()
+        if resumed:
+            logger.info(f"♻️ Возобновлено задач анализа после перезапуска: {resumed}")
+
+        for index in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(index)))
+        logger.info(f"✅ Очередь анализа запущена, воркеров: {self.workers}")
+
+    async def stop(self):
+        """Останавливает воркеры; незавершенные задачи продолжатся после запуска"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def enqueue(self, file_id: str, file_unique_id: str, document_type: str,
+                      user_id: int, chat_id: int) -> Tuple[Optional[int], bool]:
+        """
+        Ставит фото в очередь анализа
+
+        Возвращает (id задачи, создана ли новая). Если это же фото уже
+        ждет или обрабатывается, возвращается существующая задача.
+        """
+        job_id, created = await self.db.enqueue_analysis_job(
+            file_id, file_unique_id, document_type, user_id, chat_id
+        )
+        if created:
+            self._stats["enqueued"] += 1
+            self._wakeup.set()
+        elif job_id:
+            self._stats["duplicates"] += 1
+        return job_id, created
+
+    async def _worker(self, index: int):
+        while True:
+            try:
+                job = await self.db.claim_analysis_job()
+                if not job:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                await self._run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка воркера анализа {index}: {e}")
+                await asyncio.sleep(self.poll_interval)
+
+    async def _run(self, job: Dict[str, Any]):
+        """Выполняет задачу и фиксирует результат, повтор или провал"""
+        self._wait_times.append(max(job["started_at"] - job["enqueued_at"], 0.0))
+        started = time.monotonic()
+        try:
+            result = await self.handler(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error = str(e) or e.__class__.__name__
+            if job["attempts"] < self.max_attempts:
+                delay = self.retry_delay * 2 ** (job["attempts"] - 1)
+                logger.warning(
+                    f"Задача анализа {job['id']} не выполнена (попытка {job['attempts']}): {error}, "
+                    f"повтор через {delay:.0f}с"
+                )
+                self._stats["retried"] += 1
+                await self.db.retry_analysis_job(job["id"], error, delay)
+                return
+
+            logger.error(f"Задача анализа {job['id']} провалена после {job['attempts']} попыток: {error}")
+            self._stats["failed"] += 1
+            await self.db.finish_analysis_job(job["id"], "failed", error=error)
+            if self.failure_handler:
+                await self.failure_handler(job, error)
+            return
+
+        self._run_times.append(time.monotonic() - started)
+        self._stats["completed"] += 1
+        summary = {key: result[key] for key in JOB_RESULT_FIELDS if key in result} if result else None
+        await self.db.finish_analysis_job(job["id"], "done", result=summary)
+
+    async def purge(self) -> int:
+        """Удаляет завершенные задачи старше срока хранения"""
+        removed = await self.db.purge_analysis_jobs(self.retention)
+        if removed:
+            logger.info(f"🧹 Удалено завершенных задач анализа: {removed}")
+        return removed
+
+    async def stats(self) -> Dict[str, Any]:
+        """Возвращает глубину очереди, времена ожидания и счетчики"""
+        def average(values):
+            return round(sum(values) / len(values), 1) if values else None
+
+        queue = await self.db.get_analysis_queue_stats()
+        return {
+            **self._stats,
+            **queue,
+            "workers": len(self._tasks),
+            "avg_wait": average(self._wait_times),
+            "max_wait": round(max(self._wait_times), 1) if self._wait_times else None,
+            "avg_run": average(self._run_times),
+        }
+
+    async def format_stats(self) -> str:
+        """Статистика очереди в виде строки для сообщений"""
+        stats = await self.stats()
+        return (
+            f"в очереди: {stats['queued']}, в работе: {stats['running']}, "
+            f"старейшая ждет: {stats['oldest_wait']}с, ожидание: {stats['avg_wait']}с "
+            f"(макс. {stats['max_wait']}с), анализ: {stats['avg_run']}с, "
+            f"выполнено: {stats['completed']}, повторов: {stats['retried']}, "
+            f"провалено: {stats['failed']}, дублей: {stats['duplicates']}"
+        )
@@ -0,0 +1,214 @@
+import asyncio
+import importlib
+import io
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional
+
+from PIL import Image, ImageFilter, ImageOps
+
+from extraction import build_analysis_result, parse_document_text
+from image_preprocessing import find_document_box
+
+logger = logging.getLogger(__name__)
+
+# ========== ДВИЖКИ РАСПОЗНАВАНИЯ ==========
+# Движок - функция "модуль:имя", которая принимает PIL.Image и возвращает текст.
+# LOCAL_OCR_ENGINE задает имя из ENGINES или путь к своей функции, например
+# для тестов или для движка, установленного на площадке без интернета.
+ENGINES = {
+    "tesseract": "local_ocr:tesseract_engine",
+}
+
+def tesseract_engine(image: Image.Image) -> str:
+    """Распознает текст через Tesseract (нужны pytesseract и бинарник tesseract)"""
+    import pytesseract
+    # Зависший tesseract завершается самим pytesseract, не дожидаясь замены пула
+    return pytesseract.image_to_string(image, lang=os.getenv('LOCAL_OCR_LANG', 'rus+eng'),
+                                       timeout=float(os.getenv('LOCAL_OCR_TIMEOUT', 30)))
+
+# Загруженные движки процесса пула: каждый процесс импортирует движок один раз
+_engines: Dict[str, Callable[[Image.Image], str]] = {}
+
+def load_engine(spec: str) -> Callable[[Image.Image], str]:
+    """Находит функцию движка по имени из ENGINES или по пути "модуль:имя" """
+    engine = _engines.get(spec)
+    if engine is None:
+        module_name, _, attribute = ENGINES.get(spec, spec).partition(":")
+        if not attribute:
+            raise ValueError(f"Неизвестный движок OCR: {spec}")
+        engine = getattr(importlib.import_module(module_name), attribute)
+        _engines[spec] = engine
+    return engine
+
+# ========== РАБОТА В ПРОЦЕССЕ ПУЛА ==========
+def prepare_for_ocr(image_bytes: bytes, min_side: int = 1200, max_side: int = 2400) -> Image.Image:
+    """
+    Готовит фото документа к распознаванию
+
+    Поворачивает по EXIF, обрезает по границам документа, переводит в
+    оттенки серого с растяжкой контраста и приводит размер к диапазону,
+    в котором OCR уверенно читает мелкий шрифт документов.
+    """
+    with Image.open(io.BytesIO(image_bytes)) as source:
+        gray = ImageOps.exif_transpose(source).convert("L")
+
+    box = find_document_box(gray)
+    if box:
+        gray = gray.crop(box)
+
+    gray = ImageOps.autocontrast(gray, cutoff=1)
+
+    longest = max(gray.size)
+    if longest < min_side:
+        scale = min_side / longest
+        gray = gray.resize((round(gray.width * scale), round(gray.height * scale)), Image.LANCZOS)
+    elif longest > max_side:
+        gray.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    return gray.filter(ImageFilter.SHARPEN)
+
+def recognize_text(image_bytes: bytes, engine_spec: str, min_side: int, max_side: int) -> str:
+    """Предобработка и распознавание одного фото; выполняется в процессе пула"""
+    image = prepare_for_ocr(image_bytes, min_side, max_side)
+    return load_engine(engine_spec)(image) or ""
+
+# ========== АНАЛИЗАТОР ==========
+class LocalDocumentAnalyzer:
+    """
+    Анализ документов без сети: Pillow + локальный OCR + разбор текста
+
+    Распознавание выполняется в пуле процессов, поэтому не блокирует
+    цикл событий и не упирается в GIL. Вызов, не уложившийся в таймаут,
+    продолжал бы занимать процесс, поэтому после таймаута пул
+    пересоздается. Поля ищутся тем же разбором
+    текста, что и для Vision, а результат собирается так же, как для
+    Cloud Function, вместе с quality_score.
+    """
+
+    def __init__(self, text_parser: Callable[[str], Dict[str, Any]] = parse_document_text):
+        self.text_parser = text_parser
+        self.enabled = os.getenv('LOCAL_OCR_ENABLED', 'False').lower() == 'true'
+        self.engine = os.getenv('LOCAL_OCR_ENGINE', 'tesseract')
+        self.workers = int(os.getenv('LOCAL_OCR_WORKERS', 2))
+        self.timeout = float(os.getenv('LOCAL_OCR_TIMEOUT', 30))
+        self.min_side = int(os.getenv('LOCAL_OCR_MIN_SIDE', 1200))
+        self.max_side = int(os.getenv('LOCAL_OCR_MAX_SIDE', 2400))
+
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._stats = {
+            "documents": 0,
+            "failed": 0,
+            "recycled": 0,
+            "seconds": 0.0,
+        }
+
+    def _pool(self) -> ProcessPoolExecutor:
+        # Процессы запускаются при первом документе, а не при импорте модуля.
+        # spawn, а не fork: в процессе бота уже работают потоки aiosqlite и
+        # пулов, и копия их блокировок в дочернем процессе может зависнуть
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def _terminate_pool(self) -> list:
+        """Останавливает пул и завершает его процессы, возвращает их список"""
+        executor, self._executor = self._executor, None
+        if executor is None:
+            return []
+        # shutdown не прерывает уже выполняемые вызовы, поэтому процессы
+        # завершаются явно
+        processes = list((getattr(executor, "_processes", None) or {}).values())
+        executor.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+        return processes
+
+    def _recycle(self):
+        """Заменяет пул после таймаута; следующий документ запустит новый пул"""
+        if self._executor is not None:
+            self._terminate_pool()
+            self._stats["recycled"] += 1
+
+    async def analyze_document_text(self, image_bytes: bytes) -> Dict[str, Any]:
+        """Распознает текст документа; формат ответа как у Vision"""
+        if not self.enabled:
+            return {"error": "Локальное распознавание отключено", "success": False}
+
+        self._stats["documents"] += 1
+        started = time.monotonic()
+        loop = asyncio.get_running_loop()
+        try:
+            text = await asyncio.wait_for(
+                loop.run_in_executor(self._pool(), recognize_text, image_bytes,
+                                     self.engine, self.min_side, self.max_side),
+                timeout=self.timeout
+            )
+        except asyncio.TimeoutError:
+            self._stats["failed"] += 1
+            self._recycle()
+            logger.warning(f"Локальное распознавание не уложилось в {self.timeout}с, пул процессов пересоздан")
+            return {"error": "Таймаут локального распознавания", "success": False}
+        except Exception as e:
+            self._stats["failed"] += 1
+            if isinstance(e, BrokenProcessPool):
+                # Процесс пула упал - без замены пул отклонял бы все следующие вызовы
+                self._recycle()
+            logger.error(f"Ошибка локального распознавания ({self.engine}): {e}")
+            return {"error": f"Ошибка локального распознавания: {e}", "success": False}
+        finally:
+            self._stats["seconds"] += time.monotonic() - started
+
+        text = text.strip()
+        if not text:
+            self._stats["failed"] += 1
+            return {"error": "Не удалось извлечь текст из документа", "success": False}
+        return {"success": True, "extracted_text": text}
+
+    async def analyze_document(self, image_bytes: bytes, document_type: str = "СТС",
+                               organization_id: int = None) -> Dict[str, Any]:
+        """Анализирует документ локально; интерфейс как у DocumentAnalyzer"""
+        ocr_result = await self.analyze_document_text(image_bytes)
+        if not ocr_result.get("success"):
+            return ocr_result
+
+        text = ocr_result["extracted_text"]
+        fields = self.text_parser(text)
+        fields["extracted_text"] = text
+
+        result = build_analysis_result(fields, document_type)
+        result["analysis_source"] = "local"
+        logger.info(f"Локальный анализ завершен: {result['analysis_quality']} качество")
+        return result
+
+    def close(self):
+        """Останавливает пул и завершает процессы, даже занятые распознаванием"""
+        for process in self._terminate_pool():
+            process.join(timeout=1)
+
+    def stats(self) -> Dict[str, Any]:
+        """Счетчики распознанных документов и среднее время"""
+        documents = self._stats["documents"]
+        return {
+            **self._stats,
+            "avg_seconds": round(self._stats["seconds"] / documents, 2) if documents else None,
+        }
+
+    def format_stats(self) -> str:
+        """Статистика локального распознавания в виде строки для сообщений"""
+        if not self.enabled:
+            return "отключено"
+        stats = self.stats()
+        return (
+            f"движок: {self.engine}, документов: {stats['documents']}, "
+            f"ошибок: {stats['failed']}, перезапусков пула: {stats['recycled']}, "
+            f"в среднем: {stats['avg_seconds']}с"
+        )
+
+# Создаем глобальный локальный анализатор
+local_analyzer = LocalDocumentAnalyzer()
@@ -4,22 +4,41 @@ import asyncio
 import json
 import base64
 import re
+import time
 import aiohttp
 import aiocron
+from contextvars import ContextVar
 from datetime import datetime, timedelta
-from typing import Optional, Dict, List, Any
+from typing import Optional, Dict, List, Any, Tuple, Callable
 from enum import Enum
 
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command, CommandStart
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.filters.callback_data import CallbackData
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 from dotenv import load_dotenv
 
 from database import db
+from analysis_cache import analysis_cache
+from analysis_orchestrator import HedgedDocumentAnalyzer
+from batcher import MicroBatcher
+from http_client import http_client
+from image_hash import duplicate_index
+from image_preprocessing import image_preprocessor
+from local_ocr import local_analyzer
 from prompts import get_prompt, PROMPTS
+from resilience import CircuitBreaker, AdaptiveLimiter
+from job_queue import AnalysisJobQueue
+from middlewares import UserMiddleware
+from fsm_storage import fsm_storage
+from fleet_stats import fleet_stats
+from notifications import notification_scheduler
+from outbound import outbound
+from vision_analyzer import vision_analyzer as vision_text_parser
+from extraction import PREVIEW_FIELDS, JsonStreamScanner, build_analysis_result, find_json_object
 
 # ========== НАСТРОЙКА ==========
 load_dotenv()
@@ -47,7 +66,19 @@ AI_CONFIG = {
         'enabled': os.getenv('DOCUMENT_ANALYSIS_ENABLED', 'True').lower() == 'true',
         'function_url': os.getenv('DOCUMENT_ANALYSIS_FUNCTION_URL', ''),
         'timeout': int(os.getenv('CF_TIMEOUT', 60)),
-        'max_retries': int(os.getenv('CF_MAX_RETRIES', 3))
+        'max_retries': int(os.getenv('CF_MAX_RETRIES', 3)),
+        # auto - multipart с откатом на JSON, multipart или json - фиксированный формат
+        'upload_format': os.getenv('CF_UPLOAD_FORMAT', 'auto').lower(),
+        # Окно (с) и размер пакета для объединения одновременных фото в один вызов
+        'batch_window': float(os.getenv('CF_BATCH_WINDOW', 0.3)),
+        'batch_max_size': int(os.getenv('CF_BATCH_MAX_SIZE', 10)),
+        # Автомат защиты: ошибок подряд до размыкания и пауза до пробного запроса (с)
+        'breaker_threshold': int(os.getenv('CF_BREAKER_THRESHOLD', 5)),
+        'breaker_recovery': float(os.getenv('CF_BREAKER_RECOVERY', 30)),
+        # Адаптивный лимит параллельных запросов и целевая задержка ответа (с)
+        'concurrency_initial': int(os.getenv('CF_CONCURRENCY_INITIAL', 4)),
+        'concurrency_max': int(os.getenv('CF_CONCURRENCY_MAX', 32)),
+        'latency_target': float(os.getenv('CF_LATENCY_TARGET', 15))
     },
     AIModule.REGISTRATION: {
         'enabled': os.getenv('AI_ENABLED', 'True').lower() == 'true',
@@ -90,10 +121,18 @@ if not BOT_TOKEN:
     exit(1)
 
 bot = Bot(token=BOT_TOKEN, parse_mode="HTML")
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
+dp = Dispatcher(storage=fsm_storage)
+dp.message.middleware(UserMiddleware(db))
+dp.callback_query.middleware(UserMiddleware(db))
 
 # ========== КЛАСС ДЛЯ АНАЛИЗА ДОКУМЕНТОВ СТС/ПТС ==========
+# Получатель предварительных полей документа для текущего анализа.
+# Задается задачей очереди и доходит до запроса к функции через контекст,
+# не меняя сигнатур кэша, оркестратора и анализатора.
+analysis_preview: ContextVar[Optional[Callable[[Dict[str, Any]], None]]] = ContextVar(
+    "analysis_preview", default=None
+)
+
 class DocumentAnalyzer:
     """Класс для анализа документов СТС/ПТС через Yandex Cloud Function"""
     
@@ -102,10 +141,36 @@ class DocumentAnalyzer:
         self.enabled = AI_CONFIG[AIModule.DOCUMENT_ANALYSIS]['enabled']
         self.timeout = AI_CONFIG[AIModule.DOCUMENT_ANALYSIS]['timeout']
         self.max_retries = AI_CONFIG[AIModule.DOCUMENT_ANALYSIS]['max_retries']
+        self.upload_format = AI_CONFIG[AIModule.DOCUMENT_ANALYSIS]['upload_format']
+        # None - функция еще не сообщила, принимает ли она multipart
+        self._binary_supported: Optional[bool] = None
+        # Пакетные запросы включаются, только когда функция заявила их поддержку
+        self._batch_supported = False
+        # Общие для всех пользователей защита от недоступной функции и лимит параллельности
+        self.breaker = CircuitBreaker(
+            "Cloud Function",
+            failure_threshold=AI_CONFIG[AIModule.DOCUMENT_ANALYSIS]['breaker_threshold'],
+            recovery_timeout=AI_CONFIG[AIModule.DOCUMENT_ANALYSIS]['breaker_recovery']
+        )
+        self.limiter = AdaptiveLimiter(
+            "Cloud Function",
+            initial_limit=AI_CONFIG[AIModule.DOCUMENT_ANALYSIS]['concurrency_initial'],
+            max_limit=AI_CONFIG[AIModule.DOCUMENT_ANALYSIS]['concurrency_max'],
+            latency_target=AI_CONFIG[AIModule.DOCUMENT_ANALYSIS]['latency_target']
+        )
+        self._batcher = MicroBatcher(
+            self._request_analysis,
+            window=AI_CONFIG[AIModule.DOCUMENT_ANALYSIS]['batch_window'],
+            max_size=AI_CONFIG[AIModule.DOCUMENT_ANALYSIS]['batch_max_size']
+        )
         
-    async def analyze_document(self, image_bytes: bytes, document_type: str = "СТС") -> Dict[str, Any]:
+    async def analyze_document(self, image_bytes: bytes, document_type: str = "СТС",
+                               organization_id: int = None) -> Dict[str, Any]:
         """
         Анализирует документ СТС/ПТС через Yandex Cloud Function
+        
+        Повторно отправленное фото отдается из кэша без вызова функции,
+        а переснятый документ организации находится по перцептивному хэшу.
         """
         if not self.enabled:
             return {"error": "Функция анализа документов отключена", "success": False}
@@ -113,76 +178,297 @@ class DocumentAnalyzer:
         if not self.function_url:
             return {"error": "URL функции анализа документов не настроен", "success": False}
         
-        # Кодируем изображение в base64
-        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+        cache_key = analysis_cache.make_key(image_bytes, document_type)
+        cached = await analysis_cache.get(cache_key)
+        if cached:
+            logger.info(f"Результат анализа {document_type} получен из кэша")
+            cached["from_cache"] = True
+            return cached
+        
+        phash = None
+        if organization_id:
+            phash = await duplicate_index.compute(image_bytes)
+            duplicate = await duplicate_index.find(organization_id, document_type, phash)
+            if duplicate:
+                # Данные другого фото не кэшируются как анализ этого - их проверяет пользователь
+                logger.info(f"Найден похожий документ {document_type} (расстояние {duplicate['duplicate_distance']})")
+                duplicate["near_duplicate"] = True
+                return duplicate
+        
+        upload_bytes, preprocess_info = await image_preprocessor.process(image_bytes)
+        result = await self._send_for_analysis(upload_bytes, document_type)
+        if result.get("success"):
+            image_preprocessor.record_quality(preprocess_info, result.get("quality_score"))
+        await analysis_cache.set(cache_key, document_type, result)
+        await duplicate_index.add(organization_id, document_type, phash, result)
+        return result
+    
+    async def analyze_documents(self, items: List[Tuple[bytes, str]],
+                                organization_id: int = None) -> List[Dict[str, Any]]:
+        """
+        Анализирует несколько документов (изображение, тип документа)
+        
+        Одновременно ожидающие фото объединяются в один вызов функции.
+        Результаты возвращаются в порядке входного списка.
+        """
+        return list(await asyncio.gather(*(
+            self.analyze_document(image_bytes, document_type, organization_id)
+            for image_bytes, document_type in items
+        )))
+    
+    async def _send_for_analysis(self, image_bytes: bytes, document_type: str) -> Dict[str, Any]:
+        """Отправляет фото сразу или через окно пакетирования"""
+        if self._batcher.window > 0 and self._batch_supported:
+            return await self._batcher.submit((image_bytes, document_type))
+        results = await self._request_analysis([(image_bytes, document_type)],
+                                               on_partial=analysis_preview.get())
+        return results[0]
+    
+    async def _request_analysis(self, items: List[Tuple[bytes, str]],
+                                on_partial: Optional[Callable[[Dict[str, Any]], None]] = None
+                                ) -> List[Dict[str, Any]]:
+        """
+        Отправляет документы в Cloud Function с повторными попытками
+        
+        Один документ уходит обычным запросом, несколько - пакетным.
+        Возвращает результаты в порядке items. on_partial получает
+        поля предпросмотра, пока ответ еще читается.
+        """
+        is_batch = len(items) > 1
+        document_types = {document_type for _, document_type in items}
         
         # Формируем промпт
         prompt = get_prompt("document_analysis")
-        prompt = prompt.replace("СТС/ПТС/ПСМ", document_type)
+        if len(document_types) == 1:
+            prompt = prompt.replace("СТС/ПТС/ПСМ", items[0][1])
         
-        # Формируем запрос
-        payload = {
-            "image": image_base64,
+        # Метаданные запроса без изображений
+        meta = {
             "prompt": prompt,
-            "document_type": document_type,
             "timestamp": datetime.now().isoformat()
         }
+        if is_batch:
+            meta["items"] = [
+                {"part": f"image_{index}", "document_type": document_type}
+                for index, (_, document_type) in enumerate(items)
+            ]
+        else:
+            meta["document_type"] = items[0][1]
+        
+        binary = self._use_binary_upload()
+        if not binary:
+            # Кодируем изображения в base64 один раз на все попытки
+            encoded = [base64.b64encode(image_bytes).decode('utf-8') for image_bytes, _ in items]
+            if is_batch:
+                payload = {
+                    "prompt": prompt,
+                    "timestamp": meta["timestamp"],
+                    "items": [
+                        {"image": image_base64, "document_type": document_type}
+                        for image_base64, (_, document_type) in zip(encoded, items)
+                    ]
+                }
+            else:
+                payload = dict(meta, image=encoded[0])
+        
+        logger.info(f"Отправка {len(items)} документ(ов) {', '.join(document_types)} в функцию анализа "
+                    f"({'multipart' if binary else 'json'})...")
         
-        logger.info(f"Отправка документа {document_type} в функцию анализа...")
+        def fail(error: Dict[str, Any]) -> List[Dict[str, Any]]:
+            return [dict(error) for _ in items]
         
         # Пытаемся отправить запрос с повторными попытками
+        session = await http_client.get_session()
+        timeout = http_client.timeout(self.timeout)
+        retry_as_json = False
+        
         for attempt in range(self.max_retries):
+            # Пока функция недоступна, не ждем таймаутов, а сразу отказываем
+            if not self.breaker.allow_request():
+                logger.warning("Функция анализа недоступна (автомат разомкнут), запрос отклонен")
+                return fail({
+                    "error": "Функция анализа временно недоступна",
+                    "circuit_open": True,
+                    "success": False
+                })
+            
+            if binary:
+                request_kwargs = {"data": self._build_multipart(items, meta)}
+            else:
+                request_kwargs = {"json": payload, "headers": {'Content-Type': 'application/json'}}
+            
+            retry_delay = None
+            # Отмена или неожиданная ошибка до ответа не должны занимать пробный слот автомата
+            outcome_recorded = False
             try:
-                async with aiohttp.ClientSession() as session:
-                    timeout = aiohttp.ClientTimeout(total=self.timeout)
-                    
+                async with self.limiter.slot():
+                    started = time.monotonic()
                     async with session.post(
                         self.function_url, 
-                        json=payload, 
                         timeout=timeout,
-                        headers={'Content-Type': 'application/json'}
+                        **request_kwargs
                     ) as response:
                         
-                        if response.status == 200:
-                            result_data = await response.json()
+                        self._remember_upload_formats(response)
+                        latency = time.monotonic() - started
+                        # Исход успешного ответа известен только после разбора тела
+                        if response.status != 200:
+                            self._record_outcome(response.status, latency)
+                            outcome_recorded = True
+                        
+                        if binary and response.status in (400, 415) and self._negotiation_failed():
+                            retry_as_json = True
+                        
+                        elif response.status == 200:
+                            result_data = await self._read_json(response, on_partial)
+                            upstream_failed = is_batch and any(
+                                item.get("upstream_error") for item in result_data.get("results", [])
+                            )
+                            self._record_outcome(response.status, latency, upstream_failed)
+                            outcome_recorded = True
                             logger.info(f"Получен ответ (попытка {attempt + 1})")
-                            return self._process_response(result_data, document_type)
+                            if is_batch:
+                                return self._process_batch_response(result_data, items)
+                            return [self._process_response(result_data, items[0][1])]
                             
                         elif response.status == 429:
                             logger.warning(f"Слишком много запросов. Попытка {attempt + 1}")
                             if attempt < self.max_retries - 1:
-                                wait_time = 2 ** attempt
-                                await asyncio.sleep(wait_time)
-                                continue
+                                retry_delay = 2 ** attempt
                             
                         else:
                             error_text = await response.text()
                             logger.error(f"Ошибка функции: {response.status}")
-                            return {
+                            return fail({
                                 "error": f"Ошибка API: {response.status}",
                                 "status_code": response.status,
                                 "success": False
-                            }
-                            
+                            })
+                        
             except asyncio.TimeoutError:
+                self.breaker.record_failure()
+                self.limiter.record_overload()
+                outcome_recorded = True
                 logger.warning(f"Таймаут (попытка {attempt + 1})")
-                if attempt < self.max_retries - 1:
-                    await asyncio.sleep(1)
-                    continue
-                return {"error": "Таймаут при обработке документа", "success": False}
+                if attempt >= self.max_retries - 1:
+                    return fail({"error": "Таймаут при обработке документа", "success": False})
+                retry_delay = 1
                 
             except aiohttp.ClientError as e:
+                self.breaker.record_failure()
+                outcome_recorded = True
                 logger.error(f"Ошибка соединения: {e}")
-                if attempt < self.max_retries - 1:
-                    await asyncio.sleep(1)
-                    continue
-                return {"error": f"Ошибка соединения: {str(e)}", "success": False}
+                if attempt >= self.max_retries - 1:
+                    return fail({"error": f"Ошибка соединения: {str(e)}", "success": False})
+                retry_delay = 1
                 
             except Exception as e:
                 logger.error(f"Неожиданная ошибка: {e}")
-                return {"error": f"Неожиданная ошибка: {str(e)}", "success": False}
+                return fail({"error": f"Неожиданная ошибка: {str(e)}", "success": False})
+            
+            finally:
+                if not outcome_recorded:
+                    self.breaker.release()
+            
+            # Паузу держим вне слота лимитера, чтобы не занимать его
+            if retry_as_json or retry_delay is None:
+                break
+            await asyncio.sleep(retry_delay)
+        
+        if retry_as_json:
+            logger.warning("Функция не принимает multipart, переключаюсь на JSON")
+            return await self._request_analysis(items, on_partial)
         
-        return {"error": "Превышено количество попыток", "success": False}
+        return fail({"error": "Превышено количество попыток", "success": False})
+    
+    @staticmethod
+    async def _read_json(response, on_partial=None) -> Any:
+        """
+        Читает JSON-ответ функции по мере поступления блоков
+        
+        Чтение заканчивается, как только закрывается объект ответа, и
+        тело разбирается один раз. Пока ответ идет, найденные VIN,
+        госномер, марка и модель передаются on_partial.
+        """
+        scanner = JsonStreamScanner()
+        async for chunk in response.content.iter_any():
+            found = scanner.feed(chunk)
+            if scanner.complete:
+                break
+            if found and on_partial:
+                on_partial(dict(scanner.fields))
+        return scanner.result()
+    
+    def _record_outcome(self, status: int, latency: float, upstream_failed: bool = False):
+        """
+        Передает результат вызова автомату защиты и адаптивному лимиту
+        
+        upstream_failed - часть пакета не обработана из-за недоступности
+        OCR за функцией; такой ответ считается сбоем, хотя код 200.
+        """
+        if status == 429 or status >= 500 or upstream_failed:
+            self.breaker.record_failure()
+            self.limiter.record_overload()
+        else:
+            self.breaker.record_success()
+            self.limiter.record_success(latency)
+    
+    def _process_batch_response(self, result_data: Dict, items: List[Tuple[bytes, str]]) -> List[Dict[str, Any]]:
+        """Разбирает ответ пакетного запроса, ошибки элементов не влияют на остальные"""
+        results = [
+            {"error": "Функция не вернула результат для документа", "success": False}
+            for _ in items
+        ]
+        for item in result_data.get("results", []):
+            index = item.get("index")
+            if not isinstance(index, int) or not 0 <= index < len(items):
+                continue
+            if item.get("error"):
+                results[index] = {"error": item["error"], "success": False}
+            else:
+                results[index] = self._process_response(item, items[index][1])
+        return results
+    
+    def _use_binary_upload(self) -> bool:
+        """Определяет, отправлять ли изображение бинарно (multipart)"""
+        if self.upload_format == "json":
+            return False
+        if self.upload_format == "multipart":
+            return True
+        return self._binary_supported is not False
+    
+    def _negotiation_failed(self) -> bool:
+        """Отмечает, что функция не поддерживает multipart, если она не заявила обратного"""
+        if self.upload_format != "auto" or self._binary_supported:
+            return False
+        self._binary_supported = False
+        return True
+    
+    def _remember_upload_formats(self, response):
+        """Запоминает форматы, которые функция перечисляет в X-Upload-Formats"""
+        formats = response.headers.get("X-Upload-Formats")
+        if formats:
+            self._binary_supported = "multipart" in formats
+            self._batch_supported = "batch" in formats
+    
+    @staticmethod
+    def _build_multipart(items: List[Tuple[bytes, str]], meta: Dict[str, Any]) -> aiohttp.FormData:
+        """Формирует multipart тело: JSON часть meta и бинарные части изображений"""
+        form = aiohttp.FormData()
+        form.add_field("meta", json.dumps(meta, ensure_ascii=False), content_type="application/json")
+        if len(items) == 1:
+            form.add_field("image", items[0][0], filename="document.jpg", content_type="image/jpeg")
+        else:
+            for index, (image_bytes, _) in enumerate(items):
+                form.add_field(f"image_{index}", image_bytes, filename=f"document_{index}.jpg",
+                               content_type="image/jpeg")
+        return form
+    
+    def result_from_fields(self, fields: Dict, document_type: str) -> Dict[str, Any]:
+        """Валидирует извлеченные поля и добавляет оценку качества анализа"""
+        validated_data = build_analysis_result(fields, document_type)
+        logger.info(f"Анализ завершен: {validated_data['analysis_quality']} качество")
+        return validated_data
     
     def _process_response(self, result_data: Dict, document_type: str) -> Dict[str, Any]:
         """Обрабатывает ответ от Cloud Function"""
@@ -197,30 +483,19 @@ class DocumentAnalyzer:
             else:
                 result_text = str(result_data)
             
-            # Извлекаем JSON из ответа
-            json_data = self._extract_json_from_response(result_text)
+            # Функция может вернуть уже разобранный объект или текст модели
+            if isinstance(result_text, dict):
+                json_data = result_text
+            else:
+                json_data = self._extract_json_from_response(result_text)
             
             if json_data:
-                # Валидируем и очищаем данные
-                validated_data = self._validate_and_clean_data(json_data)
-                validated_data["document_type"] = document_type
-                validated_data["success"] = True
-                validated_data["analysis_timestamp"] = datetime.now().isoformat()
-                
-                # Рассчитываем качество анализа
-                quality_score = self._calculate_quality_score(validated_data)
-                validated_data["analysis_quality"] = quality_score["quality"]
-                validated_data["quality_score"] = quality_score["score"]
-                validated_data["missing_fields"] = quality_score["missing_fields"]
-                
-                logger.info(f"Анализ завершен: {quality_score['quality']} качество")
-                
-                return validated_data
+                return self.result_from_fields(json_data, document_type)
             else:
                 return {
                     "success": False,
                     "error": "Не удалось извлечь структурированные данные",
-                    "extracted_text": result_text[:500],
+                    "extracted_text": str(result_text)[:500],
                     "suggestion": "Попробуйте сделать более четкое фото"
                 }
                 
@@ -234,159 +509,13 @@ class DocumentAnalyzer:
     def _extract_json_from_response(self, response_text: str) -> Optional[Dict]:
         """Извлекает JSON из ответа функции"""
         try:
-            # Ищем JSON в ответе
-            json_patterns = [
-                r'```json\s*(.*?)\s*```',
-                r'```\s*(.*?)\s*```',
-                r'(\{.*?\})',
-            ]
-            
-            json_str = None
-            for pattern in json_patterns:
-                match = re.search(pattern, response_text, re.DOTALL)
-                if match:
-                    json_str = match.group(1) if len(match.groups()) > 0 else match.group(0)
-                    break
-            
-            if not json_str:
-                # Ищем начало и конец JSON
-                start = response_text.find('{')
-                end = response_text.rfind('}')
-                if start != -1 and end != -1 and end > start:
-                    json_str = response_text[start:end+1]
-            
-            if json_str:
-                # Очищаем строку
-                json_str = json_str.strip()
-                json_str = re.sub(r'[\x00-\x1f\x7f-\x9f]', '', json_str)
-                
-                data = json.loads(json_str)
-                return data
-                
-        except json.JSONDecodeError:
-            logger.warning("Ошибка декодирования JSON")
-            return None
-                
+            data = find_json_object(response_text)
+            if data is None:
+                logger.warning("JSON в ответе функции не найден")
+            return data
         except Exception as e:
             logger.error(f"Ошибка при извлечении JSON: {e}")
-            
-        return None
-    
-    def _validate_and_clean_data(self, data: Dict) -> Dict:
-        """Валидирует и очищает данные из JSON"""
-        cleaned = {}
-        
-        # Список ожидаемых полей
-        expected_fields = [
-            "document_type", "vin", "registration_number", "model", "brand",
-            "year", "category", "engine_power", "engine_volume", "color",
-            "weight", "max_weight", "owner", "passport_number", "registration_date",
-            "engine_number", "chassis_number", "body_number", "environmental_class",
-            "extracted_text"
-        ]
-        
-        for field in expected_fields:
-            value = data.get(field)
-            
-            if value is None or value == "null" or value == "":
-                cleaned[field] = None
-                continue
-            
-            # Очистка и валидация
-            if isinstance(value, str):
-                value = value.strip()
-                value = re.sub(r'\s+', ' ', value)
-                
-                # Специальная обработка
-                if field == "vin":
-                    vin_match = re.search(r'[A-HJ-NPR-Z0-9]{17}', value.upper())
-                    if vin_match:
-                        value = vin_match.group(0)
-                    else:
-                        value = None
-                        
-                elif field == "registration_number":
-                    value = value.upper()
-                    value = re.sub(r'[^А-Я0-9]', '', value)
-                    
-                elif field == "year":
-                    year_match = re.search(r'\b(19\d{2}|20\d{2})\b', value)
-                    if year_match:
-                        value = int(year_match.group(0))
-                    else:
-                        value = None
-                        
-                elif field == "engine_power":
-                    power_match = re.search(r'(\d+)\s*(л\.с\.|лс|кВт|сил|hp)', value, re.IGNORECASE)
-                    if power_match:
-                        value = int(power_match.group(1))
-                    else:
-                        num_match = re.search(r'\b(\d{2,4})\b', value)
-                        if num_match:
-                            value = int(num_match.group(1))
-                        else:
-                            value = None
-                            
-                elif field == "color":
-                    colors = ["белый", "черный", "красный", "синий", "зеленый", 
-                             "желтый", "серый", "коричневый", "оранжевый", "фиолетовый"]
-                    for color in colors:
-                        if color in value.lower():
-                            value = color.capitalize()
-                            break
-                
-                elif field in ["weight", "max_weight", "engine_volume"]:
-                    num_match = re.search(r'\b(\d+)\b', value)
-                    if num_match:
-                        value = int(num_match.group(0))
-                    else:
-                        value = None
-            
-            cleaned[field] = value
-        
-        return cleaned
-    
-    def _calculate_quality_score(self, data: Dict) -> Dict[str, Any]:
-        """Рассчитывает качество распознавания"""
-        critical_fields = ["vin", "model", "brand"]
-        important_fields = ["registration_number", "year", "engine_power", "category"]
-        additional_fields = ["color", "weight", "owner", "registration_date"]
-        
-        missing_fields = []
-        score = 0
-        
-        # Проверяем критические поля
-        for field in critical_fields:
-            if data.get(field):
-                score += 13.33
-            else:
-                missing_fields.append(field)
-        
-        # Проверяем важные поля
-        for field in important_fields:
-            if data.get(field):
-                score += 8.75
-            else:
-                missing_fields.append(field)
-        
-        # Проверяем дополнительные поля
-        for field in additional_fields:
-            if data.get(field):
-                score += 6.25
-        
-        # Определяем качество
-        if score >= 80:
-            quality = "high"
-        elif score >= 50:
-            quality = "medium"
-        else:
-            quality = "low"
-        
-        return {
-            "quality": quality,
-            "score": round(score, 2),
-            "missing_fields": missing_fields
-        }
+            return None
 
 # ========== КЛАСС ДЛЯ YANDEX VISION ==========
 class YandexVisionAnalyzer:
@@ -400,6 +529,8 @@ class YandexVisionAnalyzer:
             if not VISION_ENABLED or not self.api_key or not self.folder_id:
                 return {"error": "Yandex Vision API не настроен", "success": False}
             
+            image_bytes, _ = await image_preprocessor.process(image_bytes)
+            
             # Кодируем изображение в base64
             image_base64 = base64.b64encode(image_bytes).decode('utf-8')
             
@@ -423,18 +554,18 @@ class YandexVisionAnalyzer:
                 }]
             }
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, headers=headers, json=data, timeout=30) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        return self._extract_text_from_vision_result(result)
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"Ошибка Vision API: {response.status}")
-                        return {
-                            "error": f"Ошибка API: {response.status}",
-                            "success": False
-                        }
+            session = await http_client.get_session()
+            async with session.post(url, headers=headers, json=data, timeout=http_client.timeout(30)) as response:
+                if response.status == 200:
+                    result = await response.json()
+                    return self._extract_text_from_vision_result(result)
+                else:
+                    error_text = await response.text()
+                    logger.error(f"Ошибка Vision API: {response.status}")
+                    return {
+                        "error": f"Ошибка API: {response.status}",
+                        "success": False
+                    }
                         
         except asyncio.TimeoutError:
             logger.error("Таймаут Vision API")
@@ -496,6 +627,11 @@ class YandexVisionAnalyzer:
 # ========== СОЗДАЕМ ЭКЗЕМПЛЯРЫ ==========
 document_analyzer = DocumentAnalyzer()
 vision_analyzer = YandexVisionAnalyzer()
+# Cloud Function с резервным Vision OCR, если функция не успевает ответить,
+# и локальным распознаванием, если недоступен и Vision
+analysis_orchestrator = HedgedDocumentAnalyzer(
+    document_analyzer, vision_analyzer, vision_text_parser._parse_document_text, local=local_analyzer
+)
 
 # ========== СОСТОЯНИЯ ==========
 class UserStates(StatesGroup):
@@ -507,6 +643,7 @@ class UserStates(StatesGroup):
     waiting_for_equipment_name = State()
     waiting_for_motohours = State()
     waiting_for_last_service = State()
+    waiting_for_bulk_confirmation = State()
     
     # Состояния для назначения ролей
     waiting_for_role_user_id = State()
@@ -523,14 +660,14 @@ async def send_typing(chat_id):
     """Показывает 'печатает...'"""
     try:
         await bot.send_chat_action(chat_id, "typing")
-        await asyncio.sleep(0.1)
     except:
         pass
 
 async def reply(message, text, **kwargs):
-    """Отправляет сообщение с индикатором набора"""
-    await send_typing(message.chat.id)
-    return await message.answer(text, **kwargs)
+    """Отправляет ответ через диспетчер исходящих сообщений, раньше рассылок"""
+    if message.is_topic_message:
+        kwargs.setdefault('message_thread_id', message.message_thread_id)
+    return await outbound.send(message.chat.id, text, **kwargs)
 
 def get_main_keyboard(role, has_organization=False):
     """Генерирует клавиатуру в зависимости от роли"""
@@ -691,11 +828,10 @@ def get_ai_assistant_keyboard():
 
 # ========== КОМАНДА СТАРТ ==========
 @dp.message(CommandStart())
-async def cmd_start(message: types.Message, state: FSMContext):
+async def cmd_start(message: types.Message, state: FSMContext, user: Optional[Dict]):
     """Главное меню для всех"""
     await state.clear()
     
-    user = await db.get_user(message.from_user.id)
     if not user:
         await db.register_user(
             telegram_id=message.from_user.id,
@@ -757,10 +893,8 @@ async def cmd_start(message: types.Message, state: FSMContext):
 
 # ========== РЕГИСТРАЦИЯ ТЕХНИКИ С АНАЛИЗОМ ДОКУМЕНТОВ ==========
 @dp.message(F.text == "📷 Зарегистрировать технику")
-async def start_equipment_registration(message: types.Message, state: FSMContext):
+async def start_equipment_registration(message: types.Message, state: FSMContext, user: Optional[Dict]):
     """Начинает регистрацию техники с анализом документов"""
-    user = await db.get_user(message.from_user.id)
-    
     if user['role'] not in ['director', 'fleetmanager']:
         await reply(message, "⛔ Только руководители могут регистрировать технику!")
         return
@@ -784,11 +918,10 @@ async def start_equipment_registration(message: types.Message, state: FSMContext
     await state.set_state(UserStates.waiting_for_document_type)
 
 @dp.message(UserStates.waiting_for_document_type)
-async def select_document_type(message: types.Message, state: FSMContext):
+async def select_document_type(message: types.Message, state: FSMContext, user: Optional[Dict]):
     """Обрабатывает выбор типа документа"""
     if message.text == "❌ Отмена":
         await state.clear()
-        user = await db.get_user(message.from_user.id)
         await reply(message, "❌ Регистрация отменена",
                    reply_markup=get_main_keyboard(user['role'], user.get('organization_id')))
         return
@@ -817,79 +950,430 @@ async def select_document_type(message: types.Message, state: FSMContext):
         "3. Весь документ должен быть виден\n"
         "4. Избегайте бликов и теней\n"
         "5. Текст должен быть четким\n\n"
+        "📦 Для массовой регистрации отправьте альбом фото документов.\n\n"
         "<b>Отправьте фото документа:</b>",
         reply_markup=get_cancel_keyboard()
     )
     await state.set_state(UserStates.waiting_for_document_photo)
 
-@dp.message(UserStates.waiting_for_document_photo, F.photo)
-async def process_document_photo(message: types.Message, state: FSMContext):
-    """Обрабатывает фото документа"""
-    try:
-        await reply(message, "🔍 <b>Анализирую документ...</b>\n\nИИ обрабатывает изображение...")
+# ========== МАССОВАЯ РЕГИСТРАЦИЯ ТЕХНИКИ ИЗ АЛЬБОМА ==========
+# Telegram присылает фото альбома отдельными сообщениями с общим media_group_id
+ALBUM_COLLECT_DELAY = float(os.getenv('ALBUM_COLLECT_DELAY', 1.5))
+BULK_ANALYSIS_CONCURRENCY = int(os.getenv('BULK_ANALYSIS_CONCURRENCY', 4))
+
+album_buffers: Dict[str, List[types.Message]] = {}
+
+def get_bulk_confirmation_keyboard():
+    """Клавиатура для подтверждения массовой регистрации"""
+    return ReplyKeyboardMarkup(
+        keyboard=[
+            [KeyboardButton(text="✅ Зарегистрировать все")],
+            [KeyboardButton(text="❌ Отмена")]
+        ],
+        resize_keyboard=True
+    )
+
+async def analyze_album_photo(message: types.Message, document_type: str, organization_id: int,
+                              semaphore: asyncio.Semaphore) -> Dict[str, Any]:
+    """Скачивает и анализирует одно фото альбома"""
+    async with semaphore:
+        try:
+            photo = message.photo[-1]
+            file = await bot.get_file(photo.file_id)
+            photo_bytes = await bot.download_file(file.file_path)
+            image_data = await photo_bytes.read()
+            result = await analysis_orchestrator.analyze_document(image_data, document_type, organization_id)
+        except Exception as e:
+            logger.error(f"Ошибка анализа фото альбома: {e}")
+            result = {"success": False, "error": str(e)}
         
-        # Скачиваем фото
-        photo = message.photo[-1]
-        file = await bot.get_file(photo.file_id)
-        photo_bytes = await bot.download_file(file.file_path)
-        image_data = await photo_bytes.read()
+        result["document_photo_id"] = message.photo[-1].file_id
+        return result
+
+async def save_analysis_draft(document_type: str, analysis_result: Dict[str, Any]) -> Optional[int]:
+    """Сохраняет результат анализа без техники; он привязывается при регистрации"""
+    return await db.save_document_analysis({
+        "document_type": document_type,
+        "analysis_data": analysis_result,
+        "analysis_quality": analysis_result.get('analysis_quality', 'unknown'),
+        "quality_score": analysis_result.get('quality_score'),
+        "missing_fields": analysis_result.get('missing_fields', [])
+    })
+
+def bulk_item_from_analysis(analysis_result: Dict[str, Any], analysis_id: int) -> Dict[str, Any]:
+    """Формирует компактную запись техники для FSM; сам анализ хранится в базе"""
+    brand = analysis_result.get('brand') or 'Техника'
+    model = analysis_result.get('model') or ''
+    return {
+        "name": f"{brand} {model}".strip(),
+        "model": model or 'Неизвестно',
+        "vin": analysis_result.get('vin'),
+        "registration_number": analysis_result.get('registration_number'),
+        "year": analysis_result.get('year'),
+        "color": analysis_result.get('color'),
+        "engine_power": analysis_result.get('engine_power'),
+        "analysis_quality": analysis_result.get('analysis_quality', 'unknown'),
+        "near_duplicate": bool(analysis_result.get('near_duplicate')),
+        "analysis_id": analysis_id
+    }
+
+# Ограничение Telegram на длину сообщения с запасом на разметку
+BULK_SUMMARY_LIMIT = 4000
+
+def format_bulk_summary(items: List[Dict[str, Any]], failed: int) -> str:
+    """Формирует сводный экран массовой регистрации"""
+    quality_emoji = {"high": "🟢", "medium": "🟡", "low": "🔴"}
+    header = f"📦 <b>Массовая регистрация: {len(items)} ед. техники</b>\n\n"
+    
+    footer = ""
+    if failed:
+        footer += f"\n⚠️ Не удалось распознать документов: {failed}\n"
+    if any(item.get('near_duplicate') for item in items):
+        footer += "\n⚠️ <b>проверьте</b> - данные взяты из похожего документа, загруженного ранее\n"
+    footer += "\n📸 Можно отправить еще альбом - техника добавится к списку.\n"
+    footer += "<b>Зарегистрировать всю технику?</b>"
+    
+    # Список обрезается по целым строкам, чтобы не разорвать HTML-теги
+    lines = []
+    length = len(header) + len(footer)
+    for index, item in enumerate(items, 1):
+        line = f"{index}. {quality_emoji.get(item['analysis_quality'], '⚪')} <b>{item['name']}</b>"
+        line += f" | VIN: {item['vin'] or '—'}"
+        if item.get('registration_number'):
+            line += f" | {item['registration_number']}"
+        if item.get('near_duplicate'):
+            line += " | ⚠️ проверьте"
+        # Запас под строку "...и ещё N"
+        if length + len(line) + 1 > BULK_SUMMARY_LIMIT - 30:
+            lines.append(f"...и ещё {len(items) - index + 1}")
+            break
+        lines.append(line)
+        length += len(line) + 1
+    
+    return header + "\n".join(lines) + "\n" + footer
+
+# Альбомы одного чата Telegram обрабатывает параллельно; слияние списка
+# техники в FSM идет под блокировкой чата, иначе альбомы затирают друг друга
+album_locks: Dict[int, asyncio.Lock] = {}
+
+@dp.message(UserStates.waiting_for_document_photo, F.photo, F.media_group_id)
+@dp.message(UserStates.waiting_for_bulk_confirmation, F.photo, F.media_group_id)
+async def process_document_album(message: types.Message, state: FSMContext, user: Optional[Dict]):
+    """Собирает альбом фото документов и анализирует их параллельно"""
+    group_id = message.media_group_id
+    if group_id in album_buffers:
+        album_buffers[group_id].append(message)
+        return
+    
+    # Первое сообщение альбома ждет остальные
+    album_buffers[group_id] = [message]
+    await asyncio.sleep(ALBUM_COLLECT_DELAY)
+    messages = album_buffers.pop(group_id, [message])
+    
+    data = await state.get_data()
+    document_type = data.get('document_type', 'СТС')
+    
+    await reply(message, f"🔍 <b>Анализирую {len(messages)} документов...</b>\n\nЭто займет немного времени.")
+    
+    semaphore = asyncio.Semaphore(BULK_ANALYSIS_CONCURRENCY)
+    results = await asyncio.gather(*(
+        analyze_album_photo(album_message, document_type, user.get('organization_id'), semaphore)
+        for album_message in messages
+    ))
+    
+    async with album_locks.setdefault(message.chat.id, asyncio.Lock()):
+        # Пока шел анализ, пользователь мог отменить регистрацию
+        if await state.get_state() not in (UserStates.waiting_for_document_photo.state,
+                                           UserStates.waiting_for_bulk_confirmation.state):
+            return
         
-        # Получаем тип документа
+        # Данные перечитываются: за время анализа их могли дополнить другие альбомы
         data = await state.get_data()
-        document_type = data.get('document_type', 'СТС')
-        
-        # Анализируем документ
-        analysis_result = await document_analyzer.analyze_document(image_data, document_type)
+        bulk_items = data.get('bulk_items', [])
+        failed = data.get('bulk_failed', 0)
+        known_vins = {item['vin'] for item in bulk_items if item['vin']}
+        for album_message, result in zip(messages, results):
+            # Данные похожего документа с уже добавленным VIN могут быть чужими:
+            # такое фото анализируется заново, а не отбрасывается как повтор
+            if result.get("near_duplicate") and result.get('vin') in known_vins:
+                result = await analyze_album_photo(album_message, document_type, None, semaphore)
+            if not result.get("success"):
+                failed += 1
+                continue
+            # Один и тот же документ в нескольких фото регистрируем один раз
+            if result.get('vin') and result['vin'] in known_vins:
+                continue
+            analysis_id = await save_analysis_draft(document_type, result)
+            if not analysis_id:
+                failed += 1
+                continue
+            known_vins.add(result.get('vin'))
+            bulk_items.append(bulk_item_from_analysis(result, analysis_id))
         
-        if not analysis_result.get("success", False):
-            error_msg = analysis_result.get("error", "Неизвестная ошибка")
+        if not bulk_items:
+            await state.update_data(bulk_failed=failed)
             await reply(
                 message,
-                f"❌ <b>Ошибка анализа документа:</b> {error_msg}\n\n"
-                "Попробуйте:\n"
-                "1. Сделать более четкое фото\n"
-                "2. Улучшить освещение\n"
-                "3. Отправить другой документ",
+                "❌ <b>Не удалось распознать ни одного документа</b>\n\n"
+                "Попробуйте сделать более четкие фото и отправить альбом еще раз.",
                 reply_markup=get_cancel_keyboard()
             )
             return
         
-        # Сохраняем результат анализа
-        await state.update_data(
-            analysis_result=analysis_result,
-            document_photo_id=photo.file_id
+        await state.update_data(bulk_items=bulk_items, bulk_failed=failed)
+        await state.set_state(UserStates.waiting_for_bulk_confirmation)
+        await reply(message, format_bulk_summary(bulk_items, failed), reply_markup=get_bulk_confirmation_keyboard())
+
+@dp.message(UserStates.waiting_for_bulk_confirmation)
+async def process_bulk_confirmation(message: types.Message, state: FSMContext, user: Optional[Dict]):
+    """Регистрирует всю технику из альбомов одной транзакцией"""
+    if message.text == "❌ Отмена":
+        await state.clear()
+        await reply(message, "❌ Регистрация отменена",
+                   reply_markup=get_main_keyboard(user['role'], user.get('organization_id')))
+        return
+    
+    if message.text != "✅ Зарегистрировать все":
+        await reply(message, "Подтвердите регистрацию или отправьте еще альбом",
+                   reply_markup=get_bulk_confirmation_keyboard())
+        return
+    
+    data = await state.get_data()
+    bulk_items = data.get('bulk_items', [])
+    registration_date = datetime.now().strftime('%Y-%m-%d')
+    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    
+    items = []
+    for index, item in enumerate(bulk_items):
+        items.append({
+            **item,
+            "vin": item['vin'] or f"TEMP_{timestamp}_{index}",
+            "registration_number": item['registration_number'] or 'Без номера',
+            "fuel_type": 'diesel',
+            "fuel_capacity": 300,
+            "analysis": {"registration_date": registration_date}
+        })
+    
+    equipment_ids, error = await db.add_equipment_bulk(user['organization_id'], items)
+    
+    if error:
+        # Распознанные данные остаются в состоянии, регистрацию можно повторить
+        await reply(
+            message,
+            f"❌ <b>Техника не зарегистрирована:</b> {error}\n\n"
+            "Повторите регистрацию или отмените ее.",
+            reply_markup=get_bulk_confirmation_keyboard()
         )
+        return
+    
+    await state.clear()
+    db.log_action(message.from_user.id, "equipment_bulk_registered", {"equipment_ids": equipment_ids})
+    await reply(
+        message,
+        f"✅ <b>Зарегистрировано единиц техники: {len(equipment_ids)}</b>\n\n"
+        "🚜 <b>Техника добавлена в ваш автопарк!</b>",
+        reply_markup=get_main_keyboard(user['role'], user.get('organization_id'))
+    )
+
+# ========== ОЧЕРЕДЬ АНАЛИЗА ДОКУМЕНТОВ ==========
+def format_analysis_result(analysis_result: Dict[str, Any]) -> str:
+    """Формирует сообщение с результатами анализа документа"""
+    info_text = "✅ <b>Документ успешно проанализирован!</b>\n\n"
+    
+    # Качество анализа
+    quality = analysis_result.get("analysis_quality", "unknown")
+    quality_emoji = {"high": "🟢", "medium": "🟡", "low": "🔴"}.get(quality, "⚪")
+    
+    info_text += f"<b>Качество анализа:</b> {quality_emoji} {quality.upper()}\n\n"
+    
+    if analysis_result.get("near_duplicate"):
+        info_text += (
+            "⚠️ <b>Данные взяты из похожего документа, загруженного ранее.</b>\n"
+            "Сверьте VIN и госномер с фото - это может быть другая техника.\n\n"
+        )
+    
+    # Основные поля
+    fields = [
+        ("📄 Тип документа", analysis_result.get("document_type", "СТС")),
+        ("🔢 VIN номер", analysis_result.get("vin")),
+        ("🚗 Госномер", analysis_result.get("registration_number")),
+        ("🏷️ Марка", analysis_result.get("brand")),
+        ("🚜 Модель", analysis_result.get("model")),
+        ("📅 Год выпуска", analysis_result.get("year")),
+        ("⚡ Мощность", f"{analysis_result.get('engine_power')} л.с." if analysis_result.get('engine_power') else None),
+        ("🎨 Цвет", analysis_result.get("color")),
+        ("🏗️ Тип техники", analysis_result.get("category")),
+    ]
+    
+    for label, value in fields:
+        if value:
+            info_text += f"<b>{label}:</b> {value}\n"
+    
+    info_text += "\n<b>Все данные верны?</b>"
+    return info_text
+
+# Подписи полей предпросмотра в порядке PREVIEW_FIELDS
+PREVIEW_LABELS = {
+    "vin": "🔢 VIN номер",
+    "registration_number": "🚗 Госномер",
+    "brand": "🏷️ Марка",
+    "model": "🚜 Модель",
+}
+
+def format_analysis_preview(fields: Dict[str, Any]) -> str:
+    """Формирует сообщение с полями, распознанными до окончания анализа"""
+    lines = [f"<b>{PREVIEW_LABELS[field]}:</b> {fields[field]}" for field in PREVIEW_FIELDS if fields.get(field)]
+    return (
+        "🔍 <b>Предварительно распознано:</b>\n\n" + "\n".join(lines) +
+        "\n\n⏳ Проверяю остальные поля..."
+    )
+
+class AnalysisPreview:
+    """
+    Предпросмотр полей документа, пока функция анализа еще отвечает
+    
+    Первые найденные поля отправляются отдельным сообщением, следующие
+    дописываются в него же. Отправка идет в одной задаче, поэтому
+    обновления не обгоняют друг друга.
+    """
+    
+    def __init__(self, job: Dict[str, Any]):
+        self.job = job
+        self.fields: Dict[str, Any] = {}
+        self.message: Optional[types.Message] = None
+        self._task: Optional[asyncio.Task] = None
+    
+    def update(self, fields: Dict[str, Any]):
+        """Получатель analysis_preview: запоминает поля и запускает отправку"""
+        self.fields = fields
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._send())
+    
+    async def _send(self):
+        shown = None
+        try:
+            while shown != self.fields:
+                shown = self.fields
+                text = format_analysis_preview(shown)
+                if self.message:
+                    await self.message.edit_text(text)
+                elif await get_job_state(self.job):
+                    # Сообщение потом редактируется, поэтому не склеивается с соседними
+                    self.message = await outbound.send(self.job['chat_id'], text, coalesce=False)
+                else:
+                    return
+        except Exception as e:
+            logger.warning(f"Не удалось показать предпросмотр задачи {self.job['id']}: {e}")
+    
+    async def finish(self):
+        """Дожидается отправки, чтобы предпросмотр не пришел после результата"""
+        if self._task:
+            await self._task
+
+async def get_job_state(job: Dict[str, Any]) -> Optional[FSMContext]:
+    """Возвращает FSM пользователя, если он все еще ждет результат этой задачи"""
+    state = dp.fsm.get_context(bot, chat_id=job['chat_id'], user_id=job['user_id'])
+    if await state.get_state() != UserStates.waiting_for_document_photo.state:
+        return None
+    data = await state.get_data()
+    # Пользователь мог отправить новое фото - тогда результат старого не нужен
+    if data.get('analysis_job_id') != job['id']:
+        return None
+    return state
+
+async def run_analysis_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Скачивает фото, анализирует его и отправляет результат пользователю"""
+    file = await bot.get_file(job['file_id'])
+    photo_bytes = await bot.download_file(file.file_path)
+    image_data = await photo_bytes.read()
+    
+    user = await db.get_user(job['user_id'])
+    preview = AnalysisPreview(job)
+    token = analysis_preview.set(preview.update)
+    try:
+        analysis_result = await analysis_orchestrator.analyze_document(
+            image_data, job['document_type'], organization_id=user.get('organization_id') if user else None
+        )
+    finally:
+        analysis_preview.reset(token)
+        await preview.finish()
+    
+    state = await get_job_state(job)
+    if not state:
+        logger.info(f"Результат задачи анализа {job['id']} больше не ожидается")
+        return analysis_result
+    
+    await send_typing(job['chat_id'])
+    if not analysis_result.get("success", False):
+        error_msg = analysis_result.get("error", "Неизвестная ошибка")
+        await outbound.send(
+            job['chat_id'],
+            f"❌ <b>Ошибка анализа документа:</b> {error_msg}\n\n"
+            "Попробуйте:\n"
+            "1. Сделать более четкое фото\n"
+            "2. Улучшить освещение\n"
+            "3. Отправить другой документ",
+            reply_markup=get_cancel_keyboard()
+        )
+        return analysis_result
+    
+    # Результат сохраняется один раз черновиком, в FSM остается только его id
+    analysis_id = await save_analysis_draft(job['document_type'], analysis_result)
+    if not analysis_id:
+        raise RuntimeError("результат анализа не сохранен")
+    await state.update_data(
+        analysis_id=analysis_id,
+        document_photo_id=job['file_id']
+    )
+    sent = await outbound.send(job['chat_id'], format_analysis_result(analysis_result),
+                               reply_markup=get_confirmation_keyboard())
+    if not sent:
+        # Задача повторится, а не завершится результатом, которого пользователь не увидел
+        raise RuntimeError("результат анализа не отправлен")
+    await state.set_state(UserStates.waiting_for_document_analysis)
+    return {"success": True, "analysis_id": analysis_id}
+
+async def notify_analysis_job_failed(job: Dict[str, Any], error: str):
+    """Сообщает пользователю, что фото не удалось обработать после всех попыток"""
+    try:
+        if not await get_job_state(job):
+            return
+        await outbound.send(
+            job['chat_id'],
+            "❌ Ошибка при обработке фото. Попробуйте еще раз.",
+            reply_markup=get_cancel_keyboard()
+        )
+    except Exception as e:
+        logger.error(f"Ошибка уведомления о задаче анализа {job['id']}: {e}")
+
+analysis_queue = AnalysisJobQueue(db, run_analysis_job, notify_analysis_job_failed)
+
+@dp.message(UserStates.waiting_for_document_photo, F.photo)
+async def process_document_photo(message: types.Message, state: FSMContext):
+    """Ставит фото документа в очередь анализа"""
+    try:
+        photo = message.photo[-1]
+        data = await state.get_data()
+        document_type = data.get('document_type', 'СТС')
         
-        # Формируем сообщение с результатами
-        info_text = "✅ <b>Документ успешно проанализирован!</b>\n\n"
-        
-        # Качество анализа
-        quality = analysis_result.get("analysis_quality", "unknown")
-        quality_emoji = {"high": "🟢", "medium": "🟡", "low": "🔴"}.get(quality, "⚪")
-        
-        info_text += f"<b>Качество анализа:</b> {quality_emoji} {quality.upper()}\n\n"
-        
-        # Основные поля
-        fields = [
-            ("📄 Тип документа", analysis_result.get("document_type", "СТС")),
-            ("🔢 VIN номер", analysis_result.get("vin")),
-            ("🚗 Госномер", analysis_result.get("registration_number")),
-            ("🏷️ Марка", analysis_result.get("brand")),
-            ("🚜 Модель", analysis_result.get("model")),
-            ("📅 Год выпуска", analysis_result.get("year")),
-            ("⚡ Мощность", f"{analysis_result.get('engine_power')} л.с." if analysis_result.get('engine_power') else None),
-            ("🎨 Цвет", analysis_result.get("color")),
-            ("🏗️ Тип техники", analysis_result.get("category")),
-        ]
+        job_id, created = await analysis_queue.enqueue(
+            photo.file_id, photo.file_unique_id, document_type,
+            message.from_user.id, message.chat.id
+        )
+        if not job_id:
+            raise RuntimeError("задача анализа не создана")
         
-        for label, value in fields:
-            if value:
-                info_text += f"<b>{label}:</b> {value}\n"
+        await state.update_data(analysis_job_id=job_id)
         
-        info_text += "\n<b>Все данные верны?</b>"
+        if not created:
+            await reply(message, "⏳ Это фото уже анализируется, результат придет сообщением.")
+            return
         
-        await reply(message, info_text, reply_markup=get_confirmation_keyboard())
-        await state.set_state(UserStates.waiting_for_document_analysis)
+        await reply(
+            message,
+            "🔍 <b>Анализирую документ...</b>\n\n"
+            "ИИ обрабатывает изображение, результат придет сообщением."
+        )
         
     except Exception as e:
         logger.error(f"Ошибка обработки фото документа: {e}")
@@ -900,11 +1384,10 @@ async def process_document_photo(message: types.Message, state: FSMContext):
         )
 
 @dp.message(UserStates.waiting_for_document_analysis)
-async def process_document_analysis_confirmation(message: types.Message, state: FSMContext):
+async def process_document_analysis_confirmation(message: types.Message, state: FSMContext, user: Optional[Dict]):
     """Обрабатывает подтверждение данных документа"""
     if message.text == "❌ Отмена":
         await state.clear()
-        user = await db.get_user(message.from_user.id)
         await reply(message, "❌ Регистрация отменена",
                    reply_markup=get_main_keyboard(user['role'], user.get('organization_id')))
         return
@@ -934,11 +1417,11 @@ async def process_document_analysis_confirmation(message: types.Message, state:
     
     if message.text == "✅ Все верно, продолжить":
         data = await state.get_data()
-        analysis_result = data.get('analysis_result', {})
+        analysis_result = await db.get_analysis_fields(data.get('analysis_id'), ('brand', 'model'))
         
         # Предлагаем название
-        brand = analysis_result.get('brand', 'Техника')
-        model = analysis_result.get('model', '')
+        brand = analysis_result.get('brand') or 'Техника'
+        model = analysis_result.get('model') or ''
         name = f"{brand} {model}" if brand and model else brand
         
         await reply(
@@ -957,11 +1440,10 @@ async def process_document_analysis_confirmation(message: types.Message, state:
         await state.set_state(UserStates.waiting_for_equipment_name)
 
 @dp.message(UserStates.waiting_for_equipment_name)
-async def process_equipment_name(message: types.Message, state: FSMContext):
+async def process_equipment_name(message: types.Message, state: FSMContext, user: Optional[Dict]):
     """Обрабатывает ввод названия техники"""
     if message.text == "❌ Отмена":
         await state.clear()
-        user = await db.get_user(message.from_user.id)
         await reply(message, "❌ Регистрация отменена",
                    reply_markup=get_main_keyboard(user['role'], user.get('organization_id')))
         return
@@ -982,11 +1464,10 @@ async def process_equipment_name(message: types.Message, state: FSMContext):
     await state.set_state(UserStates.waiting_for_motohours)
 
 @dp.message(UserStates.waiting_for_motohours)
-async def process_motohours(message: types.Message, state: FSMContext):
+async def process_motohours(message: types.Message, state: FSMContext, user: Optional[Dict]):
     """Обрабатывает ввод моточасов"""
     if message.text == "❌ Отмена":
         await state.clear()
-        user = await db.get_user(message.from_user.id)
         await reply(message, "❌ Регистрация отменена",
                    reply_markup=get_main_keyboard(user['role'], user.get('organization_id')))
         return
@@ -1013,11 +1494,10 @@ async def process_motohours(message: types.Message, state: FSMContext):
         await reply(message, "❌ Введите число! Например: 1250")
 
 @dp.message(UserStates.waiting_for_last_service)
-async def process_last_service(message: types.Message, state: FSMContext):
+async def process_last_service(message: types.Message, state: FSMContext, user: Optional[Dict]):
     """Обрабатывает ввод данных о последнем ТО"""
     if message.text == "❌ Отмена":
         await state.clear()
-        user = await db.get_user(message.from_user.id)
         await reply(message, "❌ Регистрация отменена",
                    reply_markup=get_main_keyboard(user['role'], user.get('organization_id')))
         return
@@ -1026,8 +1506,21 @@ async def process_last_service(message: types.Message, state: FSMContext):
     
     # Получаем все данные
     data = await state.get_data()
-    user = await db.get_user(message.from_user.id)
-    analysis_result = data.get('analysis_result', {})
+    analysis_result = await db.get_analysis_fields(
+        data.get('analysis_id'), ('vin', 'model', 'registration_number', 'year', 'color', 'engine_power')
+    )
+    if data.get('analysis_id') and not analysis_result:
+        # Без анализа техника записалась бы с временным VIN и моделью "Неизвестно"
+        logger.error(f"Анализ документа {data.get('analysis_id')} не найден при регистрации техники")
+        await state.set_state(UserStates.waiting_for_document_photo)
+        await reply(
+            message,
+            "❌ <b>Результат анализа документа не найден</b>\n\n"
+            "Возможно, регистрация слишком долго оставалась незавершенной. "
+            "Отправьте фото документа еще раз.",
+            reply_markup=get_cancel_keyboard()
+        )
+        return
     equipment_name = data.get('equipment_name')
     motohours = data.get('motohours', 0)
     
@@ -1036,61 +1529,49 @@ async def process_last_service(message: types.Message, state: FSMContext):
     if not vin:
         vin = f"TEMP_{datetime.now().strftime('%Y%m%d%H%M%S')}"
     
-    # Добавляем технику в базу
-    equipment_id = await db.add_equipment(
+    registration_date = datetime.now().strftime('%Y-%m-%d')
+    
+    # Техника, привязка анализа документа и запись о ТО сохраняются одной транзакцией
+    equipment = await db.add_equipment(
         name=equipment_name,
-        model=analysis_result.get('model', 'Неизвестно'),
+        model=analysis_result.get('model') or 'Неизвестно',
         vin=vin,
         org_id=user['organization_id'],
-        registration_number=analysis_result.get('registration_number', 'Без номера'),
+        registration_number=analysis_result.get('registration_number') or 'Без номера',
         fuel_type='diesel',
-        fuel_capacity=300
-    )
-    
-    if equipment_id:
-        # Обновляем дополнительные данные
-        update_data = {'odometer': motohours}
-        
-        if analysis_result.get('year'):
-            update_data['year'] = analysis_result['year']
-        if analysis_result.get('color'):
-            update_data['color'] = analysis_result['color']
-        if analysis_result.get('engine_power'):
-            update_data['engine_power'] = analysis_result['engine_power']
-        
-        await db.update_equipment(equipment_id, **update_data)
-        
-        # Сохраняем информацию о последнем ТО
-        await db.add_maintenance(
-            equipment_id=equipment_id,
-            type="Регистрация",
-            scheduled_date=datetime.now().strftime('%Y-%m-%d'),
-            description=f"Регистрация техники. Последнее ТО: {last_service}"
-        )
-        
-        # Сохраняем анализ документа
-        await db.save_document_analysis({
-            "equipment_id": equipment_id,
-            "document_type": data.get('document_type', 'СТС'),
-            "analysis_data": analysis_result,
-            "analysis_quality": analysis_result.get('analysis_quality', 'unknown'),
+        fuel_capacity=300,
+        odometer=motohours,
+        year=analysis_result.get('year'),
+        color=analysis_result.get('color'),
+        engine_power=analysis_result.get('engine_power'),
+        analysis_id=data.get('analysis_id'),
+        analysis={
             "motohours": motohours,
             "last_service": last_service,
-            "registration_date": datetime.now().strftime('%Y-%m-%d')
-        })
+            "registration_date": registration_date
+        },
+        maintenance={
+            "type": "Регистрация",
+            "scheduled_date": registration_date,
+            "description": f"Регистрация техники. Последнее ТО: {last_service}"
+        }
+    )
+    
+    if equipment:
+        db.log_action(message.from_user.id, "equipment_registered", {"equipment_id": equipment['id'], "vin": vin})
         
         # Отправляем сообщение об успехе
         success_text = f"✅ <b>Техника успешно зарегистрирована!</b>\n\n"
-        success_text += f"<b>ID техники:</b> {equipment_id}\n"
-        success_text += f"<b>Название:</b> {equipment_name}\n"
-        success_text += f"<b>Модель:</b> {analysis_result.get('model', 'Неизвестно')}\n"
-        success_text += f"<b>VIN:</b> {vin}\n"
-        success_text += f"<b>Госномер:</b> {analysis_result.get('registration_number', 'Без номера')}\n"
+        success_text += f"<b>ID техники:</b> {equipment['id']}\n"
+        success_text += f"<b>Название:</b> {equipment['name']}\n"
+        success_text += f"<b>Модель:</b> {equipment['model']}\n"
+        success_text += f"<b>VIN:</b> {equipment['vin']}\n"
+        success_text += f"<b>Госномер:</b> {equipment['registration_number']}\n"
         
-        if analysis_result.get('year'):
-            success_text += f"<b>Год выпуска:</b> {analysis_result['year']}\n"
+        if equipment['year']:
+            success_text += f"<b>Год выпуска:</b> {equipment['year']}\n"
         
-        success_text += f"<b>Моточасы:</b> {motohours}\n"
+        success_text += f"<b>Моточасы:</b> {equipment['odometer']}\n"
         success_text += "\n🚜 <b>Техника добавлена в ваш автопарк!</b>"
         
         await reply(message, success_text)
@@ -1113,9 +1594,8 @@ async def process_last_service(message: types.Message, state: FSMContext):
 
 # ========== НАЗНАЧЕНИЕ РОЛЕЙ (АДМИНИСТРАТОР) ==========
 @dp.message(F.text == "➕ Назначить роль")
-async def assign_role_start(message: types.Message, state: FSMContext):
+async def assign_role_start(message: types.Message, state: FSMContext, user: Optional[Dict]):
     """Начинает процесс назначения роли"""
-    user = await db.get_user(message.from_user.id)
     if user['role'] != 'botadmin':
         await reply(message, "⛔ Доступ только для администратора!")
         return
@@ -1129,11 +1609,10 @@ async def assign_role_start(message: types.Message, state: FSMContext):
     await state.set_state(UserStates.waiting_for_role_user_id)
 
 @dp.message(UserStates.waiting_for_role_user_id)
-async def process_role_user_id(message: types.Message, state: FSMContext):
+async def process_role_user_id(message: types.Message, state: FSMContext, user: Optional[Dict]):
     """Обрабатывает ввод ID пользователя"""
     if message.text == "❌ Отмена":
         await state.clear()
-        user = await db.get_user(message.from_user.id)
         await reply(message, "❌ Назначение роли отменено",
                    reply_markup=get_main_keyboard(user['role'], user.get('organization_id')))
         return
@@ -1161,11 +1640,10 @@ async def process_role_user_id(message: types.Message, state: FSMContext):
         await reply(message, "❌ Введите числовой ID пользователя!")
 
 @dp.message(UserStates.waiting_for_role_type)
-async def process_role_type(message: types.Message, state: FSMContext):
+async def process_role_type(message: types.Message, state: FSMContext, user: Optional[Dict]):
     """Обрабатывает выбор типа роли"""
     if message.text == "❌ Отмена":
         await state.clear()
-        user = await db.get_user(message.from_user.id)
         await reply(message, "❌ Назначение роли отменено",
                    reply_markup=get_main_keyboard(user['role'], user.get('organization_id')))
         return
@@ -1202,6 +1680,7 @@ async def process_role_type(message: types.Message, state: FSMContext):
         success = await db.update_user_role(user_id, selected_role)
         
         if success:
+            db.log_action(message.from_user.id, "role_assigned", {"user_id": user_id, "role": selected_role})
             await reply(
                 message,
                 f"✅ <b>Роль успешно назначена!</b>\n\n"
@@ -1220,11 +1699,10 @@ async def process_role_type(message: types.Message, state: FSMContext):
         await state.clear()
 
 @dp.message(UserStates.waiting_for_role_organization)
-async def process_role_organization(message: types.Message, state: FSMContext):
+async def process_role_organization(message: types.Message, state: FSMContext, user: Optional[Dict]):
     """Обрабатывает ввод названия организации для директора"""
     if message.text == "❌ Отмена":
         await state.clear()
-        user = await db.get_user(message.from_user.id)
         await reply(message, "❌ Назначение роли отменено",
                    reply_markup=get_main_keyboard(user['role'], user.get('organization_id')))
         return
@@ -1239,6 +1717,8 @@ async def process_role_organization(message: types.Message, state: FSMContext):
     org_id, error = await db.create_organization_for_director(user_id, org_name)
     
     if org_id:
+        db.log_action(message.from_user.id, "organization_created",
+                      {"organization_id": org_id, "director_id": user_id})
         await reply(
             message,
             f"✅ <b>Организация создана и роль назначена!</b>\n\n"
@@ -1258,40 +1738,68 @@ async def process_role_organization(message: types.Message, state: FSMContext):
     await state.clear()
 
 # ========== СТАТИСТИКА ==========
+STATS_ROLE_NAMES = {
+    'botadmin': '👑 Администраторы',
+    'director': '👨‍💼 Директоры',
+    'fleetmanager': '👷 Начальники парка',
+    'driver': '🚛 Водители',
+    'unassigned': '❓ Не назначенные'
+}
+
+STATS_EQUIPMENT_STATUSES = {
+    'active': '🟢 В работе',
+    'maintenance': '🔧 На ТО',
+    'repair': '🛠 В ремонте',
+    'inactive': '⚪ Не используется'
+}
+
+STATS_QUALITY_NAMES = {
+    'high': '🟢 Высокое',
+    'medium': '🟡 Среднее',
+    'low': '🔴 Низкое',
+    'unknown': '⚪ Неизвестно'
+}
+
+def format_statistics(stats: Dict[str, Any]) -> str:
+    """Формирует текст статистики из снимка fleet_stats"""
+    text = f"👥 <b>Пользователей:</b> {stats['users']}\n"
+    for role, count in stats['users_by_role'].items():
+        text += f"• {STATS_ROLE_NAMES.get(role, role)}: {count}\n"
+    
+    text += f"\n🚜 <b>Техники:</b> {stats['equipment']}\n"
+    for status, count in stats['equipment_by_status'].items():
+        text += f"• {STATS_EQUIPMENT_STATUSES.get(status, status)}: {count}\n"
+    
+    text += "\n🔧 <b>Техническое обслуживание:</b>\n"
+    text += f"• Просрочено: {stats['maintenance_overdue']}\n"
+    text += f"• В ближайшие {stats['maintenance_days']} дн.: {stats['maintenance_upcoming']}\n"
+    
+    text += "\n📋 <b>Смены:</b>\n"
+    text += f"• Отчетов: {stats['reports']}\n"
+    text += f"• Отработано часов: {stats['shift_hours']}\n"
+    text += f"• Израсходовано топлива: {stats['fuel_used']} л\n"
+    
+    if stats['analysis_quality']:
+        text += "\n📄 <b>Качество анализа документов:</b>\n"
+        for quality, count in stats['analysis_quality'].items():
+            text += f"• {STATS_QUALITY_NAMES.get(quality, quality)}: {count}\n"
+    
+    return text
+
 @dp.message(F.text == "📊 Статистика")
-async def show_statistics(message: types.Message):
+async def show_statistics(message: types.Message, user: Optional[Dict]):
     """Показывает статистику"""
-    user = await db.get_user(message.from_user.id)
-    
     if user['role'] not in ['botadmin', 'director', 'fleetmanager']:
         await reply(message, "⛔ Доступ только для руководителей!")
         return
     
     if user['role'] == 'botadmin':
         # Статистика для администратора
-        users = await db.get_all_users_simple()
-        organizations = await db.get_all_organizations_simple()
+        stats = await fleet_stats.snapshot()
         
         stats_text = "📊 <b>Общая статистика системы</b>\n\n"
-        stats_text += f"👥 <b>Пользователей:</b> {len(users)}\n"
-        stats_text += f"🏢 <b>Организаций:</b> {len(organizations)}\n"
-        
-        # Распределение по ролям
-        roles_count = {}
-        for u in users:
-            roles_count[u['role']] = roles_count.get(u['role'], 0) + 1
-        
-        stats_text += "\n<b>Распределение по ролям:</b>\n"
-        role_names = {
-            'botadmin': '👑 Администраторы',
-            'director': '👨‍💼 Директоры',
-            'fleetmanager': '👷 Начальники парка',
-            'driver': '🚛 Водители',
-            'unassigned': '❓ Не назначенные'
-        }
-        
-        for role, count in roles_count.items():
-            stats_text += f"• {role_names.get(role, role)}: {count}\n"
+        stats_text += f"🏢 <b>Организаций:</b> {stats['organizations']}\n"
+        stats_text += format_statistics(stats)
     
     else:
         # Статистика для организации
@@ -1305,20 +1813,17 @@ async def show_statistics(message: types.Message):
             await reply(message, "❌ Организация не найдена!")
             return
         
-        # Здесь можно добавить получение статистики по организации
+        stats = await fleet_stats.snapshot(org_id)
+        
         stats_text = f"📊 <b>Статистика организации</b>\n\n"
-        stats_text += f"🏢 <b>Организация:</b> {org['name']}\n"
-        stats_text += "\n<b>Функции статистики в разработке...</b>\n"
-        stats_text += "В ближайшее время здесь будет:\n"
-        stats_text += "• Количество техники\n• Статусы ТО\n• Статистика смен\n• Анализ эффективности"
+        stats_text += f"🏢 <b>Организация:</b> {org['name']}\n\n"
+        stats_text += format_statistics(stats)
     
     await reply(message, stats_text)
 
 @dp.message(F.text == "📊 Моя статистика")
-async def show_my_statistics(message: types.Message):
+async def show_my_statistics(message: types.Message, user: Optional[Dict]):
     """Показывает персональную статистику для водителя"""
-    user = await db.get_user(message.from_user.id)
-    
     if user['role'] != 'driver':
         await reply(message, "⛔ Доступ только для водителей!")
         return
@@ -1334,9 +1839,8 @@ async def show_my_statistics(message: types.Message):
 
 # ========== НАСТРОЙКИ ИИ ==========
 @dp.message(F.text == "⚙️ Настройки ИИ")
-async def show_ai_settings(message: types.Message):
+async def show_ai_settings(message: types.Message, user: Optional[Dict]):
     """Показывает настройки ИИ модулей"""
-    user = await db.get_user(message.from_user.id)
     if user['role'] != 'botadmin':
         await reply(message, "⛔ Доступ только для администратора!")
         return
@@ -1373,10 +1877,8 @@ async def show_ai_settings(message: types.Message):
 
 # ========== ИИ ПОМОЩНИКИ ==========
 @dp.message(F.text == "🔧 Сервисный помощник")
-async def service_assistant_start(message: types.Message, state: FSMContext):
+async def service_assistant_start(message: types.Message, state: FSMContext, user: Optional[Dict]):
     """Запускает сервисного ИИ помощника"""
-    user = await db.get_user(message.from_user.id)
-    
     if not AI_CONFIG[AIModule.SERVICE]['enabled']:
         await reply(message, "⚠️ Сервисный помощник временно отключен")
         return
@@ -1395,11 +1897,10 @@ async def service_assistant_start(message: types.Message, state: FSMContext):
     await state.set_state(UserStates.waiting_for_service_issue)
 
 @dp.message(UserStates.waiting_for_service_issue)
-async def process_service_issue(message: types.Message, state: FSMContext):
+async def process_service_issue(message: types.Message, state: FSMContext, user: Optional[Dict]):
     """Обрабатывает описание проблемы для сервисного помощника"""
     if message.text == "❌ Отмена":
         await state.clear()
-        user = await db.get_user(message.from_user.id)
         await reply(message, "❌ Помощник отменен",
                    reply_markup=get_main_keyboard(user['role'], user.get('organization_id')))
         return
@@ -1426,7 +1927,6 @@ async def process_service_issue(message: types.Message, state: FSMContext):
     await reply(message, response_text)
     await state.clear()
     
-    user = await db.get_user(message.from_user.id)
     await reply(
         message,
         "Возврат в главное меню",
@@ -1434,10 +1934,8 @@ async def process_service_issue(message: types.Message, state: FSMContext):
     )
 
 @dp.message(F.text == "🚛 Помощник по сменам")
-async def shift_assistant_start(message: types.Message, state: FSMContext):
+async def shift_assistant_start(message: types.Message, state: FSMContext, user: Optional[Dict]):
     """Запускает ИИ помощника по сменам"""
-    user = await db.get_user(message.from_user.id)
-    
     if user['role'] != 'driver':
         await reply(message, "⛔ Доступ только для водителей!")
         return
@@ -1460,10 +1958,8 @@ async def shift_assistant_start(message: types.Message, state: FSMContext):
     await state.set_state(UserStates.waiting_for_shift_details)
 
 @dp.message(F.text == "📦 Помощник по запчастям")
-async def spare_parts_assistant_start(message: types.Message, state: FSMContext):
+async def spare_parts_assistant_start(message: types.Message, state: FSMContext, user: Optional[Dict]):
     """Запускает ИИ помощника по запчастям"""
-    user = await db.get_user(message.from_user.id)
-    
     if user['role'] not in ['fleetmanager', 'director']:
         await reply(message, "⛔ Доступ только для руководителей!")
         return
@@ -1487,10 +1983,8 @@ async def spare_parts_assistant_start(message: types.Message, state: FSMContext)
 
 # ========== КОМАНДА ДЛЯ РУЧНОГО АНАЛИЗА ДОКУМЕНТА ==========
 @dp.message(Command("analyze_document"))
-async def cmd_analyze_document(message: types.Message, state: FSMContext):
+async def cmd_analyze_document(message: types.Message, state: FSMContext, user: Optional[Dict]):
     """Команда для ручного анализа документа"""
-    user = await db.get_user(message.from_user.id)
-    
     if user['role'] not in ['director', 'fleetmanager']:
         await reply(message, "⛔ Только руководители могут анализировать документы!")
         return
@@ -1506,9 +2000,8 @@ async def cmd_analyze_document(message: types.Message, state: FSMContext):
 
 # ========== КОМАНДА ДЛЯ ПРОВЕРКИ СТАТУСА CLOUD FUNCTION ==========
 @dp.message(Command("check_cf_status"))
-async def cmd_check_cf_status(message: types.Message):
+async def cmd_check_cf_status(message: types.Message, user: Optional[Dict]):
     """Проверяет статус Cloud Function"""
-    user = await db.get_user(message.from_user.id)
     if user['role'] != 'botadmin':
         await reply(message, "⛔ Доступ только для администратора!")
         return
@@ -1522,87 +2015,193 @@ async def cmd_check_cf_status(message: types.Message):
     # Пробуем отправить тестовый запрос
     if config['function_url']:
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(config['function_url'], timeout=10) as response:
-                    status_text += f"<b>HTTP статус:</b> {response.status}\n"
-                    if response.status == 200:
-                        status_text += "🟢 <b>Функция доступна</b>\n"
-                    else:
-                        status_text += f"🔴 <b>Проблема: {response.status}</b>\n"
+            session = await http_client.get_session()
+            async with session.get(config['function_url'], timeout=http_client.timeout(10)) as response:
+                status_text += f"<b>HTTP статус:</b> {response.status}\n"
+                if response.status == 200:
+                    status_text += "🟢 <b>Функция доступна</b>\n"
+                else:
+                    status_text += f"🔴 <b>Проблема: {response.status}</b>\n"
         except Exception as e:
             status_text += f"🔴 <b>Ошибка подключения:</b> {str(e)}\n"
     
+    breaker = document_analyzer.breaker.stats()
+    breaker_emoji = {"closed": "🟢", "half_open": "🟡", "open": "🔴"}.get(breaker['state'], "⚪")
+    status_text += f"\n<b>Автомат защиты:</b> {breaker_emoji} {breaker['state']}"
+    if breaker['state'] == 'open':
+        status_text += f" (повтор через {breaker['retry_in']}с)"
+    status_text += f", ошибок подряд: {breaker['consecutive_failures']}, отклонено: {breaker['rejected']}\n"
+    limiter = document_analyzer.limiter.stats()
+    status_text += f"<b>Лимит параллельных запросов:</b> {limiter['limit']} (в работе: {limiter['in_flight']})\n"
+    
+    status_text += f"\n<b>🌐 HTTP пул:</b> {http_client.format_stats()}\n"
+    status_text += f"<b>🗂 Кэш анализа:</b> {analysis_cache.format_stats()}\n"
+    status_text += f"<b>🧬 Похожие документы:</b> {duplicate_index.format_stats()}\n"
+    status_text += f"<b>🗜 Предобработка фото:</b> {image_preprocessor.format_stats()}\n"
+    status_text += f"<b>🔀 Источник результата:</b> {analysis_orchestrator.format_stats()}\n"
+    status_text += f"<b>🖥 Локальное распознавание:</b> {local_analyzer.format_stats()}\n"
+    status_text += f"<b>📥 Очередь анализа:</b> {await analysis_queue.format_stats()}\n"
+    status_text += f"<b>💾 Состояния диалогов:</b> {fsm_storage.format_stats()}\n"
+    status_text += f"<b>🔔 Уведомления:</b> {notification_scheduler.format_stats()}\n"
+    status_text += f"<b>📤 Исходящие:</b> {outbound.format_stats()}\n"
+    
     await reply(message, status_text)
 
 # ========== АДМИН ФУНКЦИИ ==========
+ADMIN_PAGE_SIZE = int(os.getenv('ADMIN_PAGE_SIZE', 10))
+
+ROLE_EMOJI = {
+    'botadmin': '👑',
+    'director': '👨‍💼',
+    'fleetmanager': '👷',
+    'driver': '🚛',
+    'unassigned': '❓'
+}
+
+class UsersPage(CallbackData, prefix="users"):
+    """Страница списка пользователей: фильтры и ключ соседней страницы"""
+    role: str = ""
+    org: int = 0
+    key: str = ""
+    back: bool = False
+
+class OrganizationsPage(CallbackData, prefix="orgs"):
+    """Страница списка организаций"""
+    key: str = ""
+    back: bool = False
+
+def page_buttons(page: Dict, make_data) -> List[InlineKeyboardButton]:
+    """Кнопки перехода на предыдущую и следующую страницы"""
+    buttons = []
+    if page['prev']:
+        buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=make_data(page['prev'], True).pack()))
+    if page['next']:
+        buttons.append(InlineKeyboardButton(text="Далее ➡️", callback_data=make_data(page['next'], False).pack()))
+    return buttons
+
+async def render_users_page(role: str = "", org: int = 0, key: str = "", back: bool = False):
+    """Текст и клавиатура страницы списка пользователей"""
+    page = await db.get_users_page(key or None, back, ADMIN_PAGE_SIZE, role or None, org or None)
+    if key and not page['items']:
+        # Соседняя страница опустела (пользователей удалили) - показываем первую
+        page = await db.get_users_page(None, False, ADMIN_PAGE_SIZE, role or None, org or None)
+    
+    text = "👥 <b>Все пользователи</b>\n"
+    if role:
+        text += f"Роль: {STATS_ROLE_NAMES.get(role, role)}\n"
+    if org:
+        text += f"Организация ID: {org}\n"
+    text += "\n"
+    
+    if not page['items']:
+        text += "📭 Пользователей не найдено."
+    
+    for u in page['items']:
+        text += f"{ROLE_EMOJI.get(u['role'], '❓')} <b>{u['full_name']}</b>\n"
+        text += f"ID: <code>{u['telegram_id']}</code>\n"
+        text += f"Роль: {u['role']}\n"
+        if u.get('organization_id'):
+            text += f"Организация ID: {u['organization_id']}\n"
+        text += "\n"
+    
+    # Фильтр по роли сохраняет фильтр по организации и начинает с первой страницы
+    keyboard = [[
+        InlineKeyboardButton(
+            text=("• " if r == role else "") + (ROLE_EMOJI.get(r) or "Все"),
+            callback_data=UsersPage(role=r, org=org).pack()
+        )
+        for r in ["", *ROLE_EMOJI]
+    ]]
+    navigation = page_buttons(page, lambda k, b: UsersPage(role=role, org=org, key=k, back=b))
+    if navigation:
+        keyboard.append(navigation)
+    if org:
+        keyboard.append([InlineKeyboardButton(
+            text="✖️ Все организации", callback_data=UsersPage(role=role).pack()
+        )])
+    return text, InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+async def render_organizations_page(key: str = "", back: bool = False):
+    """Текст и клавиатура страницы списка организаций"""
+    page = await db.get_organizations_page(key or None, back, ADMIN_PAGE_SIZE)
+    if key and not page['items']:
+        page = await db.get_organizations_page(None, False, ADMIN_PAGE_SIZE)
+    
+    if not page['items']:
+        return "🏢 Организаций пока нет.", None
+    
+    text = "🏢 <b>Все организации</b>\n\n"
+    keyboard = []
+    for org in page['items']:
+        text += f"<b>ID:</b> {org['id']}\n"
+        text += f"<b>Название:</b> {org['name']}\n"
+        if org.get('director_id'):
+            text += f"<b>Директор ID:</b> {org['director_id']}\n"
+        text += "\n"
+        keyboard.append([InlineKeyboardButton(
+            text=f"👥 {org['name']}", callback_data=UsersPage(org=org['id']).pack()
+        )])
+    
+    navigation = page_buttons(page, lambda k, b: OrganizationsPage(key=k, back=b))
+    if navigation:
+        keyboard.append(navigation)
+    return text, InlineKeyboardMarkup(inline_keyboard=keyboard)
+
 @dp.message(F.text == "👥 Все пользователи")
-async def all_users(message: types.Message):
+async def all_users(message: types.Message, user: Optional[Dict]):
     """Показывает всех пользователей (админ)"""
-    user = await db.get_user(message.from_user.id)
     if user['role'] != 'botadmin':
         await reply(message, "⛔ Доступ только для администратора!")
         return
     
-    users = await db.get_all_users_simple()
-    
-    if not users:
-        await reply(message, "📭 Пользователей пока нет.")
+    text, keyboard = await render_users_page()
+    await reply(message, text, reply_markup=keyboard)
+
+@dp.callback_query(UsersPage.filter())
+async def users_page(callback: types.CallbackQuery, callback_data: UsersPage, user: Optional[Dict]):
+    """Листает список пользователей и меняет фильтры (админ)"""
+    if not user or user['role'] != 'botadmin':
+        await callback.answer("⛔ Доступ только для администратора!", show_alert=True)
         return
     
-    text = "👥 <b>Все пользователи</b>\n\n"
-    
-    for u in users[:15]:
-        role_emoji = {
-            'botadmin': '👑',
-            'director': '👨‍💼',
-            'fleetmanager': '👷',
-            'driver': '🚛',
-            'unassigned': '❓'
-        }.get(u['role'], '❓')
-        
-        text += f"{role_emoji} <b>{u['full_name']}</b>\n"
-        text += f"ID: <code>{u['telegram_id']}</code>\n"
-        text += f"Роль: {u['role']}\n"
-        if u.get('organization_id'):
-            text += f"Организация ID: {u['organization_id']}\n"
-        text += "\n"
-    
-    if len(users) > 15:
-        text += f"<i>... и еще {len(users) - 15} пользователей</i>"
-    
-    await reply(message, text)
+    text, keyboard = await render_users_page(
+        callback_data.role, callback_data.org, callback_data.key, callback_data.back
+    )
+    try:
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    except TelegramBadRequest:
+        # Повторное нажатие на тот же фильтр не меняет сообщение
+        pass
+    await callback.answer()
 
 @dp.message(F.text == "🏢 Все организации")
-async def all_organizations(message: types.Message):
+async def all_organizations(message: types.Message, user: Optional[Dict]):
     """Показывает все организации (админ)"""
-    user = await db.get_user(message.from_user.id)
     if user['role'] != 'botadmin':
         await reply(message, "⛔ Доступ только для администратора!")
         return
     
-    organizations = await db.get_all_organizations_simple()
-    
-    if not organizations:
-        await reply(message, "🏢 Организаций пока нет.")
+    text, keyboard = await render_organizations_page()
+    await reply(message, text, reply_markup=keyboard)
+
+@dp.callback_query(OrganizationsPage.filter())
+async def organizations_page(callback: types.CallbackQuery, callback_data: OrganizationsPage, user: Optional[Dict]):
+    """Листает список организаций (админ)"""
+    if not user or user['role'] != 'botadmin':
+        await callback.answer("⛔ Доступ только для администратора!", show_alert=True)
         return
     
-    text = "🏢 <b>Все организации</b>\n\n"
-    
-    for org in organizations:
-        text += f"<b>ID:</b> {org['id']}\n"
-        text += f"<b>Название:</b> {org['name']}\n"
-        if org.get('director_id'):
-            text += f"<b>Директор ID:</b> {org['director_id']}\n"
-        text += "\n"
-    
-    await reply(message, text)
+    text, keyboard = await render_organizations_page(callback_data.key, callback_data.back)
+    try:
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    except TelegramBadRequest:
+        pass
+    await callback.answer()
 
 # ========== ФУНКЦИИ ДИРЕКТОРА ==========
 @dp.message(F.text == "🏢 Моя организация")
-async def my_organization(message: types.Message):
+async def my_organization(message: types.Message, user: Optional[Dict]):
     """Показывает информацию об организации директора"""
-    user = await db.get_user(message.from_user.id)
-    
     if user['role'] != 'director':
         await reply(message, "⛔ Доступ только для директора!")
         return
@@ -1631,10 +2230,8 @@ async def my_organization(message: types.Message):
     await reply(message, org_text)
 
 @dp.message(F.text == "🏢 Создать организацию")
-async def create_organization(message: types.Message):
+async def create_organization(message: types.Message, user: Optional[Dict]):
     """Создает организацию для директора"""
-    user = await db.get_user(message.from_user.id)
-    
     if user['role'] != 'director':
         await reply(message, "⛔ Доступ только для директора!")
         return
@@ -1654,10 +2251,38 @@ async def create_organization(message: types.Message):
     await reply(message, "Функция создания организации в разработке...")
 
 # ========== ЗАПУСК БОТА ==========
+# Черновик должен пережить состояние FSM, которое на него ссылается: срок FSM
+# отсчитывается от последнего шага регистрации, а срок черновика - от анализа
+ANALYSIS_DRAFT_TTL = max(int(os.getenv('ANALYSIS_DRAFT_TTL', 3 * 24 * 3600)),
+                         int(fsm_storage.ttl) + 24 * 3600)
+
+@aiocron.crontab('17 * * * *', start=False)
+async def purge_analysis_drafts():
+    """Удаляет черновики анализа брошенных регистраций и старые задачи очереди"""
+    removed = await db.purge_unattached_analyses(ANALYSIS_DRAFT_TTL)
+    if removed:
+        logger.info(f"🧹 Удалено черновиков анализа: {removed}")
+    await analysis_queue.purge()
+
+# Проверка ТО и топлива; по умолчанию каждый день в 9:00
+NOTIFICATION_CRON = os.getenv('NOTIFICATION_CRON', '0 9 * * *')
+
+@aiocron.crontab(NOTIFICATION_CRON, start=False)
+async def send_scheduled_notifications():
+    """Рассылает директорам и начальникам парка уведомления о ТО и топливе"""
+    await notification_scheduler.run()
+
 async def on_startup():
     """Инициализация при запуске"""
     try:
         await db.connect()
+        await http_client.start()
+        await duplicate_index.load()
+        await analysis_queue.start()
+        await fsm_storage.start()
+        purge_analysis_drafts.start()
+        outbound.start(bot)
+        send_scheduled_notifications.start()
         
         # Создаем администратора если нет
         ADMIN_ID = int(os.getenv('ADMIN_ID', 1079922982))
@@ -1689,6 +2314,14 @@ async def main():
     except Exception as e:
         logger.error(f"❌ Критическая ошибка: {e}")
     finally:
+        purge_analysis_drafts.stop()
+        send_scheduled_notifications.stop()
+        # Сначала воркеры анализа: их результаты еще отправляются через диспетчер
+        await analysis_queue.stop()
+        await outbound.stop()
+        local_analyzer.close()
+        await fsm_storage.close()
+        await http_client.close()
         await db.close()
 
 if __name__ == "__main__":
@@ -0,0 +1,30 @@
+import logging
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+class UserMiddleware(BaseMiddleware):
+    """
+    Передает в обработчики запись пользователя как аргумент user
+
+    Запись берется через кэш Database.get_user, поэтому обработчику
+    не нужно обращаться к базе в начале каждого сообщения.
+    """
+
+    def __init__(self, database=None):
+        self.db = database or db
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        from_user = data.get("event_from_user")
+        data["user"] = await self.db.get_user(from_user.id) if from_user else None
+        return await handler(event, data)
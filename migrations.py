@@ -0,0 +1,254 @@
+import json
+import logging
+from typing import Awaitable, Callable, List, Tuple, Union
+
+import aiosqlite
+
+from analysis_codec import PROMOTED_FIELDS, analysis_columns
+
+logger = logging.getLogger(__name__)
+
+# Шаг миграции: SQL или функция conn -> None для преобразований, которые не выразить в SQL
+Step = Union[str, Callable[[aiosqlite.Connection], Awaitable[None]]]
+
+# Миграции схемы: (версия, описание, шаги). Применяются по порядку,
+# номер последней примененной хранится в PRAGMA user_version.
+MIGRATIONS: List[Tuple[int, str, List[Step]]] = [
+    (1, "Индексы для частых запросов", [
+        # get_users_by_organization: фильтр по организации с сортировкой по роли и имени
+        "CREATE INDEX IF NOT EXISTS idx_users_organization ON users (organization_id, role, full_name)",
+        # Списки пользователей и организаций для администратора
+        "CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_organizations_created_at ON organizations (created_at)",
+        # Техника организации и обратная связь техники с водителями
+        "CREATE INDEX IF NOT EXISTS idx_equipment_organization ON equipment (organization_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_driver_equipment_equipment ON driver_equipment (equipment_id)",
+        # get_document_analysis: последний анализ техники
+        "CREATE INDEX IF NOT EXISTS idx_document_analysis_equipment "
+        "ON document_analysis (equipment_id, created_at)",
+        # get_active_shift: у водителя обычно одна активная смена среди сотен закрытых
+        "CREATE INDEX IF NOT EXISTS idx_shifts_active_driver "
+        "ON shifts (driver_id, start_time) WHERE status = 'active'",
+        "CREATE INDEX IF NOT EXISTS idx_daily_reports_shift ON daily_reports (shift_id, report_date)",
+        "CREATE INDEX IF NOT EXISTS idx_maintenance_equipment ON maintenance (equipment_id, scheduled_date)",
+        "CREATE INDEX IF NOT EXISTS idx_action_logs_user ON action_logs (user_id, created_at)",
+        # Очистка кэша анализа по возрасту и по давности обращения
+        "CREATE INDEX IF NOT EXISTS idx_analysis_cache_created_at ON analysis_cache (created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_analysis_cache_last_access ON analysis_cache (last_access)",
+        "CREATE INDEX IF NOT EXISTS idx_fingerprints_created_at ON document_fingerprints (created_at)",
+        # claim_analysis_job: следующая готовая задача
+        "CREATE INDEX IF NOT EXISTS idx_analysis_jobs_queued "
+        "ON analysis_jobs (next_run_at, id) WHERE status = 'queued'",
+        "CREATE INDEX IF NOT EXISTS idx_analysis_jobs_status ON analysis_jobs (status)",
+    ]),
+]
+
+def _counter_sql(scope: str, table: str, key: str, org: str, value: str, columns: List[str],
+                 condition: str = "1") -> List[str]:
+    """
+    SQL для счетчика stat_counters, который поддерживается триггерами
+
+    key, org, value и condition - выражения над строкой таблицы, где {row}
+    заменяется на NEW, OLD или псевдоним таблицы; учитываются только строки,
+    для которых condition истинно. Счетчик ведется по системе целиком
+    (organization_id = 0) и по организации строки, если она известна.
+    """
+    def add(row: str, sign: str) -> str:
+        return f"""
+            INSERT INTO stat_counters (organization_id, scope, key, value)
+            SELECT org, '{scope}', counter_key, {sign}counter_value FROM (
+                SELECT 0 AS org, {key.format(row=row)} AS counter_key, {value.format(row=row)} AS counter_value
+                UNION ALL
+                SELECT {org.format(row=row)}, {key.format(row=row)}, {value.format(row=row)}
+            ) WHERE org IS NOT NULL AND {condition.format(row=row)}
+            ON CONFLICT (organization_id, scope, key) DO UPDATE SET value = value + excluded.value;"""
+
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS trg_{scope}_insert AFTER INSERT ON {table} BEGIN {add('NEW', '')} END",
+        f"CREATE TRIGGER IF NOT EXISTS trg_{scope}_delete AFTER DELETE ON {table} BEGIN {add('OLD', '-')} END",
+        f"CREATE TRIGGER IF NOT EXISTS trg_{scope}_update AFTER UPDATE OF {', '.join(columns)} ON {table} "
+        f"BEGIN {add('OLD', '-')} {add('NEW', '')} END",
+        # Заполняем счетчик по уже существующим строкам
+        f"""
+            INSERT INTO stat_counters (organization_id, scope, key, value)
+            SELECT org, '{scope}', counter_key, SUM(counter_value) FROM (
+                SELECT 0 AS org, {key.format(row='t')} AS counter_key, {value.format(row='t')} AS counter_value
+                FROM {table} AS t WHERE {condition.format(row='t')}
+                UNION ALL
+                SELECT {org.format(row='t')}, {key.format(row='t')}, {value.format(row='t')}
+                FROM {table} AS t WHERE {condition.format(row='t')}
+            ) WHERE org IS NOT NULL GROUP BY org, counter_key
+            ON CONFLICT (organization_id, scope, key) DO UPDATE SET value = value + excluded.value""",
+    ]
+
+# Организация строки отчета: отчет -> смена -> техника
+_REPORT_ORG = ("(SELECT e.organization_id FROM shifts s JOIN equipment e ON e.id = s.equipment_id "
+               "WHERE s.id = {row}.shift_id)")
+_REPORT_COLUMNS = ["shift_id", "hours_worked", "fuel_used"]
+
+MIGRATIONS.append((2, "Счетчики для статистики", [
+    """CREATE TABLE IF NOT EXISTS stat_counters (
+        organization_id INTEGER NOT NULL,
+        scope TEXT NOT NULL,
+        key TEXT NOT NULL,
+        value REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (organization_id, scope, key)
+    ) WITHOUT ROWID""",
+    # Просроченное и ближайшее ТО считается по дате, поэтому нужен индекс, а не счетчик
+    "CREATE INDEX IF NOT EXISTS idx_maintenance_scheduled ON maintenance (scheduled_date) WHERE status = 'scheduled'",
+    *_counter_sql("users_by_role", "users", "{row}.role", "{row}.organization_id", "1",
+                  ["role", "organization_id"]),
+    *_counter_sql("organizations", "organizations", "'total'", "NULL", "1", ["id"]),
+    *_counter_sql("equipment_by_status", "equipment", "COALESCE({row}.status, 'active')",
+                  "{row}.organization_id", "1", ["status", "organization_id"]),
+    *_counter_sql("analysis_quality", "document_analysis", "COALESCE({row}.analysis_quality, 'unknown')",
+                  "(SELECT organization_id FROM equipment WHERE id = {row}.equipment_id)", "1",
+                  ["analysis_quality", "equipment_id"]),
+    *_counter_sql("reports", "daily_reports", "'total'", _REPORT_ORG, "1", _REPORT_COLUMNS),
+    *_counter_sql("shift_hours", "daily_reports", "'total'", _REPORT_ORG,
+                  "COALESCE({row}.hours_worked, 0)", _REPORT_COLUMNS),
+    *_counter_sql("fuel_used", "daily_reports", "'total'", _REPORT_ORG,
+                  "COALESCE({row}.fuel_used, 0)", _REPORT_COLUMNS),
+]))
+
+MIGRATIONS.append((3, "Индексы для постраничных списков пользователей", [
+    # get_users_page: фильтры по роли и организации с порядком по дате регистрации
+    "CREATE INDEX IF NOT EXISTS idx_users_role_created_at ON users (role, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_users_organization_created_at ON users (organization_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_users_organization_role_created_at "
+    "ON users (organization_id, role, created_at)",
+]))
+
+MIGRATIONS.append((4, "Хранилище состояний FSM", [
+    # Ключ - бот, чат, пользователь, тред и destiny; data - сжатый JSON (см. fsm_storage)
+    """CREATE TABLE IF NOT EXISTS fsm_states (
+        storage_key TEXT PRIMARY KEY,
+        state TEXT,
+        data BLOB,
+        updated_at REAL NOT NULL
+    ) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS idx_fsm_states_updated_at ON fsm_states (updated_at)",
+]))
+
+MIGRATIONS.append((5, "Черновики анализа не входят в статистику", [
+    # Анализ сохраняется до регистрации техники с equipment_id = NULL
+    "DROP TRIGGER IF EXISTS trg_analysis_quality_insert",
+    "DROP TRIGGER IF EXISTS trg_analysis_quality_delete",
+    "DROP TRIGGER IF EXISTS trg_analysis_quality_update",
+    "DELETE FROM stat_counters WHERE scope = 'analysis_quality'",
+    *_counter_sql("analysis_quality", "document_analysis", "COALESCE({row}.analysis_quality, 'unknown')",
+                  "(SELECT organization_id FROM equipment WHERE id = {row}.equipment_id)", "1",
+                  ["analysis_quality", "equipment_id"], "{row}.equipment_id IS NOT NULL"),
+]))
+
+async def _compact_document_analysis(conn: aiosqlite.Connection, batch_size: int = 500):
+    """Перекодирует строки document_analysis из JSON-текста в колонки и сжатый blob"""
+    last_id = 0
+    while True:
+        cursor = await conn.execute(
+            """SELECT id, document_type, analysis_data, analysis_quality, quality_score, missing_fields
+            FROM document_analysis WHERE id > ? AND typeof(analysis_data) = 'text' ORDER BY id LIMIT ?""",
+            (last_id, batch_size)
+        )
+        rows = await cursor.fetchall()
+        await cursor.close()
+        if not rows:
+            return
+
+        updates = []
+        for row_id, document_type, analysis_json, quality, quality_score, missing_fields in rows:
+            columns, blob = analysis_columns({
+                "document_type": document_type,
+                "analysis_data": json.loads(analysis_json or '{}'),
+                "analysis_quality": quality,
+                "quality_score": quality_score,
+                "missing_fields": json.loads(missing_fields) if missing_fields else [],
+            })
+            updates.append((blob, columns["missing_fields"],
+                            *(columns[field] for field in PROMOTED_FIELDS), row_id))
+        await conn.executemany(
+            f"""UPDATE document_analysis SET analysis_data = ?, missing_fields = ?,
+            {', '.join(f'{field} = ?' for field in PROMOTED_FIELDS)} WHERE id = ?""",
+            updates
+        )
+        last_id = rows[-1][0]
+
+MIGRATIONS.append((6, "Колонки и сжатые данные анализа документов", [
+    "ALTER TABLE document_analysis ADD COLUMN vin TEXT",
+    "ALTER TABLE document_analysis ADD COLUMN registration_number TEXT",
+    "ALTER TABLE document_analysis ADD COLUMN brand TEXT",
+    "ALTER TABLE document_analysis ADD COLUMN model TEXT",
+    "ALTER TABLE document_analysis ADD COLUMN year INTEGER",
+    _compact_document_analysis,
+]))
+
+MIGRATIONS.append((7, "Уведомления о ТО и топливе", [
+    # get_due_notifications: техника с датой ТО в окне и с низким остатком топлива.
+    # Нулевой уровень - значение по умолчанию, а не пустой бак, поэтому не учитывается
+    "CREATE INDEX IF NOT EXISTS idx_equipment_next_maintenance "
+    "ON equipment (next_maintenance) WHERE next_maintenance IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS idx_equipment_fuel_percent "
+    "ON equipment (current_fuel_level * 100.0 / fuel_capacity) "
+    "WHERE fuel_capacity > 0 AND current_fuel_level > 0",
+    # Отправленные уведомления: одно на технику, получателя и период.
+    # Период ТО - дата ТО, период топлива - день
+    """CREATE TABLE IF NOT EXISTS notification_log (
+        kind TEXT NOT NULL,
+        equipment_id INTEGER NOT NULL,
+        period TEXT NOT NULL,
+        chat_id INTEGER NOT NULL,
+        sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (kind, equipment_id, period, chat_id)
+    ) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS idx_notification_log_sent_at ON notification_log (sent_at)",
+]))
+
+MIGRATIONS.append((8, "Очистка завершенных задач анализа", [
+    # purge_analysis_jobs удаляет завершенные задачи старше срока хранения
+    "CREATE INDEX IF NOT EXISTS idx_analysis_jobs_finished_at "
+    "ON analysis_jobs (finished_at) WHERE status IN ('done', 'failed')",
+    # Полный результат анализа хранится в document_analysis; у задачи остается только итог
+    """UPDATE analysis_jobs SET result = json_object(
+        'success', json(CASE WHEN json_extract(result, '$.success') THEN 'true' ELSE 'false' END),
+        'analysis_id', json_extract(result, '$.analysis_id')
+    ) WHERE result IS NOT NULL AND json_valid(result)""",
+]))
+
+MIGRATIONS.append((9, "Повтор задачи анализа определяется пользователем и чатом", [
+    # Раньше то же фото от другого пользователя получало чужую задачу и не получало ответа
+    "DROP INDEX IF EXISTS idx_analysis_jobs_active_file",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_analysis_jobs_active_request "
+    "ON analysis_jobs (file_unique_id, chat_id, user_id) WHERE status IN ('queued', 'running')",
+]))
+
+async def get_schema_version(conn: aiosqlite.Connection) -> int:
+    """Возвращает номер последней примененной миграции"""
+    cursor = await conn.execute("PRAGMA user_version")
+    row = await cursor.fetchone()
+    await cursor.close()
+    return row[0]
+
+async def run_migrations(conn: aiosqlite.Connection) -> int:
+    """Применяет недостающие миграции, каждую в своей транзакции"""
+    version = await get_schema_version(conn)
+
+    for number, description, statements in MIGRATIONS:
+        if number <= version:
+            continue
+        try:
+            await conn.execute("BEGIN")
+            for step in statements:
+                if callable(step):
+                    await step(conn)
+                else:
+                    await conn.execute(step)
+            await conn.execute(f"PRAGMA user_version = {number}")
+            await conn.commit()
+        except Exception as e:
+            await conn.rollback()
+            logger.error(f"❌ Ошибка миграции {number} ({description}): {e}")
+            raise
+        version = number
+        logger.info(f"✅ Миграция {number} применена: {description}")
+
+    return version
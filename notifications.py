@@ -0,0 +1,109 @@
+import logging
+import os
+from datetime import date
+from typing import Any, Dict, List
+
+from database import db
+from outbound import BULK, outbound
+
+logger = logging.getLogger(__name__)
+
+# Лимит Telegram - 4096 символов; длинный список делится на несколько сообщений
+MESSAGE_LIMIT = 4000
+
+def _equipment_label(notification: Dict[str, Any]) -> str:
+    label = notification["name"]
+    if notification.get("registration_number"):
+        label += f" ({notification['registration_number']})"
+    return label
+
+def format_notifications(notifications: List[Dict[str, Any]]) -> List[str]:
+    """Сообщения для одного получателя: ТО и топливо отдельными списками"""
+    today = date.today().isoformat()
+    maintenance = sorted((n for n in notifications if n["kind"] == "maintenance"), key=lambda n: n["period"])
+    fuel = sorted((n for n in notifications if n["kind"] == "fuel"), key=lambda n: n["fuel_percent"])
+
+    lines = []
+    if maintenance:
+        lines.append("🔧 <b>Плановое ТО:</b>")
+        for notification in maintenance:
+            scheduled = date.fromisoformat(notification["period"]).strftime("%d.%m.%Y")
+            overdue = " ⚠️ просрочено" if notification["period"] < today else ""
+            lines.append(f"• {_equipment_label(notification)} - {scheduled}{overdue}")
+    if fuel:
+        if lines:
+            lines.append("")
+        lines.append("⛽ <b>Мало топлива:</b>")
+        for notification in fuel:
+            lines.append(f"• {_equipment_label(notification)} - {int(notification['fuel_percent'])}%")
+
+    messages = []
+    text = "🔔 <b>Уведомления по технике</b>\n"
+    for line in lines:
+        if len(text) + len(line) + 1 > MESSAGE_LIMIT:
+            messages.append(text)
+            text = ""
+        text += f"\n{line}"
+    messages.append(text)
+    return messages
+
+class NotificationScheduler:
+    """
+    Уведомления о ближайшем ТО и низком остатке топлива
+
+    Проверка запускается по расписанию aiocron. Один запрос находит все
+    пары техника - получатель, о которых еще не сообщали в текущем
+    периоде; уведомления отмечаются в notification_log до отправки
+    и уходят рассылкой через диспетчер исходящих сообщений, по одному
+    сообщению на получателя.
+    """
+
+    def __init__(self, database=None, queue=None):
+        self.db = database or db
+        self.outbound = queue or outbound
+        self.maintenance_days = int(os.getenv('NOTIFICATION_MAINTENANCE_DAYS', 7))
+        self.fuel_threshold = float(os.getenv('NOTIFICATION_FUEL_THRESHOLD', 20))
+        self.log_days = int(os.getenv('NOTIFICATION_LOG_DAYS', 90))
+
+        self._stats = {
+            "runs": 0,
+            "notifications": 0,
+            "recipients": 0,
+        }
+
+    async def run(self) -> int:
+        """Проверяет технику и ставит уведомления в очередь; возвращает число получателей"""
+        self._stats["runs"] += 1
+        due = await self.db.get_due_notifications(self.maintenance_days, self.fuel_threshold)
+        notifications = await self.db.mark_notifications_sent(due) if due else []
+
+        by_chat: Dict[int, List[Dict[str, Any]]] = {}
+        for notification in notifications:
+            by_chat.setdefault(notification["chat_id"], []).append(notification)
+        for chat_id, items in by_chat.items():
+            for text in format_notifications(items):
+                self.outbound.send(chat_id, text, priority=BULK)
+
+        if notifications:
+            self._stats["notifications"] += len(notifications)
+            self._stats["recipients"] += len(by_chat)
+            logger.info(f"🔔 Уведомлений поставлено в очередь: {len(notifications)}, получателей: {len(by_chat)}")
+
+        removed = await self.db.purge_notification_log(self.log_days)
+        if removed:
+            logger.info(f"🧹 Удалено старых записей журнала уведомлений: {removed}")
+        return len(by_chat)
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(self._stats)
+
+    def format_stats(self) -> str:
+        """Статистика уведомлений в виде строки для сообщений"""
+        stats = self.stats()
+        return (
+            f"проверок: {stats['runs']}, уведомлений: {stats['notifications']}, "
+            f"получателей: {stats['recipients']}"
+        )
+
+# Создаем глобальный планировщик уведомлений
+notification_scheduler = NotificationScheduler()
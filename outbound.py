@@ -0,0 +1,372 @@
+import asyncio
+import heapq
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Очереди приоритета: ответы в диалоге уходят раньше рассылок
+INTERACTIVE = "interactive"
+BULK = "bulk"
+LANES = (INTERACTIVE, BULK)
+
+# Лимит длины сообщения Telegram; склеенные сообщения не должны его превышать
+MESSAGE_LIMIT = 4096
+COALESCE_SEPARATOR = "\n\n"
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, в запасе не больше capacity"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self, reserve: float = 0.0) -> float:
+        """Сколько секунд ждать, пока в ведре не останется reserve токенов сверх одного"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        needed = 1 + reserve
+        return 0.0 if self.tokens >= needed else (needed - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds: float):
+        """Опустошает ведро так, чтобы следующий токен появился через seconds"""
+        self.delay()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def full(self) -> bool:
+        return self.delay() == 0.0 and self.tokens >= self.capacity
+
+class Outgoing:
+    """Исходящее сообщение и ожидание его отправки"""
+
+    __slots__ = ("text", "kwargs", "coalesce", "future", "queued_at", "attempt")
+
+    def __init__(self, text: str, kwargs: Dict[str, Any], coalesce: bool, future: asyncio.Future):
+        self.text = text
+        self.kwargs = kwargs
+        self.coalesce = coalesce
+        self.future = future
+        self.queued_at = time.monotonic()
+        self.attempt = 1
+
+class OutboundDispatcher:
+    """
+    Диспетчер исходящих сообщений с ограничением скорости Telegram
+
+    Telegram принимает от бота около 30 сообщений в секунду суммарно и
+    около одного в секунду в один чат, а при превышении отвечает
+    RetryAfter. Здесь у каждого чата свое ведро токенов с небольшим
+    запасом на серию ответов, а общий поток ограничивает глобальное
+    ведро. Сообщения ждут в очереди своего чата, поэтому один чат не
+    задерживает остальные.
+
+    Ответы в диалоге (INTERACTIVE) идут раньше рассылок (BULK), а
+    рассылки не берут последние bulk_reserve токенов глобального ведра.
+    Несколько сообщений, скопившихся в очереди одного чата, отправляются
+    одним. RetryAfter приостанавливает чат, а для рассылок - и весь
+    поток, после чего сообщение отправляется повторно.
+
+    Каждая отправка идет отдельной задачей, одновременно не больше
+    max_in_flight, поэтому медленный ответ Telegram в одном чате не
+    задерживает остальные. В одном чате одновременно идет одна отправка,
+    так что сообщения чата приходят по порядку.
+    """
+
+    def __init__(self, bot=None):
+        self.bot = bot
+        self.global_rate = float(os.getenv('OUTBOUND_GLOBAL_RATE', 25))
+        self.chat_rate = float(os.getenv('OUTBOUND_CHAT_RATE', 1.0))
+        self.chat_burst = float(os.getenv('OUTBOUND_CHAT_BURST', 3))
+        # Доля глобального ведра, которую рассылки оставляют ответам в диалоге
+        self.bulk_reserve = self.global_rate * float(os.getenv('OUTBOUND_BULK_RESERVE', 0.2))
+        self.max_attempts = int(os.getenv('OUTBOUND_MAX_ATTEMPTS', 3))
+        self.max_in_flight = int(os.getenv('OUTBOUND_MAX_IN_FLIGHT', 20))
+
+        self._bucket = TokenBucket(self.global_rate, self.global_rate)
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        # (chat_id, очередь) -> сообщения в порядке отправки
+        self._pending: Dict[Tuple[int, str], Deque[Outgoing]] = {}
+        # Очередь -> чаты с сообщениями: (время готовности, номер, chat_id)
+        self._ready: Dict[str, List[Tuple[float, int, int]]] = {lane: [] for lane in LANES}
+        self._sequence = 0
+        self._bulk_paused_until = 0.0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self._deliveries: Set[asyncio.Task] = set()
+        # Чаты, в которые идет отправка, и их очереди, отложенные до ее конца
+        self._in_flight: Set[int] = set()
+        self._parked: Dict[int, Set[str]] = {}
+
+        # Последние времена ожидания в очереди (с) по очередям приоритета
+        self._latency: Dict[str, Deque[float]] = {lane: deque(maxlen=500) for lane in LANES}
+        self._stats = {
+            "queued": 0,
+            "sent": 0,
+            "coalesced": 0,
+            "retried": 0,
+            "dropped": 0,
+        }
+
+    def start(self, bot=None):
+        """Запускает отправку; bot можно передать, если его не было при создании"""
+        if bot:
+            self.bot = bot
+        if not self._task:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает отправку; начатые отправки завершаются, ожидающие получают None"""
+        if self._task:
+            # wait_for в Python 3.11 может поглотить отмену, если событие
+            # пришло одновременно с ней, поэтому цикл проверяет и флаг
+            self._stopping = True
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await asyncio.gather(*self._deliveries, return_exceptions=True)
+        for messages in self._pending.values():
+            for outgoing in messages:
+                self._resolve(outgoing, None)
+        self._pending.clear()
+        for heap in self._ready.values():
+            heap.clear()
+
+    def send(self, chat_id: int, text: str, priority: str = INTERACTIVE,
+             coalesce: bool = True, **kwargs) -> asyncio.Future:
+        """
+        Ставит сообщение в очередь
+
+        Возвращает future с отправленным сообщением (None при ошибке);
+        ждать его не обязательно. coalesce=False - сообщение не
+        склеивается с соседними, например если его потом редактируют.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._push(chat_id, priority, Outgoing(text, kwargs, coalesce, future))
+        self._stats["queued"] += 1
+        return future
+
+    def _push(self, chat_id: int, lane: str, outgoing: Outgoing, front: bool = False):
+        messages = self._pending.get((chat_id, lane))
+        if messages is None:
+            messages = self._pending[(chat_id, lane)] = deque()
+            self._schedule(lane, chat_id, time.monotonic())
+        if front:
+            messages.appendleft(outgoing)
+        else:
+            messages.append(outgoing)
+
+    def _schedule(self, lane: str, chat_id: int, ready_at: float):
+        self._sequence += 1
+        heapq.heappush(self._ready[lane], (ready_at, self._sequence, chat_id))
+        self._wakeup.set()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _next(self) -> Tuple[Optional[str], Optional[int], float]:
+        """
+        Выбирает очередь и чат для следующей отправки
+
+        Возвращает (очередь, chat_id, 0) или (None, None, сколько ждать).
+        """
+        now = time.monotonic()
+        wait = 60.0
+        for lane in LANES:
+            heap = self._ready[lane]
+            while heap:
+                ready_at, _, chat_id = heap[0]
+                if ready_at > now:
+                    wait = min(wait, ready_at - now)
+                    break
+                # В чат уже идет отправка: очередь вернется в расписание после нее
+                if chat_id in self._in_flight:
+                    heapq.heappop(heap)
+                    self._parked.setdefault(chat_id, set()).add(lane)
+                    continue
+                # Время готовности могло устареть: чат писал из другой очереди
+                chat_delay = self._chat_bucket(chat_id).delay()
+                if chat_delay > 0:
+                    self._sequence += 1
+                    heapq.heapreplace(heap, (now + chat_delay, self._sequence, chat_id))
+                    continue
+                if lane == BULK:
+                    global_delay = max(self._bucket.delay(self.bulk_reserve), self._bulk_paused_until - now)
+                else:
+                    global_delay = self._bucket.delay()
+                if global_delay > 0:
+                    wait = min(wait, global_delay)
+                    break
+                heapq.heappop(heap)
+                return lane, chat_id, 0.0
+        return None, None, wait
+
+    async def _run(self):
+        while not self._stopping:
+            await self._slots.acquire()
+            lane, chat_id, wait = self._next()
+            if lane is None:
+                self._slots.release()
+                # Новое сообщение или конец отправки может сделать чат готовым раньше
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            batch = self._take_batch(self._pending[(chat_id, lane)])
+            self._bucket.take()
+            self._chat_bucket(chat_id).take()
+            self._in_flight.add(chat_id)
+            task = asyncio.create_task(self._send_batch(chat_id, lane, batch))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+
+    async def _send_batch(self, chat_id: int, lane: str, batch: List[Outgoing]):
+        """Отправка одной задачей; после нее чат снова ставится в расписание"""
+        try:
+            await self._deliver(chat_id, lane, batch)
+        except asyncio.CancelledError:
+            for outgoing in batch:
+                self._resolve(outgoing, None)
+            raise
+        finally:
+            self._slots.release()
+            self._in_flight.discard(chat_id)
+            now = time.monotonic()
+            for chat_lane in {lane} | self._parked.pop(chat_id, set()):
+                messages = self._pending.get((chat_id, chat_lane))
+                if messages:
+                    self._schedule(chat_lane, chat_id, now)
+                elif messages is not None:
+                    del self._pending[(chat_id, chat_lane)]
+            self._wakeup.set()
+            self._forget_idle_chats()
+
+    def _take_batch(self, messages: Deque[Outgoing]) -> List[Outgoing]:
+        """Забирает первое сообщение и склеиваемые с ним следующие"""
+        batch = [messages.popleft()]
+        length = len(batch[0].text)
+        while messages and self._can_coalesce(batch[-1], messages[0], length):
+            length += len(COALESCE_SEPARATOR) + len(messages[0].text)
+            batch.append(messages.popleft())
+        return batch
+
+    @staticmethod
+    def _can_coalesce(last: Outgoing, following: Outgoing, length: int) -> bool:
+        """Параметры отправки должны совпадать, клавиатура допустима только у последнего"""
+        if not (last.coalesce and following.coalesce) or last.kwargs.get("reply_markup") is not None:
+            return False
+        if length + len(COALESCE_SEPARATOR) + len(following.text) > MESSAGE_LIMIT:
+            return False
+        options = {key: value for key, value in following.kwargs.items() if key != "reply_markup"}
+        return options == last.kwargs
+
+    async def _deliver(self, chat_id: int, lane: str, batch: List[Outgoing]):
+        """Отправляет сообщение или склейку; при RetryAfter возвращает их в очередь"""
+        text = COALESCE_SEPARATOR.join(outgoing.text for outgoing in batch)
+        kwargs = batch[-1].kwargs
+        try:
+            message = await self.bot.send_message(chat_id, text, **kwargs)
+        except TelegramRetryAfter as e:
+            logger.warning(f"Telegram просит подождать {e.retry_after}с перед отправкой в чат {chat_id}")
+            self._chat_bucket(chat_id).pause(e.retry_after)
+            if lane == BULK:
+                self._bulk_paused_until = time.monotonic() + e.retry_after
+            if batch[0].attempt < self.max_attempts:
+                self._stats["retried"] += 1
+                for outgoing in reversed(batch):
+                    outgoing.attempt += 1
+                    self._push(chat_id, lane, outgoing, front=True)
+            else:
+                self._drop(batch)
+            return
+        except TelegramForbiddenError:
+            # Пользователь заблокировал бота - повторять бесполезно
+            self._drop(batch)
+            return
+        except Exception as e:
+            if len(batch) > 1:
+                # Ошибку могло вызвать одно из склеенных сообщений: остальные
+                # отправляются по одному, и теряется только ошибочное
+                logger.warning(f"Склейка {len(batch)} сообщений в чат {chat_id} не отправлена ({e}), отправляю по одному")
+                for outgoing in reversed(batch):
+                    outgoing.coalesce = False
+                    self._push(chat_id, lane, outgoing, front=True)
+                return
+            logger.error(f"Ошибка отправки сообщения в чат {chat_id}: {e}")
+            self._drop(batch)
+            return
+
+        now = time.monotonic()
+        self._stats["sent"] += 1
+        self._stats["coalesced"] += len(batch) - 1
+        for outgoing in batch:
+            self._latency[lane].append(now - outgoing.queued_at)
+            self._resolve(outgoing, message)
+
+    def _drop(self, batch: List[Outgoing]):
+        self._stats["dropped"] += len(batch)
+        for outgoing in batch:
+            self._resolve(outgoing, None)
+
+    @staticmethod
+    def _resolve(outgoing: Outgoing, message):
+        if not outgoing.future.done():
+            outgoing.future.set_result(message)
+
+    def _forget_idle_chats(self):
+        """Удаляет ведра чатов, которые успели наполниться и ничего не ждут"""
+        if len(self._chat_buckets) > 10000:
+            waiting = {chat_id for chat_id, _ in self._pending}
+            self._chat_buckets = {
+                chat_id: bucket for chat_id, bucket in self._chat_buckets.items()
+                if chat_id in waiting or not bucket.full()
+            }
+
+    def metrics(self) -> Dict[str, Any]:
+        """Счетчики отправки, длина очередей и задержка в очереди по приоритетам"""
+        result = dict(self._stats)
+        result["in_flight"] = len(self._deliveries)
+        for lane in LANES:
+            latencies = sorted(self._latency[lane])
+            result[f"{lane}_pending"] = sum(
+                len(messages) for (_, message_lane), messages in self._pending.items() if message_lane == lane
+            )
+            result[f"{lane}_latency_p50"] = round(latencies[len(latencies) // 2], 3) if latencies else None
+            result[f"{lane}_latency_p95"] = (
+                round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3) if latencies else None
+            )
+            result[f"{lane}_latency_max"] = round(latencies[-1], 3) if latencies else None
+        return result
+
+    def format_stats(self) -> str:
+        """Статистика диспетчера в виде строки для сообщений"""
+        metrics = self.metrics()
+        return (
+            f"отправлено: {metrics['sent']} (склеено: {metrics['coalesced']}), "
+            f"повторов: {metrics['retried']}, потеряно: {metrics['dropped']}; "
+            f"в очереди: {metrics['interactive_pending']} ответов / {metrics['bulk_pending']} рассылок; "
+            f"ожидание p50/p95: ответы {metrics['interactive_latency_p50']}/{metrics['interactive_latency_p95']}с, "
+            f"рассылки {metrics['bulk_latency_p50']}/{metrics['bulk_latency_p95']}с"
+        )
+
+# Создаем глобальный диспетчер исходящих сообщений; бот передается в start()
+outbound = OutboundDispatcher()
@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Any
+
+logger = logging.getLogger(__name__)
+
+class CircuitBreaker:
+    """
+    Автомат защиты для внешнего сервиса (closed / open / half_open)
+
+    После failure_threshold ошибок подряд автомат размыкается и запросы
+    сразу отклоняются. Через recovery_timeout секунд пропускается
+    ограниченное число пробных запросов: успех замыкает автомат,
+    ошибка снова размыкает его. Вызов без результата должен вернуть
+    слот через release().
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: float = 30,
+                 half_open_max_calls: int = 1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._half_open_calls = 0
+        self._stats = {"rejected": 0, "opened": 0}
+
+    def allow_request(self) -> bool:
+        """Проверяет, можно ли сейчас обращаться к сервису"""
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.recovery_timeout:
+                self._stats["rejected"] += 1
+                return False
+            self.state = self.HALF_OPEN
+            self._half_open_calls = 0
+            logger.info(f"🟡 {self.name}: пробные запросы после размыкания")
+
+        if self.state == self.HALF_OPEN:
+            if self._half_open_calls >= self.half_open_max_calls:
+                self._stats["rejected"] += 1
+                return False
+            self._half_open_calls += 1
+
+        return True
+
+    def release(self):
+        """
+        Возвращает пробный слот вызова, завершившегося без результата
+
+        Вызов мог быть отменен (например, хеджирующим запросом) или
+        прерван неожиданной ошибкой до ответа сервиса; иначе занятый
+        им слот остался бы занят и автомат не вышел бы из half_open.
+        """
+        if self.state == self.HALF_OPEN and self._half_open_calls > 0:
+            self._half_open_calls -= 1
+
+    def record_success(self):
+        """Отмечает успешный вызов"""
+        if self.state != self.CLOSED:
+            logger.info(f"🟢 {self.name}: сервис восстановился")
+        self.state = self.CLOSED
+        self._failures = 0
+
+    def record_failure(self):
+        """Отмечает неудачный вызов (таймаут, 429, 5xx, ошибка соединения)"""
+        self._failures += 1
+        if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self._stats["opened"] += 1
+                logger.warning(f"🔴 {self.name}: автомат разомкнут после {self._failures} ошибок")
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+
+    def stats(self) -> Dict[str, Any]:
+        """Возвращает состояние автомата"""
+        retry_in = 0.0
+        if self.state == self.OPEN:
+            retry_in = max(self.recovery_timeout - (time.monotonic() - self._opened_at), 0.0)
+        return {
+            **self._stats,
+            "state": self.state,
+            "consecutive_failures": self._failures,
+            "retry_in": round(retry_in, 1),
+        }
+
+class AdaptiveLimiter:
+    """
+    Адаптивный лимит одновременных запросов (AIMD)
+
+    Успешный быстрый ответ увеличивает лимит примерно на единицу за
+    «окно» из limit запросов. Перегрузка (429, 5xx, таймаут или задержка
+    выше latency_target) уменьшает лимит вдвое, но не чаще раза в cooldown секунд.
+    """
+
+    def __init__(self, name: str, initial_limit: int = 4, min_limit: int = 1, max_limit: int = 32,
+                 latency_target: float = 10, decrease_factor: float = 0.5, cooldown: float = 1.0):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+
+        self._limit = float(initial_limit)
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+        self._stats = {"increases": 0, "decreases": 0, "waited": 0}
+
+    @property
+    def limit(self) -> int:
+        return max(int(self._limit), self.min_limit)
+
+    @asynccontextmanager
+    async def slot(self):
+        """Занимает место среди одновременных запросов на время вызова"""
+        async with self._condition:
+            if self._in_flight >= self.limit:
+                self._stats["waited"] += 1
+            await self._condition.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    def record_success(self, latency: float):
+        """Учитывает успешный ответ и его задержку"""
+        if latency > self.latency_target:
+            self.record_overload()
+            return
+        if self._limit < self.max_limit:
+            self._limit = min(self._limit + 1.0 / self._limit, float(self.max_limit))
+            self._stats["increases"] += 1
+
+    def record_overload(self):
+        """Уменьшает лимит при признаках перегрузки сервиса"""
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        previous = self.limit
+        self._limit = max(self._limit * self.decrease_factor, float(self.min_limit))
+        self._stats["decreases"] += 1
+        if self.limit != previous:
+            logger.warning(f"⚠️ {self.name}: лимит параллельных запросов снижен {previous} → {self.limit}")
+
+    def stats(self) -> Dict[str, Any]:
+        """Возвращает текущий лимит и загрузку"""
+        return {
+            **self._stats,
+            "limit": self.limit,
+            "in_flight": self._in_flight,
+        }
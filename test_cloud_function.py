@@ -0,0 +1,126 @@
+"""
+Проверка пайплайна Cloud Function против локальной заглушки API
+
+Запуск: python -m unittest test_cloud_function (или pytest)
+"""
+import base64
+import io
+import json
+import socket
+import unittest
+from unittest import mock
+
+from PIL import Image
+
+import cloud_function
+from cloud_function_stub import SAMPLE_TEXT, StubApiServer
+
+def _image_base64() -> str:
+    output = io.BytesIO()
+    Image.new("RGB", (640, 400), "white").save(output, format="JPEG")
+    return base64.b64encode(output.getvalue()).decode("ascii")
+
+def _event(document_type: str = "СТС") -> dict:
+    return {"body": json.dumps({"image": _image_base64(), "prompt": "Извлеки поля", "document_type": document_type})}
+
+def _batch_event(size: int = 2) -> dict:
+    items = [{"image": _image_base64(), "document_type": "СТС"} for _ in range(size)]
+    return {"body": json.dumps({"items": items, "prompt": "Извлеки поля"})}
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class CloudFunctionPipelineTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.stub = StubApiServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.stub.stop()
+
+    def setUp(self):
+        self.stub.text = SAMPLE_TEXT
+        self.stub.vision_status = self.stub.llm_status = 200
+        self.stub.requests.clear()
+        patches = [
+            mock.patch.object(cloud_function, "VISION_URL", f"{self.stub.url}/vision"),
+            mock.patch.object(cloud_function, "LLM_URL", f"{self.stub.url}/llm"),
+            mock.patch.object(cloud_function, "LLM_ENABLED", True),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def _call(self, event=None):
+        response = cloud_function.handler(event or _event(), None)
+        return response["statusCode"], json.loads(response["body"])
+
+    def test_fields_from_llm(self):
+        status, body = self._call()
+        self.assertEqual(status, 200)
+        result = body["result"]
+        self.assertEqual(result["fields_source"], "llm")
+        self.assertEqual(result["vin"], "X9F65200090012345")
+        self.assertEqual(result["engine_power"], 400)
+        self.assertEqual(result["analysis_quality"], "high")
+        self.assertEqual([path for path, _ in self.stub.requests], ["/vision", "/llm"])
+        self.assertEqual(set(result["processing_time"]), {"normalize", "ocr", "llm", "validate", "total"})
+
+    def test_llm_error_falls_back_to_regex(self):
+        self.stub.llm_status = 500
+        status, body = self._call()
+        self.assertEqual(status, 200)
+        result = body["result"]
+        self.assertEqual(result["fields_source"], "regex")
+        self.assertEqual(result["vin"], "X9F65200090012345")
+        self.assertEqual(result["registration_number"], "А123ВС77")
+        self.assertEqual(result["brand"], "КАМАЗ")
+        self.assertIn("Марка: КАМАЗ", result["extracted_text"])
+
+    def test_unreachable_ocr_returns_502(self):
+        with mock.patch.object(cloud_function, "VISION_URL", f"http://127.0.0.1:{_free_port()}/vision"):
+            status, body = self._call()
+        self.assertEqual(status, 502)
+        self.assertIn("Сервис распознавания недоступен", body["error"])
+
+    def test_ocr_error_returns_502(self):
+        self.stub.vision_status = 503
+        status, _ = self._call()
+        self.assertEqual(status, 502)
+
+    def test_batch_with_ocr_down_returns_502(self):
+        self.stub.vision_status = 503
+        status, body = self._call(_batch_event())
+        self.assertEqual(status, 502)
+        self.assertEqual([item["index"] for item in body["results"]], [0, 1])
+        self.assertTrue(all(item["upstream_error"] for item in body["results"]))
+
+    def test_batch_item_errors_keep_200(self):
+        event = json.loads(_batch_event()["body"])
+        event["items"][1]["image"] = ""
+        status, body = self._call({"body": json.dumps(event)})
+        self.assertEqual(status, 200)
+        first, second = body["results"]
+        self.assertEqual(first["result"]["vin"], "X9F65200090012345")
+        self.assertIn("Отсутствует изображение", second["error"])
+        self.assertNotIn("upstream_error", second)
+
+    def test_warm_calls_reuse_connection(self):
+        self._call()
+        connections = self.stub.stats["connections"]
+        self._call()
+        self._call()
+        self.assertEqual(self.stub.stats["connections"], connections)
+
+    def test_image_without_text_is_rejected(self):
+        self.stub.text = ""
+        status, body = self._call()
+        self.assertEqual(status, 400)
+        self.assertIn("не распознан", body["error"])
+
+if __name__ == "__main__":
+    unittest.main()
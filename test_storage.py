@@ -0,0 +1,223 @@
+"""
+Проверка хранения данных: кодек анализа, миграции, состояния FSM и очередь анализа
+
+Каждый тест работает со своей базой SQLite во временном каталоге.
+Запуск: python -m unittest test_storage (или pytest)
+"""
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from aiogram.fsm.storage.base import StorageKey
+
+import fsm_storage
+from analysis_codec import analysis_columns, decode_analysis, restore_analysis
+from database import Database
+from fsm_storage import SQLiteStorage
+from job_queue import AnalysisJobQueue
+from migrations import MIGRATIONS, get_schema_version
+
+LEGACY_RESULT = {
+    "success": True,
+    "document_type": "СТС",
+    "vin": "X9F65200090012345",
+    "registration_number": "А123ВС77",
+    "brand": "КАМАЗ",
+    "model": "6520-43",
+    "year": 2019,
+    "color": None,
+    "extracted_text": "СВИДЕТЕЛЬСТВО О РЕГИСТРАЦИИ ТРАНСПОРТНОГО СРЕДСТВА\nМарка: КАМАЗ",
+}
+
+class AnalysisCodecTest(unittest.TestCase):
+
+    def test_round_trip_keeps_values_and_explicit_none(self):
+        columns, blob = analysis_columns({
+            "analysis_data": LEGACY_RESULT, "document_type": "СТС",
+            "analysis_quality": "high", "quality_score": 0.9, "missing_fields": ["color"],
+        })
+        self.assertIsInstance(blob, bytes)
+        self.assertEqual(columns["vin"], LEGACY_RESULT["vin"])
+        self.assertEqual(columns["missing_fields"], "color")
+
+        restored = restore_analysis({**columns, "analysis_data": blob})
+        for key, value in LEGACY_RESULT.items():
+            self.assertEqual(restored[key], value, key)
+        self.assertIn("color", restored)
+        self.assertEqual(restored["missing_fields"], ["color"])
+
+    def test_legacy_json_row(self):
+        row = {
+            "analysis_data": json.dumps(LEGACY_RESULT, ensure_ascii=False, indent=2),
+            "missing_fields": json.dumps(["color", "owner"]),
+            "document_type": "СТС", "analysis_quality": "medium",
+        }
+        restored = restore_analysis(row)
+        for key, value in LEGACY_RESULT.items():
+            self.assertEqual(restored[key], value, key)
+        self.assertEqual(restored["missing_fields"], ["color", "owner"])
+
+    def test_unknown_format_is_rejected(self):
+        with self.assertRaises(ValueError):
+            decode_analysis(b"\x7fdata", {})
+
+class StorageTestCase(unittest.IsolatedAsyncioTestCase):
+    """Общая часть: файл базы во временном каталоге и подключение к нему"""
+
+    async def asyncSetUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.db_path = os.path.join(directory.name, "test.db")
+        self.databases = []
+
+    async def asyncTearDown(self):
+        for database in self.databases:
+            await database.close()
+
+    async def connect(self) -> Database:
+        database = Database(self.db_path)
+        self.databases.append(database)
+        self.assertTrue(await database.connect())
+        return database
+
+class MigrationsTest(StorageTestCase):
+
+    async def _create_legacy_database(self):
+        """База до миграций: исходные таблицы, user_version = 0, анализ в JSON-тексте"""
+        legacy = Database(self.db_path)
+        legacy.conn = await legacy._open_connection()
+        try:
+            await legacy.create_tables()
+            await legacy.conn.execute(
+                """INSERT INTO document_analysis
+                (equipment_id, document_type, analysis_data, analysis_quality, quality_score, missing_fields)
+                VALUES (?, ?, ?, ?, ?, ?)""",
+                (7, "СТС", json.dumps(LEGACY_RESULT, ensure_ascii=False, indent=2),
+                 "high", 0.9, json.dumps(["color"]))
+            )
+            await legacy.conn.execute(
+                """INSERT INTO analysis_jobs
+                (file_id, file_unique_id, document_type, user_id, chat_id, status, result,
+                 enqueued_at, next_run_at, finished_at)
+                VALUES ('f', 'u', 'СТС', 1, 1, 'done', ?, 0, 0, 0)""",
+                (json.dumps({"success": True, "analysis_id": 1, "analysis": LEGACY_RESULT}, ensure_ascii=False),)
+            )
+            await legacy.conn.commit()
+            self.assertEqual(await get_schema_version(legacy.conn), 0)
+        finally:
+            await legacy.conn.close()
+
+    async def test_migrations_from_version_zero(self):
+        await self._create_legacy_database()
+        database = await self.connect()
+
+        self.assertEqual(await get_schema_version(database.conn), MIGRATIONS[-1][0])
+
+        cursor = await database.conn.execute(
+            "SELECT typeof(analysis_data), vin, brand, year, missing_fields FROM document_analysis"
+        )
+        self.assertEqual(tuple(await cursor.fetchone()), ("blob", LEGACY_RESULT["vin"], "КАМАЗ", 2019, "color"))
+        await cursor.close()
+
+        analysis = await database.get_document_analysis(7)
+        self.assertEqual(analysis["missing_fields"], ["color"])
+        for key, value in LEGACY_RESULT.items():
+            self.assertEqual(analysis["analysis_data"][key], value, key)
+
+        cursor = await database.conn.execute("SELECT result FROM analysis_jobs")
+        self.assertEqual(json.loads((await cursor.fetchone())[0]), {"success": True, "analysis_id": 1})
+        await cursor.close()
+
+    async def test_reconnect_does_not_reapply(self):
+        database = await self.connect()
+        await database.close()
+        self.databases.remove(database)
+
+        with mock.patch("migrations.logger") as migrations_logger:
+            database = await self.connect()
+        migrations_logger.info.assert_not_called()
+        self.assertEqual(await get_schema_version(database.conn), MIGRATIONS[-1][0])
+
+class FSMStorageTest(StorageTestCase):
+
+    KEY = StorageKey(bot_id=1, chat_id=10, user_id=20)
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.database = await self.connect()
+
+    def storage(self) -> SQLiteStorage:
+        storage = SQLiteStorage(self.database)
+        storage.ttl = 60
+        return storage
+
+    async def test_state_and_data_survive_restart(self):
+        storage = self.storage()
+        await storage.set_state(self.KEY, "Registration:photo")
+        await storage.set_data(self.KEY, {"analysis_id": 5, "note": "т" * 1000})
+
+        restarted = self.storage()
+        self.assertEqual(await restarted.get_state(self.KEY), "Registration:photo")
+        self.assertEqual(await restarted.get_data(self.KEY), {"analysis_id": 5, "note": "т" * 1000})
+
+    async def test_clear_removes_record(self):
+        storage = self.storage()
+        await storage.set_state(self.KEY, "Registration:photo")
+        await storage.set_data(self.KEY, {"analysis_id": 5})
+
+        await storage.set_state(self.KEY, None)
+        await storage.set_data(self.KEY, {})
+
+        self.assertIsNone(await self.database.get_fsm_record(storage.make_key(self.KEY)))
+        self.assertIsNone(await self.storage().get_state(self.KEY))
+        self.assertEqual(await self.storage().get_data(self.KEY), {})
+
+    async def test_abandoned_state_expires(self):
+        storage = self.storage()
+        await storage.set_state(self.KEY, "Registration:photo")
+        await storage.set_data(self.KEY, {"analysis_id": 5})
+
+        later = time.time() + storage.ttl + 1
+        with mock.patch.object(fsm_storage.time, "time", return_value=later):
+            self.assertIsNone(await storage.get_state(self.KEY))
+            self.assertEqual(await storage.get_data(self.KEY), {})
+        self.assertEqual(storage.stats()["expired"], 1)
+        self.assertIsNone(await self.database.get_fsm_record(storage.make_key(self.KEY)))
+
+class AnalysisJobQueueTest(StorageTestCase):
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.database = await self.connect()
+        self.queue = AnalysisJobQueue(self.database, handler=None)
+
+    async def test_same_photo_from_same_user_is_deduplicated(self):
+        job_id, created = await self.queue.enqueue("file-1", "unique-1", "СТС", user_id=1, chat_id=1)
+        self.assertTrue(created)
+        self.assertEqual(await self.queue.enqueue("file-2", "unique-1", "СТС", user_id=1, chat_id=1),
+                         (job_id, False))
+        self.assertEqual(self.queue._stats["duplicates"], 1)
+
+    async def test_same_photo_from_another_user_gets_own_job(self):
+        first, _ = await self.queue.enqueue("file-1", "unique-1", "СТС", user_id=1, chat_id=1)
+        second, created = await self.queue.enqueue("file-1", "unique-1", "СТС", user_id=2, chat_id=2)
+        self.assertTrue(created)
+        self.assertNotEqual(first, second)
+
+    async def test_finished_job_does_not_block_new_one(self):
+        job_id, _ = await self.queue.enqueue("file-1", "unique-1", "СТС", user_id=1, chat_id=1)
+        job = await self.database.claim_analysis_job()
+        self.assertEqual(job["id"], job_id)
+        self.assertEqual(await self.queue.enqueue("file-1", "unique-1", "СТС", user_id=1, chat_id=1),
+                         (job_id, False))
+
+        await self.database.finish_analysis_job(job_id, "done", result={"success": True})
+        new_id, created = await self.queue.enqueue("file-1", "unique-1", "СТС", user_id=1, chat_id=1)
+        self.assertTrue(created)
+        self.assertNotEqual(new_id, job_id)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,10 +1,12 @@
-import aiohttp
 import base64
 import json
 import logging
 from typing import Dict, Any, Optional
 import os
 
+from extraction import parse_document_text, parse_instrument_panel
+from http_client import http_client
+
 logger = logging.getLogger(__name__)
 
 class YandexVisionAnalyzer:
@@ -51,15 +53,15 @@ class YandexVisionAnalyzer:
                 }]
             }
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, headers=headers, json=data, timeout=30) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        return self._process_vision_result(result, feature_type)
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"Ошибка Vision API: {response.status} - {error_text}")
-                        return {"error": f"Ошибка API: {response.status}"}
+            session = await http_client.get_session()
+            async with session.post(url, headers=headers, json=data, timeout=http_client.timeout(30)) as response:
+                if response.status == 200:
+                    result = await response.json()
+                    return self._process_vision_result(result, feature_type)
+                else:
+                    error_text = await response.text()
+                    logger.error(f"Ошибка Vision API: {response.status} - {error_text}")
+                    return {"error": f"Ошибка API: {response.status}"}
                         
         except Exception as e:
             logger.error(f"Ошибка анализа изображения: {e}")
@@ -120,41 +122,7 @@ class YandexVisionAnalyzer:
     
     def _parse_document_text(self, text: str) -> Dict[str, str]:
         """Пытается найти ключевые поля в тексте документа"""
-        info = {}
-        
-        # Поиск VIN (17 символов, буквы и цифры)
-        import re
-        vin_pattern = r'[A-HJ-NPR-Z0-9]{17}'
-        vin_match = re.search(vin_pattern, text.upper())
-        if vin_match:
-            info['vin'] = vin_match.group(0)
-        
-        # Поиск госномера (русские буквы, цифры)
-        plate_pattern = r'[АВЕКМНОРСТУХ]\d{3}[АВЕКМНОРСТУХ]{2}\d{2,3}'
-        plate_match = re.search(plate_pattern, text.upper())
-        if plate_match:
-            info['registration_number'] = plate_match.group(0)
-        
-        # Поиск года
-        year_pattern = r'\b(19[0-9]{2}|20[0-2][0-9])\b'
-        year_match = re.search(year_pattern, text)
-        if year_match:
-            info['year'] = year_match.group(0)
-        
-        # Простые поиски по ключевым словам
-        lines = text.split('\n')
-        for line in lines:
-            if 'МОДЕЛЬ' in line.upper() or 'MODEL' in line.upper():
-                parts = line.split(':')
-                if len(parts) > 1:
-                    info['model'] = parts[1].strip()
-            
-            if 'МАРКА' in line.upper() or 'BRAND' in line.upper():
-                parts = line.split(':')
-                if len(parts) > 1:
-                    info['brand'] = parts[1].strip()
-        
-        return info
+        return parse_document_text(text)
     
     def _is_likely_document(self, text: str) -> bool:
         """Определяет, похож ли текст на документ"""
@@ -182,34 +150,7 @@ class YandexVisionAnalyzer:
     
     def _parse_instrument_panel(self, text: str) -> Dict[str, str]:
         """Парсит показания приборной панели"""
-        info = {}
-        
-        # Ищем пробег (одометр)
-        import re
-        # Паттерны для пробега: цифры с "km", "км", или просто большие числа
-        patterns = [
-            r'(\d{1,6}[.,]?\d*)\s*(km|км|к\.м\.)',
-            r'(Пробег|Одометр|ODO)[:\s]*(\d{1,6}[.,]?\d*)',
-            r'\b(\d{4,6})\b'  # Просто 4-6 цифр подряд
-        ]
-        
-        for pattern in patterns:
-            matches = re.findall(pattern, text, re.IGNORECASE)
-            if matches:
-                for match in matches:
-                    if isinstance(match, tuple):
-                        for item in match:
-                            if item and item.isdigit():
-                                info['odometer'] = int(item.replace('.', '').replace(',', ''))
-                                break
-                    elif match.isdigit():
-                        info['odometer'] = int(match)
-                    if 'odometer' in info:
-                        break
-            if 'odometer' in info:
-                break
-        
-        return info
+        return parse_instrument_panel(text)
 
 # Создаем глобальный экземпляр анализатора
 vision_analyzer = YandexVisionAnalyzer()